@@ -1,19 +1,34 @@
 from .model import Node, Snapshot, NodeType
-from typing import Optional, Iterator, NamedTuple, Union
+from .diff import Strategy, moves, resolve
+from .hashing import changedRanges
+from .logging import metric
+from .formats import ThreadedWriter
+from typing import IO, Callable, Optional, Iterator, NamedTuple, Union
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from contextlib import nullcontext
+import bz2
+import gzip
+import io
+import lzma
 import os
+import stat
+import tarfile
 
 # --
 # ## Backup operations
 
-Op = Union["OpRm", "OpData", "OpMeta", "OpLn"]
+Op = Union["OpRm", "OpData", "OpMeta", "OpLn", "OpMv"]
 
 class OpRm(NamedTuple):
     """Remove operation"""
     path: str
 
 class OpData(NamedTuple):
-    """Data update operation"""
+    """Data update operation, for the given range of the file when set"""
     path: str
+    offset: Optional[int] = None
+    length: Optional[int] = None
 
 class OpMeta(NamedTuple):
     """Metadata update operation"""
@@ -29,18 +44,42 @@ class OpLn(NamedTuple):
     path: str
     origin: str
 
-def iops(current: Snapshot, other: Optional[Snapshot] = None) -> Iterator[Op]:
-    """Streams operations to unify `other` with `current`"""
+class OpMv(NamedTuple):
+    """Move operation, of the file at `origin` to `path`"""
+    path: str
+    origin: str
+
+def iops(current: Snapshot, other: Optional[Snapshot] = None, strategy: Strategy = Strategy.SIGNATURE, moved: bool = False) -> Iterator[Op]:
+    """Streams operations to unify `other` with `current`, computing missing
+    signatures following the given `strategy`. When `moved` is set, files
+    of `other` found with the same contents at another path of `current`
+    are moved rather than removed and written again."""
+    # Signatures made with different algorithms can't be compared, in which
+    # case contents are compared by size and time.
+    signatures = not other or current.algorithm == other.algorithm
     # Get all paths from both snapshots
     all_paths = set(current.nodes.keys())
     if other:
         all_paths.update(other.nodes.keys())
+    # The origins of the moved files, by destination
+    origins: dict[str, str] = moves(
+        (_ for p, _ in other.nodes.items() if p not in current.nodes),
+        (_ for p, _ in current.nodes.items() if p not in other.nodes),
+        (other, current),
+    ) if moved and other else {}
+    sources = set(origins.values())
 
     for path in sorted(all_paths):
         current_node = current.nodes.get(path)
         other_node = other.nodes.get(path) if other else None
 
-        if current_node and not other_node:
+        if current_node and other and path in origins:
+            # The file was moved, and may need its metadata updated
+            yield OpMv(path, origins[path])
+            if meta := metaop(current_node, other.nodes[origins[path]]):
+                yield meta
+
+        elif current_node and not other_node:
             # Path exists in current but not in other - create it
             if current_node.type == NodeType.FILE:
                 yield OpData(path)
@@ -48,7 +87,7 @@ def iops(current: Snapshot, other: Optional[Snapshot] = None) -> Iterator[Op]:
                 # For symlinks, we need to read the actual target from filesystem
                 # Since Node doesn't store the target, we'll need to read it
                 try:
-                    target = os.readlink(path)
+                    target = os.readlink(os.path.join(current.root, path) if current.root else path)
                     yield OpLn(path, target)
                 except OSError:
                     # If we can't read the link, skip it
@@ -65,34 +104,67 @@ def iops(current: Snapshot, other: Optional[Snapshot] = None) -> Iterator[Op]:
                 )
 
         elif other_node and not current_node:
-            # Path exists in other but not in current - remove it
-            yield OpRm(path)
+            # Path exists in other but not in current - remove it, unless
+            # it was moved
+            if path not in sources:
+                yield OpRm(path)
 
         elif current_node and other_node:
             # Path exists in both - check for differences
-            if current_node.hasContentChanged(other_node):
+            if other:
+                resolve((current_node, other_node), (current, other), strategy)
+            if current_node.hasContentChanged(other_node, signatures):
                 if current_node.type == NodeType.FILE:
-                    yield OpData(path)
+                    yield from dataops(current_node, current, other)
                 elif current_node.type == NodeType.LINK:
                     try:
-                        target = os.readlink(path)
+                        target = os.readlink(os.path.join(current.root, path) if current.root else path)
                         yield OpLn(path, target)
                     except OSError:
                         pass
 
-            if current_node.hasMetaChanged(other_node):
-                if current_node.meta and other_node.meta:
-                    # Only yield changed attributes
-                    mode = current_node.meta.mode if current_node.meta.mode != other_node.meta.mode else None
-                    uid = current_node.meta.uid if current_node.meta.uid != other_node.meta.uid else None
-                    gid = current_node.meta.gid if current_node.meta.gid != other_node.meta.gid else None
-                    ctime = current_node.meta.ctime if current_node.meta.ctime != other_node.meta.ctime else None
-                    mtime = current_node.meta.mtime if current_node.meta.mtime != other_node.meta.mtime else None
+            if meta := metaop(current_node, other_node):
+                yield meta
 
-                    if any([mode, uid, gid, ctime, mtime]):
-                        yield OpMeta(path, mode, uid, gid, ctime, mtime)
+def metaop(node: Node, previous: Node) -> Optional[OpMeta]:
+    """Returns the operation that updates the metadata of `previous` to the
+    one of `node`, at the path of `node`, if it changed."""
+    if node.hasMetaChanged(previous):
+        if node.meta and previous.meta:
+            # Only yield changed attributes
+            mode = node.meta.mode if node.meta.mode != previous.meta.mode else None
+            uid = node.meta.uid if node.meta.uid != previous.meta.uid else None
+            gid = node.meta.gid if node.meta.gid != previous.meta.gid else None
+            ctime = node.meta.ctime if node.meta.ctime != previous.meta.ctime else None
+            mtime = node.meta.mtime if node.meta.mtime != previous.meta.mtime else None
 
-def iscript(current: Snapshot, other: Optional[Snapshot] = None, root: str = "") -> Iterator[str]:
+            if any([mode, uid, gid, ctime, mtime]):
+                return OpMeta(node.path, mode, uid, gid, ctime, mtime)
+    return None
+
+def dataops(node: Node, current: Snapshot, other: Optional[Snapshot]) -> Iterator[OpData]:
+    """Yields the data operations for the given changed file, limited to the
+    ranges that changed when both snapshots have its block signatures and
+    the file did not shrink."""
+    path = node.path
+    size = node.meta.size if node.meta else None
+    previous = other.blocks.get(path) if other and other.blocks else None
+    blocks = current.blocks.get(path) if current.blocks else None
+    if (
+        previous is None
+        or blocks is None
+        or size is None
+        or not other
+        or other.blockSize != current.blockSize
+        or not current.blockSize
+        or len(blocks) < len(previous)
+    ):
+        yield OpData(path)
+    else:
+        for offset, length in changedRanges(previous, blocks, current.blockSize, size):
+            yield OpData(path, offset, length)
+
+def iscript(current: Snapshot, other: Optional[Snapshot] = None, root: str = "", strategy: Strategy = Strategy.SIGNATURE, moved: bool = False) -> Iterator[str]:
     """Converts operations into script command strings"""
     # Header comment
     from datetime import datetime
@@ -100,29 +172,153 @@ def iscript(current: Snapshot, other: Optional[Snapshot] = None, root: str = "")
     src_name = "SRC_PATH" if other else "PATH_OR_SNAPSHOT"
     other_name = "PATH_OR_SNAPSHOT" if other else "empty"
     yield f"# Backup of {src_name} from {other_name} on {timestamp}"
+    # The root lets `sink patch` tell the relative paths
+    if root:
+        yield f"# ROOT {root}"
+
+    for op in iops(current, other, strategy, moved):
+        if line := opline(op, root):
+            yield line
+
+def opline(op: Op, root: str = "") -> Optional[str]:
+    """Returns the script command for the given operation, with its paths
+    prefixed by `root`"""
+    path = os.path.join(root, op.path) if root else op.path
+    if isinstance(op, OpRm):
+        return f"RM {path}"
+    elif isinstance(op, OpData):
+        if op.offset is None:
+            return f"DATA {path}"
+        # The path goes last, so that it can't be mistaken for the range
+        return f"RANGE {op.offset} {op.length} {path}"
+    elif isinstance(op, OpMeta):
+        parts = []
+        if op.mode is not None:
+            parts.append(f"mode={op.mode}")
+        if op.uid is not None:
+            parts.append(f"uid={op.uid}")
+        if op.gid is not None:
+            parts.append(f"gid={op.gid}")
+        if op.ctime is not None:
+            parts.append(f"ctime={op.ctime}")
+        if op.mtime is not None:
+            parts.append(f"mtime={op.mtime}")
+        return f"META {path} {' '.join(parts)}" if parts else None
+    elif isinstance(op, OpLn):
+        return f"LN {path} {op.origin}"
+    elif isinstance(op, OpMv):
+        return f"MV {path} {os.path.join(root, op.origin) if root else op.origin}"
+    return None
 
-    for op in iops(current, other):
-        path = os.path.join(root, op.path) if root else op.path
-
-        if isinstance(op, OpRm):
-            yield f"RM {path}"
-        elif isinstance(op, OpData):
-            yield f"DATA {path}"
-        elif isinstance(op, OpMeta):
-            parts = []
-            if op.mode is not None:
-                parts.append(f"mode={op.mode}")
-            if op.uid is not None:
-                parts.append(f"uid={op.uid}")
-            if op.gid is not None:
-                parts.append(f"gid={op.gid}")
-            if op.ctime is not None:
-                parts.append(f"ctime={op.ctime}")
-            if op.mtime is not None:
-                parts.append(f"mtime={op.mtime}")
-            if parts:
-                yield f"META {path} {' '.join(parts)}"
+# --
+# ## Archives
+#
+# A tar backup embeds the data of the changed files, so that it can be
+# streamed to another machine and extracted over the previous state with
+# `tar x`. Files are read ahead of the archive writer by a pool of threads,
+# whole when they are small, and large files are copied as they are
+# written, which bounds the memory in flight to about
+# `PREFETCH_DEPTH * PREFETCH_SIZE`. Compression happens in its own thread
+# as well. The removals and metadata changes that tar can't express are
+# written as a script in a last `OPS` member.
+
+# The name of the member listing the other operations
+OPS: str = ".sink-ops"
+# Files up to this size are read by the prefetching threads
+PREFETCH_SIZE: int = 1024 * 1024
+# The number of operations queued ahead of the archive writer
+PREFETCH_DEPTH: int = 64
+
+# The compressors of archives, by extension, which leave the stream they
+# write to open.
+COMPRESSORS: dict[str, Callable[[IO[bytes]], IO[bytes]]] = {
+    ".gz": lambda f: gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6),
+    ".xz": lambda f: lzma.LZMAFile(f, "wb"),
+    ".bz2": lambda f: bz2.BZ2File(f, "wb"),
+}
+
+def prefetch(path: str) -> tuple[os.stat_result, Optional[bytes]]:
+    """Returns the `stat` of the file at `path` and its contents when it is
+    small enough to be prefetched."""
+    with open(path, "rb") as f:
+        r = os.fstat(f.fileno())
+        return r, f.read() if r.st_size <= PREFETCH_SIZE else None
+
+def archive(current: Snapshot, other: Optional[Snapshot], output: IO[bytes], codec: Optional[str] = None, strategy: Strategy = Strategy.SIGNATURE, jobs: int = 4) -> tuple[int, int]:
+    """Writes the changes to unify `other` with `current` as a tar archive
+    to `output`, compressed with the given `codec` extension, reading the
+    files from the root of `current`. Returns the number of members and of
+    bytes of file data written."""
+    if not current.root or not os.path.isdir(current.root):
+        raise ValueError("Archives need the source to be a directory")
+    root = current.root
+    archived = metric("backup.files")
+    written = metric("backup.bytes")
+    count: int = 0
+    size: int = 0
+    script: list[str] = []
+    pending: deque[tuple[Op, Optional[Future[tuple[os.stat_result, Optional[bytes]]]]]] = deque()
+    # Paths whose data is in the archive, whose metadata comes with it
+    added: set[str] = set()
+
+    def member(tar: tarfile.TarFile, op: Op, future: Optional[Future[tuple[os.stat_result, Optional[bytes]]]]) -> None:
+        nonlocal count, size
+        path = os.path.join(root, op.path)
+        if future:
+            try:
+                r, data = future.result()
+            except FileNotFoundError:
+                return
+            info = tar.tarinfo(op.path)
+            info.mode = stat.S_IMODE(r.st_mode)
+            info.uid, info.gid, info.mtime = r.st_uid, r.st_gid, r.st_mtime
+            if data is not None:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            else:
+                # Large files are copied as they are written
+                with open(path, "rb") as f:
+                    info.size = os.fstat(f.fileno()).st_size
+                    tar.addfile(info, f)
+            count += 1
+            size += info.size
+            archived.inc()
+            written.add(info.size)
         elif isinstance(op, OpLn):
-            yield f"LN {path} {op.origin}"
+            info = tar.tarinfo(op.path)
+            info.type = tarfile.SYMTYPE
+            info.linkname = op.origin
+            tar.addfile(info)
+            count += 1
+            archived.inc()
+        elif line := opline(op):
+            script.append(line)
+
+    stream: IO[bytes] = io.BufferedWriter(ThreadedWriter(COMPRESSORS[codec](output)), buffer_size=1024 * 1024) if codec else output
+    with stream if codec else nullcontext(), tarfile.open(fileobj=stream, mode="w|", format=tarfile.PAX_FORMAT) as tar, ThreadPoolExecutor(max(1, jobs)) as pool:
+        for op in iops(current, other, strategy):
+            if isinstance(op, OpData):
+                # Ranges of a file are archived as the whole file
+                if op.path in added:
+                    continue
+                added.add(op.path)
+                pending.append((op, pool.submit(prefetch, os.path.join(root, op.path))))
+            elif isinstance(op, OpMeta) and op.path in added:
+                continue
+            else:
+                if isinstance(op, OpLn):
+                    added.add(op.path)
+                pending.append((op, None))
+            while len(pending) > PREFETCH_DEPTH:
+                member(tar, *pending.popleft())
+        while pending:
+            member(tar, *pending.popleft())
+        if script:
+            data = "".join(f"{_}\n" for _ in script).encode("utf8")
+            info = tar.tarinfo(OPS)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+            count += 1
+    return count, size
 
 # EOF
\ No newline at end of file
@@ -0,0 +1,173 @@
+from typing import Optional, Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from time import time
+import os
+import sqlite3
+from .logging import metric
+
+# --
+# ## Signature cache
+#
+# Signatures are cached on disk, keyed by the device and inode of the file
+# and the hash algorithm, and validated against its size, modification and
+# change times (in nanoseconds). A file whose `stat` is unchanged since it
+# was last hashed reuses its cached signature. Entries are evicted when they
+# have not been used for `MAX_AGE` seconds, or when there are more than
+# `MAX_ENTRIES`, least recently used first.
+
+# The version of the schema, an older cache is discarded.
+VERSION: int = 2
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS signatures (
+	dev INTEGER NOT NULL,
+	ino INTEGER NOT NULL,
+	algorithm TEXT NOT NULL,
+	size INTEGER NOT NULL,
+	mtime_ns INTEGER NOT NULL,
+	ctime_ns INTEGER NOT NULL,
+	sig TEXT NOT NULL,
+	used INTEGER NOT NULL,
+	PRIMARY KEY (dev, ino, algorithm)
+);
+CREATE INDEX IF NOT EXISTS signatures_used ON signatures (used);
+"""
+
+
+class SignatureCache:
+	"""An on-disk cache of file signatures, backed by SQLite."""
+
+	MAX_AGE: int = 30 * 24 * 3600
+	MAX_ENTRIES: int = 2_000_000
+	# The last use of an entry is only updated with this granularity, so
+	# that a cache hit does not always imply a write.
+	USED_RESOLUTION: int = 24 * 3600
+	# The number of pending writes after which they are committed
+	BATCH: int = 10_000
+	# Files modified less than this many seconds ago are not cached, as a
+	# later change within the timestamp resolution would go unnoticed.
+	RECENT: int = 2
+
+	@staticmethod
+	def Location() -> Path:
+		"""Returns the default location of the cache database"""
+		base = (
+			os.environ.get("XDG_CACHE_HOME") or f"{os.environ.get('HOME', '.')}/.cache"
+		)
+		return Path(base) / "sink" / "signatures.sqlite"
+
+	@staticmethod
+	def Open(
+		path: Optional[Path] = None, *, rehash: bool = False
+	) -> Optional["SignatureCache"]:
+		"""Opens the cache at the given path, returning `None` when the cache
+		cannot be opened (for instance, when the location is read-only)."""
+		path = path or SignatureCache.Location()
+		try:
+			path.parent.mkdir(parents=True, exist_ok=True)
+			return SignatureCache(sqlite3.connect(str(path)), rehash=rehash)
+		except (OSError, sqlite3.Error):
+			return None
+
+	def __init__(self, db: sqlite3.Connection, *, rehash: bool = False):
+		self.db: sqlite3.Connection = db
+		# When rehashing, the cache is only written to
+		self.rehash: bool = rehash
+		self.now: int = int(time())
+		self.updated: list[tuple[int, int, str, int, int, int, str, int]] = []
+		self.touched: list[tuple[int, int, int, str]] = []
+		self.hits = metric("snap.cache.hit")
+		self.misses = metric("snap.cache.miss")
+		if self.db.execute("PRAGMA user_version").fetchone()[0] != VERSION:
+			self.db.executescript(
+				f"DROP TABLE IF EXISTS signatures; PRAGMA user_version={VERSION};"
+			)
+		self.db.executescript(SCHEMA)
+
+	def get(self, r: os.stat_result, algorithm: str) -> Optional[str]:
+		"""Returns the cached signature for the file with the given `stat`,
+		if it has not changed since."""
+		row = (
+			None
+			if self.rehash
+			else self.db.execute(
+				"SELECT size, mtime_ns, ctime_ns, sig, used FROM signatures WHERE dev=? AND ino=? AND algorithm=?",
+				(r.st_dev, r.st_ino, algorithm),
+			).fetchone()
+		)
+		if row and row[0:3] == (r.st_size, r.st_mtime_ns, r.st_ctime_ns):
+			self.hits.inc()
+			if self.now - row[4] > self.USED_RESOLUTION:
+				self.touched.append((self.now, r.st_dev, r.st_ino, algorithm))
+			return str(row[3])
+		else:
+			self.misses.inc()
+			return None
+
+	def set(self, r: os.stat_result, algorithm: str, sig: str) -> None:
+		"""Caches the signature `sig` made with `algorithm` for the file with
+		the given `stat`."""
+		if r.st_mtime_ns // 1_000_000_000 >= self.now - self.RECENT:
+			return
+		self.updated.append(
+			(
+				r.st_dev,
+				r.st_ino,
+				algorithm,
+				r.st_size,
+				r.st_mtime_ns,
+				r.st_ctime_ns,
+				sig,
+				self.now,
+			)
+		)
+		if len(self.updated) >= self.BATCH:
+			self.flush()
+
+	def flush(self) -> None:
+		"""Commits the pending writes"""
+		with self.db:
+			self.db.executemany(
+				"INSERT OR REPLACE INTO signatures VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+				self.updated,
+			)
+			self.db.executemany(
+				"UPDATE signatures SET used=? WHERE dev=? AND ino=? AND algorithm=?",
+				self.touched,
+			)
+		self.updated.clear()
+		self.touched.clear()
+
+	def evict(self) -> None:
+		"""Removes the entries that are too old, and then the least recently
+		used entries above `MAX_ENTRIES`."""
+		with self.db:
+			self.db.execute(
+				"DELETE FROM signatures WHERE used < ?", (self.now - self.MAX_AGE,)
+			)
+			self.db.execute(
+				"DELETE FROM signatures WHERE rowid IN (SELECT rowid FROM signatures ORDER BY used DESC LIMIT -1 OFFSET ?)",
+				(self.MAX_ENTRIES,),
+			)
+
+	def close(self) -> None:
+		self.flush()
+		self.evict()
+		self.db.close()
+
+
+@contextmanager
+def signatures(
+	enabled: bool = True, *, rehash: bool = False
+) -> Iterator[Optional[SignatureCache]]:
+	"""Opens the default signature cache for the duration of the context,
+	yielding `None` when disabled or unavailable."""
+	cache = SignatureCache.Open(rehash=rehash) if enabled else None
+	try:
+		yield cache
+	finally:
+		if cache:
+			cache.close()
+
+
+# EOF
@@ -88,7 +88,8 @@ def command(
 	alias: Optional[str] = None,
 ) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
 	"""Decorator used to register a function as a CLI command. Arguments
-	are like `("-o","-f|--format", "FILE+")` and the decorated function
+	are like `("-o?","-f|--format?", "--force", "FILE+")`, where options
+	without cardinality are boolean flags, and the decorated function
 	should have a documentation that contains lines like
 	`o: Output file` or `format: Output format` or `FILE: Input file(s)`."""
 	cli_args: dict[str, TArgument] = {}
@@ -113,9 +114,12 @@ def command(
 					p_args.append(f"-{short}")
 				if long:
 					p_args.append(f"--{long}")
+				# Options without cardinality are flags, like `--rehash`
+				if not card:
+					p_kwargs["action"] = "store_true"
 				# NOTE: Using append is actually better than
 				# using nargs there.
-				if card in "+*":
+				elif card in "+*":
 					p_kwargs["action"] = "append"
 
 				p_kwargs["dest"] = name
@@ -154,6 +158,10 @@ def command(
 				continue
 			kk = pythonArgNames[k]
 			cli_args[kk][1].setdefault("default", v)
+		# Arguments annotated as integers are converted by `argparse`.
+		for k, t in arg_spec.annotations.items():
+			if k in pythonArgNames and t in (int, Optional[int]):
+				cli_args[pythonArgNames[k]][1].setdefault("type", int)
 		for line in (f.__doc__ or "").split("\n"):
 			if not (m := RE_ARG.match(line)):
 				doc.append(line)
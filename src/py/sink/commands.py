@@ -2,17 +2,27 @@ from .cli import command, write, CLI
 from .utils import difftool
 from .snap import snapshot
 from .term import TermFont, termcolor
-from .diff import diff as _diff
-from .model import Snapshot, Status
+from .diff import idiff, comparable, strategy, Strategy
+from .model import Node, Snapshot, Status
 from .matching import (
 	filters,
 	rawfilters,
 )
-from .backup import iscript
+from .backup import COMPRESSORS, archive, iscript
+from .patch import Patcher, parse
+from .cache import signatures
+from .hashing import ALGORITHM, BLOCK_SIZE, changedRanges
+from .formats import FORMATS, codecOf, formatOf, save
+from .store import generations
+from .watch import Watcher
 from .snap import snapshot
-from typing import Optional, NamedTuple
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional, TextIO
+from contextlib import nullcontext
 from pathlib import Path
+from time import monotonic as now
 import json
+import os
+import sys
 
 
 # --
@@ -21,6 +31,10 @@ import json
 # Defines the primary commands available through the Sink CLI.
 
 O_STANDARD = ["-o|--output?", "-f|--format?"]
+O_SNAPSHOT = ["-j|--jobs?", "-W|--walkers?", "-H|--hash?", "--no-cache", "--rehash"]
+O_COMPARE = ["-c|--compare?"]
+O_STORE = ["--store", "--store-dir?"]
+O_BLOCKS = ["--blocks", "--block-size?"]
 O_FILTERS = [
 	"-i|--ignores*",
 	"-I|--ignore-set*",
@@ -82,7 +96,10 @@ def parseDiffRange(text: str) -> DiffRange:
 
 # TODO: Add -s for the filterset
 # TODO: Seems that snap
-@command("PATH?", *(O_STANDARD + O_FILTERS))
+@command(
+	"PATH?",
+	*(O_STANDARD + O_SNAPSHOT + O_STORE + O_BLOCKS + O_FILTERS + ["--mmap?"]),
+)
 def snap(
 	cli: CLI[None],
 	*,
@@ -97,8 +114,23 @@ def snap(
 	acceptSet: Optional[list[str]] = None,
 	keepSet: Optional[list[str]] = None,
 	filterSet: Optional[list[str]] = None,
+	jobs: int = 1,
+	walkers: int = 1,
+	hash: str = ALGORITHM,
+	noCache: bool = False,
+	rehash: bool = False,
+	store: bool = False,
+	storeDir: Optional[str] = None,
+	blocks: bool = False,
+	blockSize: int = BLOCK_SIZE,
+	mmap: Optional[int] = None,
 ) -> None:
-	"""Takes a snapshot of the given file location."""
+	"""Takes a snapshot of the given file location. With `--store`, the
+	snapshot is added to the snapshot store as a new generation, and is only
+	output when an output is given. With `--blocks`, large files are given
+	block signatures, so that the ranges that change can be told. With
+	`--mmap SIZE`, files of at least SIZE bytes are memory-mapped to be
+	hashed rather than read in chunks."""
 
 	active_filters = filters(
 		rejects=ignores,
@@ -109,20 +141,145 @@ def snap(
 		keepSet=keepSet,
 		filterSet=filterSet,
 	)
-	s = snapshot(
-		path,
-		accepts=active_filters.accepts,
-		rejects=active_filters.rejects,
-		keeps=active_filters.keeps,
+	format = formatOf(output) or format
+	# Nodes are written as they are produced, so the output file exists
+	# while walking, and we make sure it's not part of the snapshot.
+	excluded = (
+		os.path.relpath(os.path.abspath(output), os.path.abspath(path))
+		if output and output != "-"
+		else None
 	)
-	if output and output.endswith(".json"):
-		format = "json"
-	with write(output) as f:
-		if format == "json":
-			json.dump(s.toPrimitive(), f)
-		else:
-			for path in s.nodes:
-				f.write(f"{path}\n")
+	with (
+		signatures(not noCache, rehash=rehash) as cache,
+		generations(storeDir) if store else nullcontext(None) as history,
+	):
+		s = snapshot(
+			path,
+			accepts=active_filters.accepts,
+			rejects=active_filters.rejects,
+			keeps=active_filters.keeps,
+			gitignore=active_filters.gitignore,
+			jobs=jobs,
+			walkers=walkers,
+			cache=cache,
+			algorithm=hash,
+			stream=True,
+			exclude=excluded,
+			blocks=blockSize if blocks else None,
+			mmapThreshold=mmap,
+		)
+		# Nodes are added to the store as they are written
+		writer = history.writer(path, s.algorithm) if history else None
+		nodes = writer.stream(s.stream()) if writer else s.stream()
+		try:
+			if format in FORMATS.values():
+				save(
+					output,
+					nodes,
+					format,
+					s.footer,
+					algorithm=s.algorithm,
+					sorted=s.isSorted,
+					# Directory hashes known upfront, like for stored
+					# generations, are written before the nodes so that
+					# JSON snapshots can be pruned as they are read.
+					**({"dirs": s.dirs} if s.dirs is not None else {}),
+				)
+			elif writer and not output:
+				for _ in nodes:
+					pass
+			else:
+				with write(output) as f:
+					for node in nodes:
+						f.write(f"{node.path}\n")
+		except BaseException:
+			if writer:
+				writer.abort()
+			raise
+		if writer:
+			generation = writer.close(s.dirs, s.blocks, s.blockSize)
+			sys.stderr.write(
+				f"INF Stored {path} as generation {generation}: {writer.count} nodes, {writer.written} entries, {writer.added} new records\n"
+			)
+
+
+# The walk of `watch` adds the watches as it goes, and is always serial
+O_WATCH = ["-j|--jobs?", "-H|--hash?", "--no-cache", "--rehash", "--interval?"]
+
+
+@command("PATH?", *(O_STANDARD + O_WATCH + O_FILTERS))
+def watch(
+	cli: CLI[None],
+	*,
+	path: str = ".",
+	format: Optional[str] = None,
+	output: Optional[str] = None,
+	ignores: Optional[list[str]] = None,
+	accepts: Optional[list[str]] = None,
+	keeps: Optional[list[str]] = None,
+	ignoreSet: Optional[list[str]] = None,
+	acceptSet: Optional[list[str]] = None,
+	keepSet: Optional[list[str]] = None,
+	filterSet: Optional[list[str]] = None,
+	jobs: int = 1,
+	hash: str = ALGORITHM,
+	noCache: bool = False,
+	rehash: bool = False,
+	interval: int = 5,
+) -> None:
+	"""Watches the given file location (on Linux), keeping its snapshot up to
+	date from filesystem events rather than walking it again. The snapshot
+	is written to the output whenever it changed, at most every `interval`
+	seconds, and until interrupted, in the given `format` or the one of the
+	output's extension."""
+	if format is not None and format not in FORMATS.values():
+		raise ValueError(
+			f"Unsupported snapshot format '{format}', pick one of: {', '.join(FORMATS.values())}"
+		)
+	active_filters = filters(
+		rejects=ignores,
+		accepts=accepts,
+		keeps=keeps,
+		rejectSet=ignoreSet,
+		acceptSet=acceptSet,
+		keepSet=keepSet,
+		filterSet=filterSet,
+	)
+	ignored: set[str] = set()
+	if output and output != "-":
+		# The output and its temporary file may be in the watched location
+		rel = os.path.relpath(os.path.abspath(output), os.path.abspath(path))
+		head, name = os.path.split(rel)
+		ignored = {rel, os.path.join(head, f".tmp-{name}")}
+	with signatures(not noCache, rehash=rehash) as cache:
+		watcher = Watcher(
+			path,
+			accepts=active_filters.accepts,
+			rejects=active_filters.rejects,
+			keeps=active_filters.keeps,
+			gitignore=active_filters.gitignore,
+			jobs=jobs,
+			cache=cache,
+			algorithm=hash,
+			ignored=ignored,
+		)
+		try:
+			count = len(watcher.start().nodes)
+			sys.stderr.write(f"INF Watching {path}: {count} nodes\n")
+			if output and output != "-":
+				watcher.write(output, format)
+				watcher.run(output, format=format, interval=interval)
+			else:
+				while True:
+					if n := watcher.poll(interval):
+						sys.stderr.write(
+							f"INF Applied {n} events: {len(watcher.snapshot.nodes)} nodes\n"
+						)
+		except KeyboardInterrupt:
+			if output and output != "-" and watcher.changed:
+				watcher.write(output, format)
+		finally:
+			watcher.close()
 
 
 @command("PATH?", *(O_STANDARD + O_FILTERS))
@@ -171,7 +328,7 @@ def _filters(
 		f.write("No active filter\n")
 
 
-@command("PATH+", *(O_STANDARD + O_FILTERS))
+@command("PATH+", *(O_STANDARD + O_SNAPSHOT + O_FILTERS))
 def _list(
 	cli: CLI[None],
 	*,
@@ -185,9 +342,13 @@ def _list(
 	acceptSet: Optional[list[str]] = None,
 	keepSet: Optional[list[str]] = None,
 	filterSet: Optional[list[str]] = None,
+	jobs: int = 1,
+	walkers: int = 1,
+	hash: str = ALGORITHM,
+	noCache: bool = False,
+	rehash: bool = False,
 ) -> None:
 	"""Prints out the paths in the given snapshot."""
-	snap: Snapshot | None = None
 	active_filters = filters(
 		rejects=ignores,
 		accepts=accepts,
@@ -197,33 +358,138 @@ def _list(
 		keepSet=keepSet,
 		filterSet=filterSet,
 	)
-	for s in [
-		snapshot(
-			_,
-			accepts=active_filters.accepts,
-			rejects=active_filters.rejects,
-			keeps=active_filters.keeps,
-		)
-		for _ in path
-	]:
-		if snap:
-			snap = snap.extend(s.nodes.values())
-		else:
-			snap = s
-	with write(output) as out_file:
-		if not snap:
-			pass
-		elif format == "json":
-			json.dump(snap.toPrimitive(), out_file)
+	format = formatOf(output) or format
+	with signatures(not noCache, rehash=rehash) as cache:
+		snaps = [
+			snapshot(
+				_,
+				accepts=active_filters.accepts,
+				rejects=active_filters.rejects,
+				keeps=active_filters.keeps,
+				gitignore=active_filters.gitignore,
+				jobs=jobs,
+				walkers=walkers,
+				cache=cache,
+				algorithm=hash,
+				stream=True,
+			)
+			for _ in path
+		]
+
+		# Snapshots are streamed, and we only keep track of the paths
+		# to detect duplicates when there's more than one.
+		def nodes() -> Iterator[Node]:
+			seen: Optional[set[str]] = set() if len(snaps) > 1 else None
+			for s in snaps:
+				for node in s.stream():
+					if seen is not None:
+						if node.path in seen:
+							raise RuntimeError(f"Node already registered: {node.path}")
+						seen.add(node.path)
+					yield node
+
+		if format in FORMATS.values():
+			save(
+				output,
+				nodes(),
+				format,
+				# Directory hashes are only valid for a single snapshot
+				lambda: snaps[0].footer() if len(snaps) == 1 else {},
+				algorithm=snaps[0].algorithm,
+				sorted=len(snaps) == 1 and snaps[0].isSorted,
+				**(
+					{"dirs": snaps[0].dirs}
+					if len(snaps) == 1 and snaps[0].dirs is not None
+					else {}
+				),
+			)
 		else:
-			for path_str in snap.nodes.keys():
-				out_file.write(f"{path_str}\n")
+			with write(output) as out_file:
+				for node in nodes():
+					out_file.write(f"{node.path}\n")
 
 
 SOURCES = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
+# The initial width of the paths column, when it is adaptive
+DIFF_WIDTH: int = 32
+DIFF_COLORS: dict[str, str] = {
+	# NOTE: I've changed the presentation here, '.' becomes '+' and
+	# '<' becomes '.'. We may
+	" ! ": f"{termcolor(237, 73, 18)}{TermFont.Bold} ! {TermFont.Reset}",
+	" - ": f"{termcolor(237, 73, 18)} - {TermFont.Reset}",
+	" > ": f"{termcolor(156, 224, 220)}{TermFont.Bold} > {TermFont.Reset}",
+	" + ": f"{termcolor(156, 224, 20)}{TermFont.Bold} + {TermFont.Reset}",
+	" . ": f"{termcolor(156, 224, 20)}{TermFont.Bold} + {TermFont.Reset}",
+	" < ": f"{termcolor(160, 160, 160)} . {TermFont.Reset}",
+	" → ": f"{termcolor(156, 160, 224)}{TermFont.Bold} → {TermFont.Reset}",
+}
+
+
+def diffNDJSON(
+	out: TextIO,
+	sources: list[str],
+	rows: Iterable[tuple[int, str, list[Status]]],
+	origins: dict[str, str],
+) -> None:
+	"""Writes the diff rows as one JSON object per line, with the `origin`
+	of moved files."""
+	for i, p, status in rows:
+		out.write(
+			json.dumps(
+				{
+					"row": i,
+					"path": p,
+					"status": [_.value.strip() for _ in status],
+					"origin": origins.get(p),
+				}
+			)
+		)
+		out.write("\n")
+
 
-@command("PATH+", "-d|--diff*", "-t|--tool?", *(O_STANDARD + O_FILTERS))
+def diffTSV(
+	out: TextIO,
+	sources: list[str],
+	rows: Iterable[tuple[int, str, list[Status]]],
+	origins: dict[str, str],
+) -> None:
+	"""Writes the diff rows as tab-separated values, with a header line and
+	the `origin` of moved files last. Backslashes, tabs and newlines in
+	paths are escaped."""
+
+	def escape(p: str) -> str:
+		return p.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+	out.write("\t".join(("row", "path", *SOURCES[: len(sources)], "origin")))
+	out.write("\n")
+	for i, p, status in rows:
+		origin = escape(origins[p]) if p in origins else ""
+		out.write(
+			"\t".join((str(i), escape(p), *(_.value.strip() for _ in status), origin))
+		)
+		out.write("\n")
+
+
+# The machine-readable formats of `sink diff`, given the rows and the path
+# each moved file was moved from.
+DIFF_FORMATS: dict[
+	str,
+	Callable[
+		[TextIO, list[str], Iterable[tuple[int, str, list[Status]]], dict[str, str]],
+		None,
+	],
+] = {"ndjson": diffNDJSON, "tsv": diffTSV}
+
+
+@command(
+	"PATH+",
+	"-d|--diff*",
+	"-t|--tool?",
+	"-w|--width?",
+	"-M|--moves",
+	*(O_STANDARD + O_SNAPSHOT + O_COMPARE + O_STORE + O_BLOCKS + O_FILTERS),
+)
 def diff(
 	cli: CLI[None],
 	*,
@@ -239,8 +505,30 @@ def diff(
 	acceptSet: Optional[list[str]] = None,
 	keepSet: Optional[list[str]] = None,
 	filterSet: Optional[list[str]] = None,
+	jobs: int = 1,
+	walkers: int = 1,
+	hash: str = ALGORITHM,
+	noCache: bool = False,
+	rehash: bool = False,
+	compare: str = Strategy.SIGNATURE.value,
+	width: Optional[int] = None,
+	store: bool = False,
+	storeDir: Optional[str] = None,
+	blocks: bool = False,
+	blockSize: int = BLOCK_SIZE,
+	moves: bool = False,
 ) -> None:
-	"""Compares the different snapshots of file locations."""
+	"""Compares the different snapshots of file locations. Rows are aligned
+	on the longest path, unless a `--width` is given, in which case they
+	are written as soon as they are known, 0 making the width adaptive.
+	The `ndjson` and `tsv` formats are always streamed. With `--store`,
+	`PATH@GENERATION` (or `PATH@` for the latest) designates a stored
+	snapshot, and the latest stored snapshot of the first location is
+	compared to them when none is given. With `--moves`, files removed from
+	the first location and found with the same contents in another one are
+	marked as moved in both rows, which are then only written once all are
+	known."""
+	comparison = strategy(compare)
 	f = filters(
 		rejects=ignores,
 		accepts=accepts,
@@ -250,53 +538,14 @@ def diff(
 		keepSet=keepSet,
 		filterSet=filterSet,
 	)
-	snaps: list[Snapshot] = [
-		snapshot(
-			_,
-			accepts=f.accepts,
-			rejects=f.rejects,
-			keeps=f.keeps,
-		)
-		for _ in path
-	]
-	# This format the output like
-	#                              [A] ← src/py
-	#                               ┆  [B] ← ../xxxxxxx--main/src/py
-	#                               ⇣   ⇣
-	# 000 __main__.py                   <   >
-	# 001 xxxxxxxxx/__init__.py         <   >
-	# 002 xxxxxxxxx/service.py          <   >
-	# 003 xxxxxxxxx/tests/__init__.py   <   >
-	compared = _diff(*snaps)
+
 	with_diff: bool = diff is not None
 	diff_ranges = parseDiffRanges(diff)
 	sources = path
-	node_paths = [_ for _ in compared]
-	if not node_paths:
-		cli.out("No matching paths")
-	else:
-		node_path_length = max((len(_) for _ in node_paths))
-		COLOR_FORMAT = {
-			# NOTE: I've changed the presentation here, '.' becomes '+' and
-			# '<' becomes '.'. We may
-			" ! ": f"{termcolor(237, 73, 18)}{TermFont.Bold} ! {TermFont.Reset}",
-			" - ": f"{termcolor(237, 73, 18)} - {TermFont.Reset}",
-			" > ": f"{termcolor(156, 224, 220)}{TermFont.Bold} > {TermFont.Reset}",
-			" + ": f"{termcolor(156, 224, 20)}{TermFont.Bold} + {TermFont.Reset}",
-			" . ": f"{termcolor(156, 224, 20)}{TermFont.Bold} + {TermFont.Reset}",
-			" < ": f"{termcolor(160, 160, 160)} . {TermFont.Reset}",
-		}
-
-		# --
-		# Header formatting
-		for i, p in enumerate(sources):
-			cli.out("    ")
-			cli.out(
-				" ".join((" " * (node_path_length), " ┆ " * i, f"[{SOURCES[i]}] ← {p}"))
-			)
-			cli.out("\n")
-		# TODO: Restore that
-		# cli.out(" " * node_path_length, " ".join(f" ⇣ " for _ in range(len(sources))))
+	if format is not None and format not in DIFF_FORMATS:
+		raise ValueError(
+			f"Unsupported diff format '{format}', pick one of: {', '.join(DIFF_FORMATS)}"
+		)
 
 	# We defined convenience functions
 	def has_source(i: int) -> bool:
@@ -312,54 +561,201 @@ def diff(
 				return True
 		return False
 
-	# --
-	# List formatting
-	edit_rounds: int = 0
-	# We iterate on the nodes, skipping the ones that have no changes.
-	for i, p_nodes in enumerate(
-		[(p, nodes) for p, nodes in compared.items() if has_changes(nodes)]
+	# We number the rows with changes, keeping track of the number of
+	# rows and of the longest path along the way.
+	count: int = 0
+	longest: int = 0
+	modified: list[str] = []
+	# The path each moved file was moved from, known before the rows
+	origins: dict[str, str] = {}
+
+	def label(p: str) -> str:
+		return f"{p} ← {origins[p]}" if p in origins else p
+
+	def changed(
+		rows: Iterator[tuple[str, list[Status]]],
+	) -> Iterator[tuple[int, str, list[Status]]]:
+		nonlocal count, longest
+		i: int = 0
+		for p, status in rows:
+			# Pruned directories count as matching rows, so that identical
+			# trees are reported like they are without pruning.
+			count += 1
+			longest = max(longest, len(label(p)))
+			if has_changes(status):
+				modified.append(p)
+				if has_row(i):
+					yield i, p, status
+				i += 1
+
+	# Snapshots are streamed and merged as they are read, and rows are
+	# written as soon as they're known, except for the default table which
+	# aligns the paths on the longest one.
+	with (
+		signatures(not noCache, rehash=rehash) as cache,
+		generations(storeDir) if store else nullcontext(None) as history,
+		write(output) as out,
 	):
-		# We skip any row that is not in the -d sources, if provided.
-		if not has_row(i):
-			continue
-		# We print the row, filtering out the sources
-		p, nodes = p_nodes
-		print(
-			f"{i:03d}",
-			p.ljust(node_path_length),
-			" ".join(
-				COLOR_FORMAT.get(v := _.value, v) if has_source(j) else "   "
-				for j, _ in enumerate(nodes)
-			),
-		)
-		# --
-		# We have the -d option, so we're going to interactively review
-		# the diffs.
-		if with_diff:
-			paths = [
-				Path(sources[j]) / p
-				for j, _ in enumerate(nodes)
-				if j == 0 or has_source(i)
+		# With a store, `ROOT@GENERATION` designates a stored snapshot, and
+		# the latest one of the first location is compared by default.
+		refs: list[Optional[int]] = []
+		if history:
+			if not any("@" in _ for _ in path):
+				path = [f"{path[0]}@", *path]
+			refs = [history.reference(_) for _ in path]
+			sources = [
+				_ if ref is None else f"{_.rpartition('@')[0]}@{ref}"
+				for _, ref in zip(path, refs)
 			]
-			if edit_rounds > 0:
-				if (
-					# FIXME: Better prompt formatting
-					answer := (
-						cli.ask("- ↳ [E]dit ┄ [s]kip ┄ [q]uit → ").strip().lower()
-					)
-					or " "
-				) == "q":
-					break
-				elif answer[0] == "s":
-					continue
-				else:
-					pass
-			print("PATHS", paths)
-			difftool(*paths)
-			edit_rounds += 1
+		snaps: list[Snapshot]
+		# Adjacent generations are compared through the delta of the latest
+		if (
+			history
+			and len(refs) == 2
+			and refs[0] is not None
+			and refs[1] is not None
+			and history.parentOf(refs[1]) == refs[0]
+		):
+			snaps = list(history.delta(refs[1]))
+		else:
+			snaps = [
+				snapshot(
+					_,
+					accepts=f.accepts,
+					rejects=f.rejects,
+					keeps=f.keeps,
+					gitignore=f.gitignore,
+					jobs=jobs,
+					walkers=walkers,
+					cache=cache,
+					algorithm=hash,
+					signatures=comparison == Strategy.SIGNATURE,
+					stream=True,
+					store=history,
+					blocks=blockSize if blocks else None,
+				)
+				for _ in path
+			]
+		if not comparable(*snaps):
+			sys.stderr.write(
+				f"WRN Snapshots use different hash algorithms ({', '.join(_.algorithm for _ in snaps)}), comparing files by size and time\n"
+			)
+		# Binary snapshots and stored generations have their directory hashes
+		# upfront, which lets the diff skip the directories that are the same.
+		# JSON snapshots only have them after their nodes, and are streamed
+		# without pruning rather than read in memory.
+		# With block signatures on both sides, we tell how many bytes differ
+		def summary() -> None:
+			if len(snaps) != 2 or not all(_.blocks for _ in snaps):
+				return
+			a, b = snaps
+			if not (size := a.blockSize) or size != b.blockSize:
+				return
+			ranges = [
+				changedRanges(a.blocks[_], b.blocks[_], size)
+				for _ in modified
+				if a.blocks and b.blocks and _ in a.blocks and _ in b.blocks
+			]
+			sys.stderr.write(
+				f"INF {sum(l for r in ranges for _, l in r)} bytes in changed blocks across {len(ranges)} files\n"
+			)
 
+		rows = changed(
+			idiff(
+				*snaps,
+				strategy=comparison,
+				prune=True,
+				moved=moves,
+				origins=origins,
+			)
+		)
+		if format:
+			DIFF_FORMATS[format](out, sources, rows, origins)
+			summary()
+			return
+		elif width is None:
+			rows = iter(list(rows))
+		# This format the output like
+		#                              [A] ← src/py
+		#                               ┆  [B] ← ../xxxxxxx--main/src/py
+		#                               ⇣   ⇣
+		# 000 __main__.py                   <   >
+		# 001 xxxxxxxxx/__init__.py         <   >
+		# 002 xxxxxxxxx/service.py          <   >
+		# 003 xxxxxxxxx/tests/__init__.py   <   >
+		node_path_length: int = longest if width is None else (width or DIFF_WIDTH)
+		if width is None and not count:
+			out.write("No matching paths")
+		else:
+			# --
+			# Header formatting
+			for i, p in enumerate(sources):
+				out.write("    ")
+				out.write(
+					" ".join(
+						(" " * (node_path_length), " ┆ " * i, f"[{SOURCES[i]}] ← {p}")
+					)
+				)
+				out.write("\n")
+			# TODO: Restore that
+			# cli.out(" " * node_path_length, " ".join(f" ⇣ " for _ in range(len(sources))))
 
-@command("SRC", "PATH?", "-r|--root?", "-t|--type?", *(O_STANDARD + O_FILTERS))
+		# --
+		# List formatting
+		edit_rounds: int = 0
+		# We iterate on the nodes with changes
+		for i, p, nodes in rows:
+			# An adaptive width grows with the paths
+			if width == 0:
+				node_path_length = max(node_path_length, len(label(p)))
+			# We write the row, filtering out the sources
+			out.write(
+				f"{i:03d} {label(p).ljust(node_path_length)} "
+				+ " ".join(
+					DIFF_COLORS.get(v := _.value, v) if has_source(j) else "   "
+					for j, _ in enumerate(nodes)
+				)
+				+ "\n"
+			)
+			# --
+			# We have the -d option, so we're going to interactively review
+			# the diffs.
+			if with_diff:
+				out.flush()
+				paths = [
+					Path(sources[j]) / p
+					for j, _ in enumerate(nodes)
+					if j == 0 or has_source(i)
+				]
+				if edit_rounds > 0:
+					if (
+						# FIXME: Better prompt formatting
+						answer := (
+							cli.ask("- ↳ [E]dit ┄ [s]kip ┄ [q]uit → ").strip().lower()
+						)
+						or " "
+					) == "q":
+						break
+					elif answer[0] == "s":
+						continue
+					else:
+						pass
+				print("PATHS", paths)
+				difftool(*paths)
+				edit_rounds += 1
+		if width is not None and not count:
+			out.write("No matching paths")
+		summary()
+
+
+@command(
+	"SRC",
+	"PATH?",
+	"-r|--root?",
+	"-t|--type?",
+	"--no-moves",
+	*(O_STANDARD + O_SNAPSHOT + O_COMPARE + O_BLOCKS + O_FILTERS),
+)
 def backup(
 	cli: CLI[None],
 	*,
@@ -376,10 +772,32 @@ def backup(
 	acceptSet: Optional[list[str]] = None,
 	keepSet: Optional[list[str]] = None,
 	filterSet: Optional[list[str]] = None,
+	jobs: int = 1,
+	walkers: int = 1,
+	hash: str = ALGORITHM,
+	noCache: bool = False,
+	rehash: bool = False,
+	compare: str = Strategy.SIGNATURE.value,
+	blocks: bool = False,
+	blockSize: int = BLOCK_SIZE,
+	noMoves: bool = False,
 ) -> None:
-	"""Outputs commands that describe changes to make PATH_OR_SNAPSHOT like SRC_PATH."""
-	if type != "script":
-		raise ValueError(f"Unsupported backup type: {type}. Only 'script' is supported.")
+	"""Outputs commands that describe changes to make PATH_OR_SNAPSHOT like
+	SRC_PATH, or with `-t tar` a tar archive of them that embeds the changed
+	files, compressed as `-t tar.gz` or when the output ends with `.gz`,
+	`.xz` or `.bz2`. Scripts move the files found with the same contents at
+	another path, unless `--no-moves` is given, while archives always embed
+	them so that they can be extracted as they are."""
+	codec: Optional[str] = None
+	if type.startswith("tar"):
+		codec = type[3:] or codecOf(output)
+		if codec and codec not in COMPRESSORS:
+			raise ValueError(f"Unsupported archive compression: {codec}")
+	elif type != "script":
+		raise ValueError(
+			f"Unsupported backup type: {type}. Use 'script' or 'tar' (.gz, .xz, .bz2)."
+		)
+	comparison = strategy(compare)
 
 	active_filters = filters(
 		rejects=ignores,
@@ -391,30 +809,96 @@ def backup(
 		filterSet=filterSet,
 	)
 
-	# Create snapshot for SRC
-	current = snapshot(
-		src,
-		accepts=active_filters.accepts,
-		rejects=active_filters.rejects,
-		keeps=active_filters.keeps,
-	)
-
-	# Create snapshot for PATH if provided
-	other = None
-	if path:
-		other = snapshot(
-			path,
+	with signatures(not noCache, rehash=rehash) as cache:
+		# Create snapshot for SRC
+		current = snapshot(
+			src,
 			accepts=active_filters.accepts,
 			rejects=active_filters.rejects,
 			keeps=active_filters.keeps,
+			gitignore=active_filters.gitignore,
+			jobs=jobs,
+			walkers=walkers,
+			cache=cache,
+			algorithm=hash,
+			signatures=comparison == Strategy.SIGNATURE,
+			blocks=blockSize if blocks else None,
+		)
+
+		# Create snapshot for PATH if provided
+		other = None
+		if path:
+			other = snapshot(
+				path,
+				accepts=active_filters.accepts,
+				rejects=active_filters.rejects,
+				keeps=active_filters.keeps,
+				gitignore=active_filters.gitignore,
+				jobs=jobs,
+				walkers=walkers,
+				cache=cache,
+				algorithm=hash,
+				signatures=comparison == Strategy.SIGNATURE,
+				blocks=blockSize if blocks else None,
+			)
+
+	if type.startswith("tar"):
+		started = now()
+		with (
+			open(output, "wb")
+			if output and output != "-"
+			else nullcontext(sys.stdout.buffer)
+		) as b:
+			count, size = archive(
+				current, other, b, codec, comparison, jobs=max(jobs, 4)
+			)
+		elapsed = now() - started
+		sys.stderr.write(
+			f"INF Archived {count} members, {size} bytes in {elapsed:0.2f}s ({size / max(elapsed, 1e-6) / 1_000_000:0.1f}MB/s)\n"
 		)
+		return
 
 	# Use root path for relative paths, default to src
 	root_path = root if root else src
 
 	with write(output) as f:
-		for line in iscript(current, other, root_path):
+		for line in iscript(current, other, root_path, comparison, not noMoves):
 			f.write(f"{line}\n")
 
 
+@command(
+	"TARGET",
+	"SCRIPT?",
+	"-r|--root?",
+	"-S|--source?",
+	"-j|--jobs?",
+	"-n|--dry-run",
+	"--no-sync",
+)
+def patch(
+	cli: CLI[None],
+	*,
+	target: str,
+	script: Optional[str] = None,
+	root: Optional[str] = None,
+	source: Optional[str] = None,
+	jobs: int = 4,
+	dryRun: bool = False,
+	noSync: bool = False,
+) -> None:
+	"""Applies a script from `sink backup` to the TARGET location, like
+	`sink backup SRC TARGET | sink patch TARGET`. Paths of the script are
+	relative to its root, given by the script or `--root`, and data is read
+	from it or from `--source`. With `--dry-run`, operations are listed
+	rather than applied."""
+	with open(script, "rt") if script and script != "-" else nullcontext(sys.stdin) as f:
+		changes = parse(f, root)
+	patcher = Patcher(target, source, jobs=jobs, dryRun=dryRun, sync=not noSync)
+	patcher.apply(changes, sys.stdout if dryRun else None)
+	elapsed = max(patcher.elapsed, 1e-6)
+	sys.stderr.write(
+		f"INF {'Checked' if dryRun else 'Applied'} {patcher.ops} operations, {patcher.bytes} bytes in {patcher.elapsed:0.2f}s ({patcher.ops / elapsed:0.0f} ops/s, {patcher.bytes / elapsed / 1_000_000:0.1f}MB/s)\n"
+	)
+
+
 # EOF
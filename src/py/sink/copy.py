@@ -0,0 +1,142 @@
+from typing import Callable, Optional
+import errno
+import os
+from .logging import metric
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None  # type: ignore[assignment]
+
+# --
+# ## Copy
+#
+# Copies file data without pulling it through Python when the platform
+# allows it. Whole files are first cloned with the `FICLONE` ioctl, which
+# shares their extents on copy-on-write filesystems (btrfs, XFS) and takes
+# no extra space. Otherwise, and for ranges, data is copied in the kernel
+# with `copy_file_range`, then `sendfile`, and finally with a buffered
+# `pread`/`pwrite` loop. A method that is not supported for a pair of files
+# falls back to the next one, and methods the system lacks are not tried
+# again.
+
+# The `FICLONE` ioctl, as `_IOW(0x94, 9, int)`
+FICLONE: int = 0x40049409
+# The most bytes copied by a single call
+CHUNK: int = 1 << 30
+# The size of the buffer of the last resort copy
+BUFFER: int = 1024 * 1024
+
+# The errors that tell a method is not supported for the given files
+FALLBACK: frozenset[int] = frozenset(
+	(
+		errno.ENOSYS,
+		errno.EXDEV,
+		errno.EINVAL,
+		errno.EOPNOTSUPP,
+		errno.ENOTTY,
+		errno.EBADF,
+	)
+)
+
+# A method copies up to `count` bytes from `src` to `dst` at `position`,
+# returning how many were copied, which is 0 at the end of the file.
+TMethod = Callable[[int, int, int, int], int]
+
+
+def copyRange(src: int, dst: int, position: int, count: int) -> int:
+	return os.copy_file_range(src, dst, count, position, position)
+
+
+def sendFile(src: int, dst: int, position: int, count: int) -> int:
+	os.lseek(dst, position, os.SEEK_SET)
+	return os.sendfile(dst, src, position, count)
+
+
+def readWrite(src: int, dst: int, position: int, count: int) -> int:
+	data = os.pread(src, min(count, BUFFER), position)
+	return os.pwrite(dst, data, position) if data else 0
+
+
+# The methods, by name, in the order they're tried
+METHODS: dict[str, TMethod] = {
+	"range": copyRange,
+	"sendfile": sendFile,
+	"buffer": readWrite,
+}
+# The methods the system lacks
+UNSUPPORTED: set[str] = {
+	name
+	for name, function in (("range", "copy_file_range"), ("sendfile", "sendfile"))
+	if not hasattr(os, function)
+}
+
+
+def clone(src: int, dst: int) -> bool:
+	"""Tries to make `dst` share the data of `src`, returning `True` on
+	success."""
+	if fcntl is None:
+		return False
+	try:
+		fcntl.ioctl(dst, FICLONE, src)
+		metric("copy.clone").inc()
+		return True
+	except OSError as e:
+		if e.errno not in FALLBACK:
+			raise
+		return False
+
+
+def transfer(
+	src: int, dst: int, offset: int = 0, length: Optional[int] = None
+) -> int:
+	"""Copies `length` bytes from `src` to `dst` at `offset`, or up to the
+	end of `src` when `length` is `None`, returning the number of bytes
+	copied."""
+	copied: int = 0
+	methods = [(k, v) for k, v in METHODS.items() if k not in UNSUPPORTED]
+	while methods:
+		name, method = methods[0]
+		try:
+			while length is None or copied < length:
+				count = CHUNK if length is None else min(CHUNK, length - copied)
+				if not (n := method(src, dst, offset + copied, count)):
+					break
+				copied += n
+				metric(f"copy.{name}").add(n)
+			return copied
+		except OSError as e:
+			if e.errno not in FALLBACK or len(methods) == 1:
+				raise
+			if e.errno == errno.ENOSYS:
+				UNSUPPORTED.add(name)
+			methods.pop(0)
+	return copied
+
+
+def copyFile(
+	source: str,
+	target: str,
+	offset: Optional[int] = None,
+	length: Optional[int] = None,
+) -> int:
+	"""Copies the data of `source` to `target`, the whole file or the given
+	range, returning the number of bytes copied. Whole files replace the
+	contents of `target`, while ranges are written in place."""
+	src = os.open(source, os.O_RDONLY)
+	try:
+		if offset is None:
+			dst = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+		else:
+			dst = os.open(target, os.O_WRONLY | os.O_CREAT, 0o644)
+		try:
+			if offset is None and clone(src, dst):
+				return os.fstat(src).st_size
+			return transfer(src, dst, offset or 0, length)
+		finally:
+			os.close(dst)
+	finally:
+		os.close(src)
+
+
+# EOF
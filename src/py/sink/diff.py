@@ -1,10 +1,37 @@
-from .model import Node, Snapshot, Status
-from typing import Optional
+from .model import Node, NodeType, Snapshot, Status
+from .snap import FileSystem
+from .logging import metric
+from typing import Callable, Generator, Iterable, Iterator, Optional, Sequence, cast
+from enum import Enum
+import heapq
 
 # --
 # ## Directory diffing command
 
 
+class Strategy(Enum):
+	"""Defines how file contents are compared. Apart from `SIGNATURE`, files
+	are not hashed up front, and a size mismatch means a change. Files of the
+	same size are then hashed on demand: always for `SIZE`, only when their
+	modification time differs for `QUICK`, and never for `TIME`, which
+	compares the modification times instead."""
+
+	SIGNATURE = "signature"
+	QUICK = "quick"
+	SIZE = "size"
+	TIME = "time"
+
+
+def strategy(name: str) -> Strategy:
+	"""Returns the strategy with the given name"""
+	for _ in Strategy:
+		if _.value == name:
+			return _
+	raise ValueError(
+		f"Unsupported comparison strategy '{name}', pick one of: {', '.join(_.value for _ in Strategy)}"
+	)
+
+
 def compareNodes(a: Optional[Node], b: Optional[Node]) -> int:
 	return 0
 
@@ -17,8 +44,108 @@ def compareMeta(a: Optional[Node], b: Optional[Node]) -> int:
 	return 0
 
 
-def status(origin: Optional[Node], *others: Optional[Node]) -> list[Status]:
-	"""Maps the status of a node, with respect to the other nodes"""
+def ambiguous(a: Node, b: Node, strategy: Strategy) -> bool:
+	"""Tells if the contents of `a` and `b` can only be compared by their
+	signatures, given the `strategy`."""
+	if a.type != NodeType.FILE or b.type != NodeType.FILE or not a.meta or not b.meta:
+		return False
+	elif a.meta.size != b.meta.size:
+		return False
+	elif strategy == Strategy.QUICK:
+		return a.meta.mtime != b.meta.mtime
+	else:
+		return strategy != Strategy.TIME
+
+
+def resolve(
+	row: Sequence[Optional[Node]],
+	snapshots: Sequence[Snapshot],
+	strategy: Strategy = Strategy.QUICK,
+) -> None:
+	"""Computes the missing signatures of the nodes in `row` (one per
+	snapshot) that can't be compared with the origin otherwise. Signatures
+	can only be computed for snapshots that have a `root`."""
+	origin = row[0]
+	if not origin or strategy == Strategy.SIGNATURE:
+		return
+	hashed = metric("diff.hashed")
+	for i, other in enumerate(row):
+		if not other or i == 0:
+			continue
+		elif (origin.sig is None or other.sig is None) and ambiguous(
+			origin, other, strategy
+		):
+			for j, node in ((0, origin), (i, other)):
+				if node.sig is None and (root := snapshots[j].root):
+					node.sig = FileSystem.signature(
+						f"{root}/{node.path}", snapshots[j].algorithm
+					)
+					hashed.inc()
+
+
+def signed(node: Node, snapshot: Snapshot) -> Optional[str]:
+	"""Returns the signature of the node, computed from the root of the
+	`snapshot` when it is missing and the file is still there."""
+	if node.sig is None and (root := snapshot.root):
+		try:
+			node.sig = FileSystem.signature(
+				f"{root}/{node.path}", snapshot.algorithm
+			)
+			metric("diff.hashed").inc()
+		except FileNotFoundError:
+			pass
+	return node.sig
+
+
+def moves(
+	removed: Iterable[Node], added: Iterable[Node], snapshots: Sequence[Snapshot]
+) -> dict[str, str]:
+	"""Pairs the `removed` files of the first of the `snapshots` with the
+	`added` files of the second one that have the same contents, returning
+	the path each added file was moved from. Files are indexed by size
+	first, so that signatures are only compared, and computed when missing,
+	for files of the same size. Files with the same name are paired first,
+	and empty files are never paired."""
+	res: dict[str, str] = {}
+	if not comparable(*snapshots):
+		return res
+	sizes: dict[Optional[int], list[Node]] = {}
+	for node in removed:
+		size = node.meta.size if node.meta else None
+		if node.type == NodeType.FILE and size != 0:
+			sizes.setdefault(size, []).append(node)
+	# The removed files by size and signature, once their size is seen
+	index: dict[tuple[Optional[int], str], list[Node]] = {}
+	indexed: set[Optional[int]] = set()
+	for node in added:
+		if node.type != NodeType.FILE:
+			continue
+		size = node.meta.size if node.meta else None
+		if not (candidates := sizes.get(size)):
+			continue
+		if size not in indexed:
+			indexed.add(size)
+			for _ in candidates:
+				if (sig := signed(_, snapshots[0])) is not None:
+					index.setdefault((size, sig), []).append(_)
+		if (sig := signed(node, snapshots[1])) is None or not (
+			matches := index.get((size, sig))
+		):
+			continue
+		name = node.path.rsplit("/", 1)[-1]
+		match = next(
+			(_ for _ in matches if _.path.rsplit("/", 1)[-1] == name), matches[0]
+		)
+		matches.remove(match)
+		res[node.path] = match.path
+	return res
+
+
+def status(
+	origin: Optional[Node], *others: Optional[Node], signatures: bool = True
+) -> list[Status]:
+	"""Maps the status of a node, with respect to the other nodes. When
+	`signatures` is false, contents are compared by size and time."""
 	res = []
 	added_count = 0
 	removed_count = 0
@@ -41,7 +168,7 @@ def status(origin: Optional[Node], *others: Optional[Node]) -> list[Status]:
 			res.append(Status.ADDED)
 			added_count += 1
 		# TODO: We should distinguish between type, content and meta changes
-		elif other.hasChanged(origin):
+		elif other.hasChanged(origin, signatures=signatures):
 			if other.isNewer(origin):
 				res.append(Status.NEWER)
 				changed_count += 1
@@ -50,7 +177,7 @@ def status(origin: Optional[Node], *others: Optional[Node]) -> list[Status]:
 				res.append(Status.OLDER)
 				older_count += 1
 				changed_count += 1
-			elif other.hasContentChanged(origin):
+			elif other.hasContentChanged(origin, signatures):
 				res.append(Status.CHANGED)
 				changed_count += 1
 			elif other.hasTypeChanged(origin):
@@ -81,23 +208,164 @@ def status(origin: Optional[Node], *others: Optional[Node]) -> list[Status]:
 	return res
 
 
-# TODO: Should do sha vs time
-def diff(*snapshots: Snapshot) -> dict[str, list[Status]]:
-	"""Compares the list of snapshots, returning a list of status per snapshot"""
-	states: dict[str, list[Optional[Node]]] = {}
-	n: int = len(snapshots)
-	# This fills in states as a sparse matrix of nodes (rows) by
-	# snapshots.
-	for i, s in enumerate(snapshots):
-		# For each node of the snapshot
-		for node in s.nodes.values():
-			# We create a row if it's not there
-			if node.path not in states:
-				states[node.path] = [None] * n
-			# And we assign the node
-			states[node.path][i] = node
-	# FIXME: The sort here may be an issue performance-wise
-	return {path: status(*sources) for path, sources in sorted(states.items())}
+def comparable(*snapshots: Snapshot) -> bool:
+	"""Tells if the signatures of the given snapshots can be compared, which
+	requires them to use the same hash algorithm."""
+	return len({_.algorithm for _ in snapshots}) <= 1
+
+
+def merge(
+	*sources: Iterable[Node],
+	prune: Optional[Callable[[str], Optional[str]]] = None,
+) -> Iterator[tuple[str, list[Optional[Node]]]]:
+	"""Merges the given sources of nodes, which must be sorted by path,
+	yielding each path along with its row of nodes, one per source and
+	`None` when the source has no node for the path. The `prune` function
+	is given each path and may return one of its directories, whose nodes
+	are then skipped, in which case the directory is yielded with an empty
+	row. Pruning requires the sources to be generators like `Snapshot.sorted`,
+	as the directory is sent to them."""
+	n: int = len(sources)
+	iterators = [iter(_) for _ in sources]
+	heap: list[tuple[str, int, Node]] = [
+		(node.path, i, node)
+		for i, it in enumerate(iterators)
+		if (node := next(it, None)) is not None
+	]
+	heapq.heapify(heap)
+	while heap:
+		path = heap[0][0]
+		if prune and (skipped := prune(path)) is not None:
+			# All the nodes in the directory come first, as it contains the
+			# path at the top of the heap.
+			prefix = f"{skipped}/"
+			while heap and heap[0][0].startswith(prefix):
+				i = heap[0][1]
+				try:
+					following = cast(Generator[Node, str, None], iterators[i]).send(
+						skipped
+					)
+					heapq.heapreplace(heap, (following.path, i, following))
+				except StopIteration:
+					heapq.heappop(heap)
+			yield prefix, [None] * n
+			continue
+		row: list[Optional[Node]] = [None] * n
+		while heap and heap[0][0] == path:
+			_, i, node = heap[0]
+			row[i] = node
+			if (following := next(iterators[i], None)) is not None:
+				heapq.heapreplace(heap, (following.path, i, following))
+			else:
+				heapq.heappop(heap)
+		yield path, row
+
+
+def idiff(
+	*snapshots: Snapshot,
+	strict: bool = False,
+	strategy: Strategy = Strategy.SIGNATURE,
+	prune: bool = False,
+	moved: bool = False,
+	origins: Optional[dict[str, str]] = None,
+) -> Iterator[tuple[str, list[Status]]]:
+	"""Like `diff`, but yields the status of each path as soon as it is
+	known, in path order. Snapshots are merged as they are read, so
+	sorted streamed snapshots are never held in memory, unless `moved` is
+	set: files removed from the origin and added to another snapshot with
+	the same contents are then paired (see `moves`), and marked as `MOVED`
+	in both rows once all the rows are known. The path each file was moved
+	from is then added to `origins` when given, before the rows are
+	yielded.
+
+	When `prune` is set and the directory hashes of all the snapshots are
+	known, the directories with the same hash in all snapshots are skipped,
+	and yielded instead as their path with a trailing `/`, and an unchanged
+	status."""
+	signatures: bool = comparable(*snapshots)
+	if strict and not signatures:
+		raise ValueError(
+			f"Snapshots use different hash algorithms: {', '.join(sorted({_.algorithm for _ in snapshots}))}"
+		)
+	dirs = [_.dirs for _ in snapshots]
+	same: set[str] = (
+		{
+			path
+			for path, h in (dirs[0] or {}).items()
+			if path and all(cast(dict[str, str], _).get(path) == h for _ in dirs[1:])
+		}
+		if prune and signatures and all(_ is not None for _ in dirs)
+		else set()
+	)
+
+	def pruned(path: str) -> Optional[str]:
+		"""Returns the topmost directory of `path` that is the same in all
+		the snapshots, if any."""
+		i = path.find("/")
+		while i != -1:
+			if (parent := path[:i]) in same:
+				return parent
+			i = path.find("/", i + 1)
+		return None
+
+	unchanged: list[Status] = (
+		[Status.ORIGIN] + [Status.SAME] * (len(snapshots) - 1) if snapshots else []
+	)
+	rows: list[tuple[str, list[Optional[Node]], list[Status]]] = []
+	for path, row in merge(
+		*(_.sorted() for _ in snapshots), prune=pruned if same else None
+	):
+		if not any(row):
+			# Each row gets its own list, as moves update them in place
+			res = list(unchanged)
+		else:
+			resolve(row, snapshots, strategy)
+			res = status(*row, signatures=signatures)
+		if moved:
+			# Only the nodes that may have moved are kept
+			rows.append(
+				(path, row if Status.ADDED in res or Status.REMOVED in res else [], res)
+			)
+		else:
+			yield path, res
+	if moved:
+		for j in range(1, len(snapshots)):
+			added: dict[str, str] = moves(
+				(
+					cast(Node, row[0])
+					for _, row, res in rows
+					if res[j] == Status.REMOVED
+				),
+				(
+					cast(Node, row[j])
+					for _, row, res in rows
+					if res[j] == Status.ADDED
+				),
+				(snapshots[0], snapshots[j]),
+			)
+			paths = set(added) | set(added.values())
+			if origins is not None:
+				for path, origin in added.items():
+					origins.setdefault(path, origin)
+			for path, _, res in rows:
+				if path in paths:
+					res[j] = Status.MOVED
+		for path, _, res in rows:
+			yield path, res
+
+
+def diff(
+	*snapshots: Snapshot,
+	strict: bool = False,
+	strategy: Strategy = Strategy.SIGNATURE,
+	moved: bool = False,
+) -> dict[str, list[Status]]:
+	"""Compares the list of snapshots, returning a list of status per snapshot.
+	Snapshots using different hash algorithms are compared by size and time,
+	unless `strict` is set, in which case a `ValueError` is raised. Missing
+	signatures are computed on demand following the `strategy`, and moved
+	files are detected when `moved` is set."""
+	return dict(idiff(*snapshots, strict=strict, strategy=strategy, moved=moved))
 
 
 # EOF
@@ -0,0 +1,674 @@
+from typing import (
+	IO,
+	Any,
+	BinaryIO,
+	Callable,
+	Generator,
+	Iterable,
+	Iterator,
+	Optional,
+	TextIO,
+)
+from contextlib import nullcontext
+from queue import Queue
+import bz2
+import gzip
+import io
+import json
+import lzma
+import shutil
+import tempfile
+import threading
+import math
+import mmap
+import struct
+import sys
+from .model import Node, NodeMeta, Snapshot
+from .hashing import ALGORITHM
+
+# --
+# ## Snapshot formats
+#
+# Snapshots are read and written as streams of nodes, so that neither the
+# whole file nor the whole snapshot needs to be in memory at once.
+
+# --
+# ### JSON
+#
+# JSON snapshots are like `{"algorithm": …, "nodes": {PATH: NODE, …}}`. The
+# reader decodes one value at a time from a bounded buffer, and yields the
+# nodes as they are decoded. Other keys are gathered in the `header`.
+
+
+class JSONReader:
+	"""Incrementally reads a JSON snapshot from a text stream."""
+
+	CHUNK: int = 64 * 1024
+
+	def __init__(self, stream: TextIO):
+		self.stream: TextIO = stream
+		self.buffer: str = ""
+		self.offset: int = 0
+		self.eof: bool = False
+		self.decoder = json.JSONDecoder()
+		# The top-level keys other than `nodes`, which are all known once
+		# `start` has returned when they are written before the nodes.
+		self.header: dict[str, Any] = {}
+		self.started: bool = False
+		self.inNodes: bool = False
+
+	def fill(self) -> bool:
+		"""Reads the next chunk, discarding the consumed part of the buffer."""
+		if self.eof:
+			return False
+		chunk = self.stream.read(self.CHUNK)
+		if not chunk:
+			self.eof = True
+			return False
+		self.buffer = self.buffer[self.offset :] + chunk
+		self.offset = 0
+		return True
+
+	def peek(self) -> str:
+		"""Returns the next non-whitespace character, or an empty string at
+		the end of the stream."""
+		while True:
+			buffer, offset = self.buffer, self.offset
+			while offset < len(buffer) and buffer[offset] in " \t\n\r":
+				offset += 1
+			self.offset = offset
+			if offset < len(buffer) or not self.fill():
+				return buffer[offset] if offset < len(buffer) else ""
+
+	def expect(self, *chars: str) -> str:
+		if (c := self.peek()) not in chars:
+			raise ValueError(f"Malformed JSON snapshot, expected {chars}, got {c!r}")
+		self.offset += 1
+		return c
+
+	def value(self) -> Any:
+		"""Decodes the next JSON value"""
+		self.peek()
+		while True:
+			try:
+				value, end = self.decoder.raw_decode(self.buffer, self.offset)
+				# A value at the very end of the buffer might be truncated,
+				# like a number.
+				if end < len(self.buffer) or self.eof:
+					self.offset = end
+					return value
+			except json.JSONDecodeError as e:
+				if self.eof:
+					raise e
+			self.fill()
+
+	def start(self) -> "JSONReader":
+		"""Reads the header up to the beginning of the nodes."""
+		if not self.started:
+			self.started = True
+			self.expect("{")
+			self.inNodes = self.keys()
+		return self
+
+	def keys(self) -> bool:
+		"""Reads the top-level keys up to `nodes`, returning `True` if the
+		nodes follow."""
+		while (c := self.peek()) != "}":
+			if c == ",":
+				self.offset += 1
+			key = self.value()
+			self.expect(":")
+			if key == "nodes" and self.peek() == "{":
+				self.offset += 1
+				return True
+			else:
+				self.header[key] = self.value()
+		self.offset += 1
+		return False
+
+	def __iter__(self) -> Iterator[Node]:
+		self.start()
+		while self.inNodes:
+			while (c := self.peek()) != "}":
+				if c == ",":
+					self.offset += 1
+				self.value()
+				self.expect(":")
+				yield Node.FromPrimitive(self.value())
+			self.offset += 1
+			# There may be header values after the nodes
+			self.inNodes = self.keys()
+
+
+def writeJSON(
+	stream: TextIO,
+	nodes: Iterable[Node],
+	footer: Optional[Callable[[], dict[str, Any]]] = None,
+	**header: Any,
+) -> int:
+	"""Writes the given `nodes` as a JSON snapshot, one node at a time, with
+	the `header` values first, and the values returned by `footer` last, as
+	they may only be known once the nodes are written, unless they are in
+	the header already. Returns the number of nodes written."""
+	count: int = 0
+	stream.write("{")
+	for k, v in header.items():
+		stream.write(f"{json.dumps(k)}: {json.dumps(v)}, ")
+	stream.write('"nodes": {')
+	for node in nodes:
+		if count:
+			stream.write(", ")
+		stream.write(json.dumps(node.path))
+		stream.write(": ")
+		stream.write(json.dumps(node.toPrimitive()))
+		count += 1
+	stream.write("}")
+	for k, v in (footer() if footer else {}).items():
+		if k not in header:
+			stream.write(f", {json.dumps(k)}: {json.dumps(v)}")
+	stream.write("}")
+	return count
+
+
+# --
+# ### Binary
+#
+# Binary snapshots (`.snap`) are made of a header, a sequence of node
+# records, and tables referenced by the records, followed by the offset of
+# the tables. Paths are split into components stored once in a string
+# table, and each record only lists the components that differ from the
+# previous path. The `(mode, uid, gid)` triples are stored once in a table,
+# integers are varints, times are integer nanoseconds, and signatures are
+# stored as raw digest bytes. The tables come last so that the records can
+# be written as nodes are produced.
+#
+# ```
+# MAGIC VERSION LEN(HEADER) HEADER(JSON)
+# RECORD*
+# TABLES: COUNT(STRINGS) (LEN BYTES)* COUNT(METAS) (MODE UID GID)* COUNT(NODES)
+# COUNT(SUBTREES) (START DEPTH LENGTH)*
+# LEN(FOOTER) FOOTER(JSON)
+# OFFSET(TABLES):u64 MAGIC
+# ```
+#
+# The footer holds the header values only known once the nodes are written,
+# and is merged into the header when reading. Version 1 has no footer, and
+# versions before 3 have no subtrees.
+#
+# A record is `TYPE FLAGS SHARED ADDED COMPONENT*` followed by `META SIZE
+# CTIME MTIME` when it has meta, and `LEN SIG` when it has a signature.
+#
+# Subtrees locate the records of each directory, which are contiguous as
+# nodes are written in path order: the directory at `DEPTH` in the path of
+# the record at offset `START` (relative to the previous subtree) has its
+# first record there, and its records span `LENGTH` bytes. A reader can
+# then seek past a directory, like when pruning a diff.
+
+BINARY_MAGIC: bytes = b"SINKSNAP"
+BINARY_VERSION: int = 3
+BINARY_TRAILER = struct.Struct("<Q8s")
+FLAG_META: int = 0b001
+FLAG_SIG: int = 0b010
+# The signature is not hexadecimal, and is stored as text
+FLAG_SIG_TEXT: int = 0b100
+
+
+def varint(value: int) -> bytes:
+	"""Encodes a positive integer as a LEB128 varint"""
+	res = bytearray()
+	while value > 0x7F:
+		res.append((value & 0x7F) | 0x80)
+		value >>= 7
+	res.append(value)
+	return bytes(res)
+
+
+def zigzag(value: int) -> int:
+	"""Maps signed integers to positive integers, for varints"""
+	return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+
+def unzigzag(value: int) -> int:
+	return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+
+def nanoseconds(value: float) -> int:
+	"""Converts a time in seconds to nanoseconds, splitting the integer part
+	so that the conversion is exact, and back and forth conversions
+	preserve the value."""
+	seconds = math.floor(value)
+	return seconds * 1_000_000_000 + round((value - seconds) * 1_000_000_000)
+
+
+class BinaryWriter:
+	"""Writes a binary snapshot to a binary stream, one node at a time."""
+
+	def __init__(self, stream: BinaryIO, **header: Any):
+		self.stream: BinaryIO = stream
+		self.strings: dict[str, int] = {}
+		self.metas: dict[tuple[int, int, int], int] = {}
+		self.previous: list[str] = []
+		self.count: int = 0
+		# The start offsets of the directories of the previous path, and the
+		# `(start, depth, end)` of the directories that were closed.
+		self.opened: list[int] = []
+		self.subtrees: list[tuple[int, int, int]] = []
+		self.header: dict[str, Any] = header
+		data = json.dumps(header).encode("utf8")
+		self.offset: int = 0
+		self.write(BINARY_MAGIC + bytes((BINARY_VERSION,)) + varint(len(data)) + data)
+
+	def write(self, data: bytes) -> None:
+		self.stream.write(data)
+		self.offset += len(data)
+
+	def string(self, value: str) -> int:
+		if (i := self.strings.get(value)) is None:
+			i = self.strings[value] = len(self.strings)
+		return i
+
+	def add(self, node: Node) -> None:
+		components = node.path.split("/")
+		previous = self.previous
+		shared = 0
+		limit = min(len(components), len(previous))
+		while shared < limit and components[shared] == previous[shared]:
+			shared += 1
+		# The directories that don't contain the path end here, and the ones
+		# that contain it start here when they're not open yet.
+		opened = self.opened
+		depth = min(shared, len(components) - 1)
+		while len(opened) > depth:
+			self.subtrees.append((opened[-1], len(opened) - 1, self.offset))
+			opened.pop()
+		while len(opened) < len(components) - 1:
+			opened.append(self.offset)
+		sig = node.sig
+		sig_bytes: Optional[bytes] = None
+		flags = (FLAG_META if node.meta else 0) | (FLAG_SIG if sig is not None else 0)
+		if sig is not None:
+			try:
+				sig_bytes = bytes.fromhex(sig)
+				if sig_bytes.hex() != sig:
+					raise ValueError
+			except ValueError:
+				sig_bytes = sig.encode("utf8")
+				flags |= FLAG_SIG_TEXT
+		record = bytearray(varint(node.type))
+		record += varint(flags)
+		record += varint(shared)
+		record += varint(len(components) - shared)
+		for c in components[shared:]:
+			record += varint(self.string(c))
+		if meta := node.meta:
+			key = (meta.mode, meta.uid, meta.gid)
+			if (m := self.metas.get(key)) is None:
+				m = self.metas[key] = len(self.metas)
+			record += varint(m)
+			record += varint(meta.size)
+			record += varint(zigzag(nanoseconds(meta.ctime)))
+			record += varint(zigzag(nanoseconds(meta.mtime)))
+		if sig_bytes is not None:
+			record += varint(len(sig_bytes))
+			record += sig_bytes
+		self.write(bytes(record))
+		self.previous = components
+		self.count += 1
+
+	def close(self, footer: Optional[dict[str, Any]] = None) -> None:
+		"""Writes the tables, the `footer` values that are not in the header
+		and the trailer"""
+		tables = self.offset
+		while self.opened:
+			self.subtrees.append((self.opened[-1], len(self.opened) - 1, tables))
+			self.opened.pop()
+		res = bytearray(varint(len(self.strings)))
+		for s in self.strings:
+			data = s.encode("utf8")
+			res += varint(len(data))
+			res += data
+		res += varint(len(self.metas))
+		for mode, uid, gid in self.metas:
+			res += varint(mode) + varint(uid) + varint(gid)
+		res += varint(self.count)
+		res += varint(len(self.subtrees))
+		start = 0
+		for offset, depth, end in sorted(self.subtrees):
+			res += varint(offset - start) + varint(depth) + varint(end - offset)
+			start = offset
+		data = json.dumps(
+			{k: v for k, v in (footer or {}).items() if k not in self.header}
+		).encode("utf8")
+		res += varint(len(data))
+		res += data
+		self.write(bytes(res))
+		self.write(BINARY_TRAILER.pack(tables, BINARY_MAGIC))
+
+
+def writeBinary(
+	stream: BinaryIO,
+	nodes: Iterable[Node],
+	footer: Optional[Callable[[], dict[str, Any]]] = None,
+	**header: Any,
+) -> int:
+	"""Writes the given `nodes` as a binary snapshot, one node at a time,
+	like `writeJSON`. Returns the number of nodes written."""
+	writer = BinaryWriter(stream, **header)
+	for node in nodes:
+		writer.add(node)
+	writer.close(footer() if footer else None)
+	return writer.count
+
+
+class BinaryReader:
+	"""Reads a binary snapshot from a buffer, typically a memory-mapped
+	file. Only the header and the tables are decoded upfront, the nodes
+	are decoded as they are iterated on. Sending a directory path to the
+	iterator seeks past the nodes it contains."""
+
+	def __init__(self, data: mmap.mmap | bytes):
+		self.data = data
+		size = len(data)
+		if (
+			size < len(BINARY_MAGIC) + 1 + BINARY_TRAILER.size
+			or data[: len(BINARY_MAGIC)] != BINARY_MAGIC
+		):
+			raise ValueError("Not a binary snapshot")
+		if (version := data[len(BINARY_MAGIC)]) not in (1, 2, BINARY_VERSION):
+			raise ValueError(f"Unsupported binary snapshot version: {version}")
+		tables, magic = BINARY_TRAILER.unpack(data[size - BINARY_TRAILER.size :])
+		if magic != BINARY_MAGIC:
+			raise ValueError("Truncated binary snapshot")
+		length, offset = self.varint(len(BINARY_MAGIC) + 1)
+		self.header: dict[str, Any] = json.loads(
+			bytes(data[offset : offset + length]).decode("utf8")
+		)
+		self.start: int = offset + length
+		self.end: int = tables
+		# We decode the tables
+		count, offset = self.varint(tables)
+		self.strings: list[str] = []
+		for _ in range(count):
+			length, offset = self.varint(offset)
+			self.strings.append(bytes(data[offset : offset + length]).decode("utf8"))
+			offset += length
+		count, offset = self.varint(offset)
+		self.metas: list[tuple[int, int, int]] = []
+		for _ in range(count):
+			mode, offset = self.varint(offset)
+			uid, offset = self.varint(offset)
+			gid, offset = self.varint(offset)
+			self.metas.append((mode, uid, gid))
+		self.count, offset = self.varint(offset)
+		# The end offset of the records of each directory, by the offset of
+		# its first record and its depth.
+		self.subtrees: dict[tuple[int, int], int] = {}
+		if version > 2:
+			count, offset = self.varint(offset)
+			start = 0
+			for _ in range(count):
+				delta, offset = self.varint(offset)
+				depth, offset = self.varint(offset)
+				length, offset = self.varint(offset)
+				start += delta
+				self.subtrees[(start, depth)] = start + length
+		if version > 1:
+			length, offset = self.varint(offset)
+			self.header.update(
+				json.loads(bytes(data[offset : offset + length]).decode("utf8"))
+			)
+
+	def varint(self, offset: int) -> tuple[int, int]:
+		"""Decodes the varint at `offset`, returning its value and the offset
+		right after."""
+		data = self.data
+		value = 0
+		shift = 0
+		while True:
+			b = data[offset]
+			offset += 1
+			value |= (b & 0x7F) << shift
+			if b < 0x80:
+				return value, offset
+			shift += 7
+
+	def __len__(self) -> int:
+		return self.count
+
+	def __iter__(self) -> Generator[Node, Optional[str], None]:
+		data, strings, metas, varint = self.data, self.strings, self.metas, self.varint
+		subtrees = self.subtrees
+		offset = self.start
+		components: list[str] = []
+		# The end offsets of the directories of the current path, when known
+		ends: list[Optional[int]] = []
+		while offset < self.end:
+			start = offset
+			node_type, offset = varint(offset)
+			flags, offset = varint(offset)
+			shared, offset = varint(offset)
+			added, offset = varint(offset)
+			del components[shared:]
+			for _ in range(added):
+				i, offset = varint(offset)
+				components.append(strings[i])
+			del ends[min(shared, len(components) - 1) :]
+			while len(ends) < len(components) - 1:
+				ends.append(subtrees.get((start, len(ends))))
+			meta: Optional[NodeMeta] = None
+			sig: Optional[str] = None
+			if flags & FLAG_META:
+				m, offset = varint(offset)
+				size, offset = varint(offset)
+				ctime, offset = varint(offset)
+				mtime, offset = varint(offset)
+				mode, uid, gid = metas[m]
+				meta = NodeMeta(
+					mode=mode,
+					uid=uid,
+					gid=gid,
+					size=size,
+					ctime=unzigzag(ctime) / 1_000_000_000,
+					mtime=unzigzag(mtime) / 1_000_000_000,
+				)
+			if flags & FLAG_SIG:
+				length, offset = varint(offset)
+				raw = bytes(data[offset : offset + length])
+				offset += length
+				sig = raw.decode("utf8") if flags & FLAG_SIG_TEXT else raw.hex()
+			skip = yield Node("/".join(components), node_type, meta, sig)
+			# The directory contains the path, and the next record shares at
+			# most its parent's components, which are kept.
+			if (
+				skip is not None
+				and (depth := skip.count("/")) < len(ends)
+				and (end := ends[depth]) is not None
+				and "/".join(components[: depth + 1]) == skip
+			):
+				offset = end
+				del ends[depth:]
+
+
+# --
+# ### Compression
+#
+# Snapshot files can be compressed, which is denoted by an extra extension
+# like `.json.gz` or `.snap.xz`. Compression is done in a separate thread
+# while the nodes are produced.
+
+
+class ThreadedWriter(io.RawIOBase):
+	"""A raw writable stream that passes its data to a thread writing it to
+	`target`, so that the work done by `target` (like compression)
+	overlaps with the production of the data."""
+
+	def __init__(self, target: IO[bytes], depth: int = 16):
+		super().__init__()
+		self.target: IO[bytes] = target
+		self.queue: Queue[Optional[bytes]] = Queue(maxsize=depth)
+		self.error: Optional[BaseException] = None
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def writable(self) -> bool:
+		return True
+
+	def write(self, data: Any) -> int:
+		if self.error:
+			raise self.error
+		self.queue.put(bytes(data))
+		return len(data)
+
+	def run(self) -> None:
+		while (chunk := self.queue.get()) is not None:
+			if not self.error:
+				try:
+					self.target.write(chunk)
+				except BaseException as e:
+					self.error = e
+
+	def close(self) -> None:
+		if not self.closed:
+			self.queue.put(None)
+			self.thread.join()
+			self.target.close()
+			super().close()
+			if self.error:
+				raise self.error
+
+
+# The compression codecs, by file extension
+CODECS: dict[str, Callable[[str, str], IO[Any]]] = {
+	".gz": lambda path, mode: gzip.open(path, mode, compresslevel=6),
+	".xz": lambda path, mode: lzma.open(path, mode),
+	".bz2": lambda path, mode: bz2.open(path, mode),
+}
+
+
+def codecOf(path: Optional[str]) -> Optional[str]:
+	"""Returns the compression codec extension of the given path, if any"""
+	for ext in CODECS:
+		if path and path.endswith(ext):
+			return ext
+	return None
+
+
+def openSnapshot(path: str, mode: str) -> IO[Any]:
+	"""Opens the snapshot file at the given path, decompressing or
+	compressing it on the fly based on its extension."""
+	if not (codec := codecOf(path)):
+		return open(path, mode)
+	elif "w" in mode:
+		stream = io.BufferedWriter(
+			ThreadedWriter(CODECS[codec](path, "wb")), buffer_size=1024 * 1024
+		)
+		return io.TextIOWrapper(stream, encoding="utf8") if "t" in mode else stream
+	else:
+		return CODECS[codec](path, mode)
+
+
+# --
+# ### Loading and saving
+
+# The snapshot formats, by file extension
+FORMATS: dict[str, str] = {".json": "json", ".snap": "snap"}
+
+
+def formatOf(path: Optional[str]) -> Optional[str]:
+	"""Returns the snapshot format for the given path, if any"""
+	if path and (codec := codecOf(path)):
+		path = path[: -len(codec)]
+	for ext, fmt in FORMATS.items():
+		if path and path.endswith(ext):
+			return fmt
+	return None
+
+
+def isSnapshotPath(path: str) -> bool:
+	"""Tells if the given path designates a snapshot file"""
+	return formatOf(path) is not None
+
+
+def save(
+	path: Optional[str],
+	nodes: Iterable[Node],
+	format: str,
+	footer: Optional[Callable[[], dict[str, Any]]] = None,
+	**header: Any,
+) -> int:
+	"""Writes the given nodes as a snapshot in the given `format` to the file
+	at `path`, or to the standard output when `path` is `None` or `-`. The
+	values returned by `footer` are written after the nodes."""
+	output: Optional[str] = None if path in (None, "-") else path
+	if format == "json":
+		with openSnapshot(output, "wt") if output else nullcontext(sys.stdout) as f:
+			return writeJSON(f, nodes, footer, **header)
+	elif format == "snap":
+		with (
+			openSnapshot(output, "wb") if output else nullcontext(sys.stdout.buffer)
+		) as b:
+			return writeBinary(b, nodes, footer, **header)
+	else:
+		raise ValueError(
+			f"Unsupported snapshot format '{format}', pick one of: {', '.join(FORMATS.values())}"
+		)
+
+
+def load(path: str) -> Snapshot:
+	"""Returns a streamed snapshot for the snapshot file at the given path.
+	The file is closed once all the nodes have been read."""
+	if formatOf(path) == "snap":
+		return loadBinary(path)
+	f = openSnapshot(path, "rt")
+	reader = JSONReader(f).start()
+
+	# Directory hashes and block signatures come after the nodes, unless
+	# they were known when the snapshot was written.
+	def nodes() -> Iterator[Node]:
+		with f:
+			yield from reader
+		res.dirs = reader.header.get("dirs")
+		res.blocks = reader.header.get("blocks")
+		res.blockSize = reader.header.get("blockSize")
+
+	res = Snapshot.Stream(
+		nodes(),
+		algorithm=reader.header.get("algorithm", ALGORITHM),
+		isSorted=reader.header.get("sorted", False),
+	)
+	res.dirs = reader.header.get("dirs")
+	return res
+
+
+def loadBinary(path: str) -> Snapshot:
+	"""Returns a streamed snapshot for the binary snapshot at the given path,
+	which is memory-mapped. Compressed snapshots are first decompressed
+	to a temporary file."""
+	with openSnapshot(path, "rb") as f:
+		if codecOf(path):
+			t = tempfile.TemporaryFile(prefix="sink-")
+			with t:
+				shutil.copyfileobj(f, t, 1024 * 1024)
+				t.flush()
+				data = mmap.mmap(t.fileno(), 0, access=mmap.ACCESS_READ)
+		else:
+			data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	reader = BinaryReader(data)
+
+	def nodes() -> Iterator[Node]:
+		with data:
+			yield from reader
+
+	res = Snapshot.Stream(
+		nodes(),
+		algorithm=reader.header.get("algorithm", ALGORITHM),
+		isSorted=reader.header.get("sorted", False),
+	)
+	res.dirs = reader.header.get("dirs")
+	res.blocks = reader.header.get("blocks")
+	res.blockSize = reader.header.get("blockSize")
+	res.seekable = True
+	return res
+
+
+# EOF
@@ -0,0 +1,194 @@
+from typing import Iterator, NamedTuple, Optional
+import os
+import stat
+import struct
+
+# --
+# ## Git index
+#
+# Reads the index of a git repository (`.git/index`) directly, which lists
+# the tracked files along with the `stat` data they had when they were last
+# staged and the id of their blob. Index versions 2, 3 and 4 (which
+# compresses paths against the previous one) are supported.
+
+# The header, like `(signature, version, count)`
+HEADER = struct.Struct(">4sII")
+# The fixed part of an entry, like `(ctime_s, ctime_ns, mtime_s, mtime_ns,
+# dev, ino, mode, uid, gid, size, sha1, flags)`
+ENTRY = struct.Struct(">10I20sH")
+FLAG_EXTENDED: int = 0x4000
+FLAG_STAGE: int = 0x3000
+NAME_MASK: int = 0x0FFF
+
+
+class IndexEntry(NamedTuple):
+	"""A file tracked in the index, with its `stat` data when it was staged"""
+
+	path: str
+	mode: int
+	# The id of the blob, which is its `git` signature (see `hashing.GitBlob`)
+	sha: str
+	# The size is truncated to 32 bits
+	size: int
+	mtime_ns: int
+	ctime_ns: int
+	dev: int
+	ino: int
+	uid: int
+	gid: int
+
+
+def varint(data: bytes, offset: int) -> tuple[int, int]:
+	"""Decodes the offset-encoded integer used by index version 4, returning
+	it along with the offset after it."""
+	c = data[offset]
+	offset += 1
+	value = c & 0x7F
+	while c & 0x80:
+		c = data[offset]
+		offset += 1
+		value = ((value + 1) << 7) | (c & 0x7F)
+	return value, offset
+
+
+def entries(data: bytes) -> Iterator[IndexEntry]:
+	"""Parses the entries of the index in `data`, skipping the ones that are
+	not merged yet."""
+	signature, version, count = HEADER.unpack_from(data, 0)
+	if signature != b"DIRC" or version not in (2, 3, 4):
+		raise ValueError(f"Unsupported git index version {version}")
+	offset: int = HEADER.size
+	previous: bytes = b""
+	for _ in range(count):
+		start = offset
+		(
+			ctime_s,
+			ctime_ns,
+			mtime_s,
+			mtime_ns,
+			dev,
+			ino,
+			mode,
+			uid,
+			gid,
+			size,
+			sha,
+			flags,
+		) = ENTRY.unpack_from(data, offset)
+		offset += ENTRY.size
+		if flags & FLAG_EXTENDED and version >= 3:
+			offset += 2
+		if version == 4:
+			strip, offset = varint(data, offset)
+			end = data.index(b"\0", offset)
+			path = previous[: len(previous) - strip] + data[offset:end]
+			offset = end + 1
+		else:
+			length = flags & NAME_MASK
+			end = (
+				offset + length
+				if length < NAME_MASK
+				else data.index(b"\0", offset + NAME_MASK)
+			)
+			path = data[offset:end]
+			# Entries are padded with 1 to 8 NUL bytes to a multiple of 8
+			offset = start + ((end - start + 8) & ~7)
+		previous = path
+		# Sparse directories and unmerged entries have no file to compare
+		if flags & FLAG_STAGE or stat.S_ISDIR(mode):
+			continue
+		yield IndexEntry(
+			os.fsdecode(path),
+			mode,
+			sha.hex(),
+			size,
+			mtime_s * 1_000_000_000 + mtime_ns,
+			ctime_s * 1_000_000_000 + ctime_ns,
+			dev,
+			ino,
+			uid,
+			gid,
+		)
+
+
+def repository(path: str) -> Optional[tuple[str, str]]:
+	"""Returns the work tree and the git directory of the repository that
+	contains `path`, if any."""
+	current = os.path.abspath(path)
+	while True:
+		dotgit = os.path.join(current, ".git")
+		if os.path.isdir(dotgit):
+			return current, dotgit
+		elif os.path.isfile(dotgit):
+			# Worktrees and submodules have a `.git` file pointing to it
+			with open(dotgit, "rt") as f:
+				line = f.readline().strip()
+			if line.startswith("gitdir:"):
+				return current, os.path.join(current, line[7:].strip())
+			return None
+		parent = os.path.dirname(current)
+		if parent == current:
+			return None
+		current = parent
+
+
+class GitIndex:
+	"""The entries of a git index, seen from a directory of its work tree."""
+
+	@staticmethod
+	def Open(path: str) -> Optional["GitIndex"]:
+		"""Reads the index of the repository containing `path`, if any"""
+		if not (repo := repository(path)):
+			return None
+		worktree, gitdir = repo
+		index = os.path.join(gitdir, "index")
+		try:
+			with open(index, "rb") as f:
+				data = f.read()
+				mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+		except FileNotFoundError:
+			return None
+		prefix = os.path.relpath(os.path.abspath(path), worktree)
+		return GitIndex(
+			entries(data),
+			prefix="" if prefix == "." else f"{prefix}/",
+			mtime_ns=mtime_ns,
+		)
+
+	def __init__(
+		self, entries: Iterator[IndexEntry], *, prefix: str = "", mtime_ns: int = 0
+	):
+		self.entries: dict[str, IndexEntry] = {_.path: _ for _ in entries}
+		# The path of the directory we're in, relative to the work tree
+		self.prefix: str = prefix
+		# The modification time of the index, entries modified since can't
+		# be trusted (see "racy git").
+		self.mtime_ns: int = mtime_ns
+
+	def paths(self) -> Iterator[str]:
+		"""Iterates on the tracked paths, relative to the directory"""
+		prefix = self.prefix
+		offset = len(prefix)
+		for path in self.entries:
+			if path.startswith(prefix):
+				yield path[offset:]
+
+	def signature(self, path: str, r: os.stat_result) -> Optional[str]:
+		"""Returns the blob id of the file at `path`, relative to the
+		directory, when its `stat` shows it has not changed since it was
+		staged."""
+		entry = self.entries.get(f"{self.prefix}{path}")
+		if (
+			entry
+			and stat.S_ISREG(entry.mode)
+			and entry.mtime_ns == r.st_mtime_ns
+			and entry.ctime_ns == r.st_ctime_ns
+			and entry.size == r.st_size & 0xFFFFFFFF
+			and entry.ino == r.st_ino & 0xFFFFFFFF
+			and entry.mtime_ns < self.mtime_ns
+		):
+			return entry.sha
+		return None
+
+
+# EOF
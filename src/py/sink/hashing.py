@@ -0,0 +1,208 @@
+from typing import Optional, Callable, Protocol
+from functools import partial
+import hashlib
+import mmap
+import os
+import zlib
+
+# --
+# ## Hashing engine
+#
+# File contents are hashed in fixed-size chunks read into a preallocated
+# buffer that is reused from one file to the next, so that the peak memory
+# stays the same whatever the size of the files. Files above a given size
+# can optionally be memory-mapped instead, in which case the pages are
+# backed by the file itself and can be reclaimed by the OS at any time.
+
+# The default size of the chunks fed to the digest.
+CHUNK_SIZE: int = 1024 * 1024
+# The default algorithm used for signatures
+ALGORITHM: str = "sha512_256"
+
+# --
+# Large files can also be given block signatures, like rsync does: their
+# contents are split in fixed-size blocks, each with a weak checksum
+# (Adler-32) and a strong digest (the first 8 bytes of BLAKE2b), written
+# one after the other in hex. Comparing the block signatures of two
+# versions of a file gives the ranges that changed.
+
+# The default size of the blocks
+BLOCK_SIZE: int = 64 * 1024
+# Files with fewer blocks are not given block signatures
+BLOCK_MIN: int = 16
+# The length of the signature of a block, in hex digits
+BLOCK_SIG: int = 8 + 16
+
+
+class Digest(Protocol):
+	"""The subset of the `hashlib` interface used for signatures"""
+
+	def update(self, data: bytes | memoryview, /) -> None: ...
+
+	def hexdigest(self) -> str: ...
+
+
+class Checksum:
+	"""Wraps `zlib` checksums in the `hashlib` interface. Checksums are
+	much cheaper than digests, but are only fit for change detection."""
+
+	def __init__(
+		self, function: Callable[[bytes | memoryview, int], int], value: int
+	):
+		self.function = function
+		self.value: int = value
+
+	def update(self, data: bytes | memoryview, /) -> None:
+		self.value = self.function(data, self.value)
+
+	def hexdigest(self) -> str:
+		return f"{self.value:08x}"
+
+
+class GitBlob:
+	"""Hashes contents the way git identifies blobs, which is the `sha1` of
+	a `blob SIZE\0` header followed by the contents. The size needs to be
+	given with `start` before the contents, and without it, this is a plain
+	`sha1`."""
+
+	def __init__(self) -> None:
+		self.digest = hashlib.sha1(usedforsecurity=False)
+
+	def start(self, size: int) -> None:
+		self.digest.update(f"blob {size}\0".encode("ascii"))
+
+	def update(self, data: bytes | memoryview, /) -> None:
+		self.digest.update(data)
+
+	def hexdigest(self) -> str:
+		return self.digest.hexdigest()
+
+
+# --
+# The algorithms available for signatures, by name.
+ALGORITHMS: dict[str, Callable[[], Digest]] = {
+	"sha512_256": partial(hashlib.new, "sha512_256"),
+	"sha256": hashlib.sha256,
+	"sha1": hashlib.sha1,
+	"md5": partial(hashlib.md5, usedforsecurity=False),
+	"blake2b": hashlib.blake2b,
+	"blake2b-128": partial(hashlib.blake2b, digest_size=16),
+	"blake2s": hashlib.blake2s,
+	"crc32": partial(Checksum, zlib.crc32, 0),
+	"adler32": partial(Checksum, zlib.adler32, 1),
+	"git": GitBlob,
+}
+
+
+def digester(name: str) -> Callable[[], Digest]:
+	"""Returns the digest factory for the algorithm with the given name"""
+	if name not in ALGORITHMS:
+		raise ValueError(
+			f"Unsupported hash algorithm '{name}', pick one of: {', '.join(ALGORITHMS)}"
+		)
+	return ALGORITHMS[name]
+
+
+class Hasher:
+	"""Computes file content digests using a reusable read buffer. A hasher
+	is not thread-safe, as the buffer is shared between calls."""
+
+	def __init__(
+		self,
+		algorithm: str = ALGORITHM,
+		*,
+		chunkSize: int = CHUNK_SIZE,
+		mmapThreshold: Optional[int] = None,
+	):
+		self.algorithm: str = algorithm
+		self.factory: Callable[[], Digest] = digester(algorithm)
+		self.chunkSize: int = chunkSize
+		# Files of at least this size are memory-mapped, `None` disables it.
+		self.mmapThreshold: Optional[int] = mmapThreshold
+		self.buffer: bytearray = bytearray(chunkSize)
+		self.view: memoryview = memoryview(self.buffer)
+
+	def digest(self, path: str) -> str:
+		"""Returns the hex digest of the contents of the file at `path`."""
+		h = self.factory()
+		# NOTE: We don't need Python's buffering as we read in large chunks
+		with open(path, "rb", buffering=0) as f:
+			size = os.fstat(f.fileno()).st_size
+			if isinstance(h, GitBlob):
+				h.start(size)
+			if self.mmapThreshold is not None and size and size >= self.mmapThreshold:
+				self.mapped(f.fileno(), size, h)
+			else:
+				view = self.view
+				while n := f.readinto(view):
+					h.update(view[:n])
+		return h.hexdigest()
+
+	def digestBlocks(self, path: str, size: int = BLOCK_SIZE) -> tuple[str, str]:
+		"""Returns the hex digest of the contents of the file at `path` along
+		with its block signatures (see `blocks`), reading it once."""
+		h = self.factory()
+		blocks = self.blocks(path, size, h)
+		return h.hexdigest(), blocks
+
+	def blocks(
+		self, path: str, size: int = BLOCK_SIZE, h: Optional[Digest] = None
+	) -> str:
+		"""Returns the block signatures of the file at `path`, for blocks of
+		the given `size`, feeding its contents to the digest `h` when given."""
+		res: list[str] = []
+		# Files are read in as many whole blocks as fit in a chunk
+		span = max(size, self.chunkSize // size * size)
+		view = self.view if span <= self.chunkSize else memoryview(bytearray(span))
+		with open(path, "rb", buffering=0) as f:
+			if isinstance(h, GitBlob):
+				h.start(os.fstat(f.fileno()).st_size)
+			chunk = view[:span]
+			while n := f.readinto(chunk):
+				# NOTE: `readinto` may return less than asked before the end
+				while n < span and (m := f.readinto(chunk[n:])):
+					n += m
+				if h is not None:
+					h.update(chunk[:n])
+				for offset in range(0, n, size):
+					data = chunk[offset : min(offset + size, n)]
+					res.append(
+						f"{zlib.adler32(data):08x}{hashlib.blake2b(data, digest_size=8).hexdigest()}"
+					)
+		return "".join(res)
+
+	def mapped(self, fd: int, size: int, h: Digest) -> None:
+		"""Feeds the memory-mapped file `fd` to the digest `h`, one chunk
+		at a time."""
+		with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as m:
+			if hasattr(m, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+				m.madvise(mmap.MADV_SEQUENTIAL)
+			view = memoryview(m)
+			try:
+				for offset in range(0, size, self.chunkSize):
+					h.update(view[offset : offset + self.chunkSize])
+			finally:
+				# The view needs to be released before the map is closed
+				view.release()
+
+
+def changedRanges(
+	previous: str, current: str, blockSize: int, size: Optional[int] = None
+) -> list[tuple[int, int]]:
+	"""Returns the `(offset, length)` ranges of the file with the `current`
+	block signatures that differ from the `previous` ones, adjacent blocks
+	being merged. Ranges are clamped to the file `size`, when given."""
+	res: list[tuple[int, int]] = []
+	for i in range(0, len(current), BLOCK_SIG):
+		if current[i : i + BLOCK_SIG] != previous[i : i + BLOCK_SIG]:
+			offset = (i // BLOCK_SIG) * blockSize
+			if res and res[-1][0] + res[-1][1] == offset:
+				res[-1] = (res[-1][0], res[-1][1] + blockSize)
+			else:
+				res.append((offset, blockSize))
+	if size is not None and res and sum(res[-1]) > size:
+		res[-1] = (res[-1][0], size - res[-1][0])
+	return res
+
+
+# EOF
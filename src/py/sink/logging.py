@@ -19,7 +19,10 @@ class Metric:
 		self.last = value
 
 	def inc(self) -> None:
-		self.value += 1
+		self.add(1)
+
+	def add(self, value: int) -> None:
+		self.value += value
 		t = now()
 		if t - self.update < self.THROTTLING:
 			pass
@@ -1,11 +1,13 @@
-from typing import NamedTuple, Iterable, Optional
+from typing import NamedTuple, Iterable, Optional, Union
 import re
 import os
 import sys
 import fnmatch
+import glob
 from enum import Enum
 from pathlib import Path
-from .utils import shell, dotfile
+from .utils import dotfile
+from .gitindex import GitIndex
 
 
 # --
@@ -22,9 +24,11 @@ class RawFilters(NamedTuple):
 
 
 class Filters(NamedTuple):
-	rejects: Optional[re.Pattern[str]] = None
-	accepts: Optional[re.Pattern[str]] = None
-	keeps: Optional[re.Pattern[str]] = None
+	rejects: Optional["TFilter"] = None
+	accepts: Optional["TFilter"] = None
+	keeps: Optional["TFilter"] = None
+	# Tells if the `.gitignore` files found while walking apply
+	gitignore: bool = False
 
 
 class FilterCategory(Enum):
@@ -62,9 +66,9 @@ def makePattern(
 	setlist: Optional[list[str]],
 	sets: dict[str, RawFilters],
 	category: FilterCategory,
-) -> Optional[re.Pattern[str]]:
+) -> Optional["Matcher"]:
 	"""A helper function for filters"""
-	return pattern(makeFilterList(items, setlist, sets, category))
+	return Matcher.Compile(makeFilterList(items, setlist, sets, category))
 
 
 def combine(a: Optional[list[str]], b: Optional[list[str]]) -> Optional[list[str]]:
@@ -130,7 +134,12 @@ def filters(
 		return Filters(accepts=accepted, rejects=rejected, keeps=kept)
 	else:
 		f = gitignored()
-		return Filters(accepts=None, rejects=pattern(f.rejects), keeps=pattern(f.keeps))
+		return Filters(
+			accepts=None,
+			rejects=Matcher.Compile(f.rejects),
+			keeps=Matcher.Compile(f.keeps),
+			gitignore=True,
+		)
 
 
 RE_EXACT = re.compile(r"^(/|./)(?P<path>.*)$")
@@ -185,12 +194,125 @@ def pattern(
 		raise e from e
 
 
+# --
+# ## Matchers
+#
+# Filters are run against every entry of a walk, and the same names come up
+# over and over again in large trees. Matchers split patterns into literal
+# names (looked up in a set), suffix globs like `*.pyc` (checked with
+# `endswith`) and the remaining name globs (a regexp), and memoize their
+# decision for each name. Exact patterns (starting with `./` or `/`) and
+# patterns with a `/` match the path instead, or any of its parents.
+
+RE_GLOB = re.compile(r"[*?\[]")
+
+
+class Matcher:
+	"""A compiled list of filter patterns (see `Compile`)"""
+
+	# The number of name decisions kept, after which they're forgotten
+	MEMO: int = 65_536
+
+	@staticmethod
+	def Compile(patterns: Optional[Iterable[str]]) -> Optional["Matcher"]:
+		"""Compiles the given patterns, returning `None` when there are none
+		given, like `pattern`."""
+		if patterns is None:
+			return None
+		res = Matcher()
+		suffixes: list[str] = []
+		name_globs: list[str] = []
+		path_globs: list[str] = []
+		for p in patterns:
+			if m := RE_EXACT.match(p):
+				p, anchored = m.group("path"), True
+			else:
+				anchored = "/" in p
+			if not p:
+				continue
+			elif anchored:
+				if RE_GLOB.search(p):
+					path_globs.append(p)
+				else:
+					res.paths.add(p.rstrip("/"))
+			elif not RE_GLOB.search(p):
+				res.names.add(p)
+			elif p.startswith("*") and not RE_GLOB.search(p, 1):
+				suffixes.append(p[1:])
+			else:
+				name_globs.append(p)
+		res.suffixes = tuple(suffixes)
+		if name_globs:
+			res.nameExpr = re.compile(f"^({'|'.join(globre(_) for _ in name_globs)})$")
+		if path_globs:
+			res.pathExpr = re.compile(
+				f"^({'|'.join(globre(_) for _ in path_globs)})(/.*)?$"
+			)
+		return res
+
+	@staticmethod
+	def Of(value: "TFilter") -> "Matcher":
+		"""Returns a matcher for the given filter, a compiled regexp matching
+		both the names and the paths."""
+		if isinstance(value, Matcher):
+			return value
+		res = Matcher()
+		res.nameExpr = res.pathExpr = value
+		return res
+
+	def __init__(self) -> None:
+		self.names: set[str] = set()
+		self.suffixes: tuple[str, ...] = ()
+		self.nameExpr: Optional[re.Pattern[str]] = None
+		self.paths: set[str] = set()
+		self.pathExpr: Optional[re.Pattern[str]] = None
+		self.memo: dict[str, bool] = {}
+
+	def matchesName(self, name: str) -> bool:
+		if (res := self.memo.get(name)) is None:
+			res = bool(
+				name in self.names
+				or (self.suffixes and name.endswith(self.suffixes))
+				or (self.nameExpr and self.nameExpr.match(name))
+			)
+			if len(self.memo) >= self.MEMO:
+				self.memo.clear()
+			self.memo[name] = res
+		return res
+
+	def matchesPath(self, path: str) -> bool:
+		if self.paths:
+			parent = path
+			while parent:
+				if parent in self.paths:
+					return True
+				parent = parent.rpartition("/")[0]
+		return bool(self.pathExpr and self.pathExpr.match(path))
+
+	def matches(self, name: str, path: str) -> bool:
+		"""Tells if the entry with the given `name`, at the given relative
+		`path`, matches."""
+		return self.matchesName(name) or self.matchesPath(path)
+
+	def match(self, value: str) -> bool:
+		"""Matches the given path, like a compiled regexp would"""
+		return self.matches(value.rpartition("/")[2], value)
+
+	def __getstate__(self) -> dict[str, object]:
+		# The memo is not worth sending to walker processes
+		return {**self.__dict__, "memo": {}}
+
+
+# A filter, either compiled by `pattern` or by `Matcher.Compile`
+TFilter = Union[re.Pattern[str], Matcher]
+
+
 def matches(
 	value: str,
 	*,
-	accepts: Optional[re.Pattern[str]] = None,
-	rejects: Optional[re.Pattern[str]] = None,
-	keeps: Optional[re.Pattern[str]] = None,
+	accepts: Optional[TFilter] = None,
+	rejects: Optional[TFilter] = None,
+	keeps: Optional[TFilter] = None,
 ) -> bool:
 	"""Tells if the given value passes the `accepts` and `rejects` filters."""
 	if rejects and rejects.match(value):
@@ -202,21 +324,190 @@ def matches(
 		return True
 
 
+# --
+# ## Path filters
+#
+# Walks filter their entries by path relative to their root, so that `./`
+# anchored patterns apply to nested paths, while other patterns also match
+# the entry's name at any depth. Directories are filtered before being
+# listed, so that a rejected directory is pruned as a whole, and the
+# `.gitignore` files found along the way apply to the directory they are
+# in, like git does.
+
+
+class IgnoreRule(NamedTuple):
+	"""A rule of a `.gitignore` file"""
+
+	expr: re.Pattern[str]
+	# Negated rules (`!PATTERN`) re-include what they match
+	negated: bool = False
+	# Rules ending with `/` only match directories
+	directory: bool = False
+	# Rules with a `/` match paths relative to their `.gitignore`,
+	# otherwise they match names.
+	anchored: bool = False
+
+
+class IgnoreScope(NamedTuple):
+	"""The rules of the `.gitignore` file of the directory at `base`, and
+	of its parent directories."""
+
+	base: str
+	rules: list[IgnoreRule]
+	parent: Optional["IgnoreScope"] = None
+
+
+def ignorere(text: str) -> str:
+	"""Converts a `.gitignore` glob to a regexp, where `*` does not match
+	`/` unlike in `globre`, and `**` matches any number of directories."""
+	res: list[str] = []
+	i: int = 0
+	n: int = len(text)
+	if text.startswith("**/"):
+		res.append("(.*/)?")
+		i = 3
+	while i < n:
+		c = text[i]
+		if text.startswith("/**/", i):
+			res.append("/(.*/)?")
+			i += 4
+		elif text.startswith("/**", i) and i + 3 == n:
+			res.append("/.*")
+			i += 3
+		elif text.startswith("**", i):
+			res.append(".*")
+			i += 2
+		elif c == "*":
+			res.append("[^/]*")
+			i += 1
+		elif c == "?":
+			res.append("[^/]")
+			i += 1
+		elif c == "[" and (j := text.find("]", i + 2)) > 0:
+			body = text[i + 1 : j].replace("\\", "\\\\")
+			res.append(f"[^{body[1:]}]" if body[0] in "!^" else f"[{body}]")
+			i = j + 1
+		elif c == "\\" and i + 1 < n:
+			res.append(re.escape(text[i + 1]))
+			i += 2
+		else:
+			res.append(re.escape(c))
+			i += 1
+	return "".join(res)
+
+
+def ignorerules(lines: Iterable[str]) -> list[IgnoreRule]:
+	"""Parses the lines of a `.gitignore` file into rules"""
+	res: list[IgnoreRule] = []
+	for line in lines:
+		line = line.rstrip("\n")
+		# Trailing spaces are ignored unless escaped
+		while line.endswith(" ") and not line.endswith("\\ "):
+			line = line[:-1]
+		if not line or line.startswith("#"):
+			continue
+		negated = line.startswith("!")
+		if negated or line.startswith("\\#") or line.startswith("\\!"):
+			line = line[1:]
+		directory = line.endswith("/")
+		line = line.rstrip("/")
+		if not line:
+			continue
+		anchored = "/" in line
+		try:
+			expr = re.compile(f"^{ignorere(line.lstrip('/'))}$")
+		except re.error:
+			sys.stderr.write(f"WRN Skipping invalid .gitignore pattern: {line}\n")
+			continue
+		res.append(IgnoreRule(expr, negated, directory, anchored))
+	return res
+
+
+class PathFilter:
+	"""Filters the paths of a walk of `root`, relative to it, given the
+	`accepts`, `rejects` and `keeps` patterns and, when `gitignore` is set,
+	the `.gitignore` files of the walked directories."""
+
+	def __init__(
+		self,
+		root: str,
+		*,
+		accepts: Optional[TFilter] = None,
+		rejects: Optional[TFilter] = None,
+		keeps: Optional[TFilter] = None,
+		gitignore: bool = False,
+	):
+		self.root: str = root
+		self.accepts: Optional[Matcher] = Matcher.Of(accepts) if accepts else None
+		self.rejects: Optional[Matcher] = Matcher.Of(rejects) if rejects else None
+		self.keeps: Optional[Matcher] = Matcher.Of(keeps) if keeps else None
+		self.gitignore: bool = gitignore
+
+	def scope(
+		self, path: str, parent: Optional[IgnoreScope] = None
+	) -> Optional[IgnoreScope]:
+		"""Returns the ignore scope of the directory at `path`, within the
+		`parent` scope, which is the parent one when it has no `.gitignore`."""
+		if not self.gitignore:
+			return None
+		try:
+			with open(
+				f"{self.root}/{path}/.gitignore" if path else f"{self.root}/.gitignore",
+				"rt",
+				errors="surrogateescape",
+			) as f:
+				rules = ignorerules(f)
+		except (FileNotFoundError, NotADirectoryError, PermissionError):
+			return parent
+		return IgnoreScope(path, rules, parent) if rules else parent
+
+	def ignored(
+		self, path: str, isDirectory: bool, scope: Optional[IgnoreScope]
+	) -> bool:
+		"""Tells if `path` is ignored by the rules of the given scope, the
+		last matching rule of the innermost `.gitignore` taking precedence."""
+		name = path.rpartition("/")[2]
+		while scope:
+			rel = path[len(scope.base) + 1 :] if scope.base else path
+			for rule in reversed(scope.rules):
+				if rule.directory and not isDirectory:
+					continue
+				if rule.expr.match(rel if rule.anchored else name):
+					return not rule.negated
+			scope = scope.parent
+		return False
+
+	def allows(
+		self,
+		path: str,
+		isDirectory: bool = False,
+		scope: Optional[IgnoreScope] = None,
+	) -> bool:
+		"""Tells if the entry at `path` passes the filters, `scope` being the
+		ignore scope of its directory. Accepted patterns only apply to files,
+		as directories may contain accepted files."""
+		name = path.rpartition("/")[2]
+		if (
+			self.rejects
+			and self.rejects.matches(name, path)
+			or (scope and self.ignored(path, isDirectory, scope))
+		) and not (self.keeps and self.keeps.matches(name, path)):
+			return False
+		if not isDirectory and self.accepts and not self.accepts.matches(name, path):
+			return False
+		return True
+
+
 def filterset(collection: str) -> RawFilters:
 	"""Returns"""
 	match collection:
 		case "none":
 			return RawFilters()
 		case "git":
-			return RawFilters(
-				accepts=[
-					_
-					for _ in str(
-						shell(["git", "ls-tree", "-r", "HEAD", "--name-only"]), "utf8"
-					).split("\n")
-					if _.strip()
-				]
-			)
+			# Tracked paths are exact paths, which matchers look up in a set
+			if not (index := GitIndex.Open(".")):
+				raise ValueError("The 'git' filter set requires a git repository")
+			return RawFilters(accepts=[f"./{glob.escape(_)}" for _ in index.paths()])
 		case "gitignore":
 			return gitignored()
 		case _:
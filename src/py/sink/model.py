@@ -1,6 +1,19 @@
-from typing import Optional, Iterable, Iterator, Any, Final
+from typing import (
+	Optional,
+	Iterable,
+	Iterator,
+	Any,
+	Final,
+	Generator,
+	MutableMapping,
+	cast,
+)
 from dataclasses import dataclass
+from array import array
+from bisect import bisect_left
 from enum import Enum
+import sys
+from .hashing import ALGORITHM, Digest, digester
 
 # --
 # This is a re-implementation of Sink (V1) backend, with a few different
@@ -21,6 +34,7 @@ class Status(Enum):
 	ABSENT = " ! "
 	ORIGIN = " . "
 	META_CHANGED = " ^ "
+	MOVED = " → "
 
 
 class Change(Enum):
@@ -51,7 +65,7 @@ class NodeType:
 	UNKNOWN: Final[int] = 100
 
 
-@dataclass
+@dataclass(slots=True)
 class NodeMeta:
 	"""Captures the node metadata that is part of the snapshot"""
 
@@ -77,7 +91,7 @@ class NodeMeta:
 		)
 
 
-@dataclass
+@dataclass(slots=True)
 class Node:
 	"""Represents the snapshot of a node in a given tree."""
 
@@ -122,25 +136,202 @@ class Node:
 			"sig": self.sig,
 		}
 
-	def hasChanged(self, other: Optional["Node"], meta: bool = False) -> bool:
+	def hasChanged(
+		self, other: Optional["Node"], meta: bool = False, signatures: bool = True
+	) -> bool:
 		return (
 			self.hasTypeChanged(other)
-			or self.hasContentChanged(other)
+			or self.hasContentChanged(other, signatures)
 			or (meta and self.hasMetaChanged(other))
 		)
 
 	def hasTypeChanged(self, other: Optional["Node"]) -> bool:
 		return self.type != other.type if other else True
 
-	def hasContentChanged(self, other: Optional["Node"]) -> bool:
-		return self.sig != other.sig if other else True
+	def hasContentChanged(
+		self, other: Optional["Node"], signatures: bool = True
+	) -> bool:
+		"""Tells if the content has changed, comparing signatures when
+		both nodes have one and `signatures` is set, and otherwise the
+		size and modification time of files."""
+		if not other:
+			return True
+		elif signatures and self.sig is not None and other.sig is not None:
+			return self.sig != other.sig
+		elif self.type == NodeType.FILE and self.meta and other.meta:
+			return (
+				self.meta.size != other.meta.size or self.meta.mtime != other.meta.mtime
+			)
+		else:
+			return self.sig != other.sig
 
 	def hasMetaChanged(self, other: Optional["Node"]) -> bool:
 		return self.meta != other.meta if other else True
 
 
+class NodeTable(MutableMapping[str, Node]):
+	"""A mapping of paths to nodes that stores the node attributes in
+	typed columns instead of as objects, which takes a fraction of the
+	memory. Paths and signatures are interned, so that they are shared
+	between the snapshots of the same tree. Nodes are created on access
+	and are detached copies: changing them does not update the table. The
+	rows of removed nodes are reused by the nodes added afterwards, so that
+	a table that keeps changing doesn't grow."""
+
+	# Set in the type column when the node has a meta
+	HAS_META: Final[int] = 0x80
+
+	def __init__(self, nodes: Optional[Iterable[Node]] = None):
+		self.rows: dict[str, int] = {}
+		self.types: array[int] = array("B")
+		self.modes: array[int] = array("I")
+		self.uids: array[int] = array("q")
+		self.gids: array[int] = array("q")
+		self.sizes: array[int] = array("q")
+		self.ctimes: array[float] = array("d")
+		self.mtimes: array[float] = array("d")
+		self.sigs: list[Optional[str]] = []
+		# The rows of the removed nodes, to be reused
+		self.free: list[int] = []
+		for node in nodes or ():
+			self[node.path] = node
+
+	def node(self, path: str, row: int) -> Node:
+		"""Returns a node for the given row"""
+		t = self.types[row]
+		return Node(
+			path,
+			t & ~self.HAS_META,
+			(
+				NodeMeta(
+					self.modes[row],
+					self.uids[row],
+					self.gids[row],
+					self.sizes[row],
+					self.ctimes[row],
+					self.mtimes[row],
+				)
+				if t & self.HAS_META
+				else None
+			),
+			self.sigs[row],
+		)
+
+	def __getitem__(self, path: str) -> Node:
+		return self.node(path, self.rows[path])
+
+	def __setitem__(self, path: str, node: Node) -> None:
+		meta = node.meta
+		t = node.type | self.HAS_META if meta else node.type
+		values = (
+			(meta.mode, meta.uid, meta.gid, meta.size, meta.ctime, meta.mtime)
+			if meta
+			else (0, 0, 0, 0, 0.0, 0.0)
+		)
+		sig = sys.intern(node.sig) if node.sig is not None else None
+		columns = (
+			self.modes,
+			self.uids,
+			self.gids,
+			self.sizes,
+			self.ctimes,
+			self.mtimes,
+		)
+		if (row := self.rows.get(path)) is None and not self.free:
+			self.rows[sys.intern(path)] = len(self.types)
+			self.types.append(t)
+			for column, value in zip(columns, values):
+				column.append(value)
+			self.sigs.append(sig)
+		else:
+			if row is None:
+				row = self.rows[sys.intern(path)] = self.free.pop()
+			self.types[row] = t
+			for column, value in zip(columns, values):
+				column[row] = value
+			self.sigs[row] = sig
+
+	def __delitem__(self, path: str) -> None:
+		row = self.rows.pop(path)
+		# The signature is released, and the row reused by the next node
+		self.sigs[row] = None
+		self.free.append(row)
+
+	def __contains__(self, path: object) -> bool:
+		return path in self.rows
+
+	def __iter__(self) -> Iterator[str]:
+		return iter(self.rows)
+
+	def __len__(self) -> int:
+		return len(self.rows)
+
+	def nodes(self) -> Iterator[Node]:
+		"""Iterates on the nodes, faster than `values()`"""
+		for path, row in self.rows.items():
+			yield self.node(path, row)
+
+
+class TreeHasher:
+	"""Computes the hashes of the directories of a tree from its nodes,
+	given in path order. The hash of a directory covers the names, types and
+	signatures of its children, including the hashes of its subdirectories,
+	so that directories with the same hash have the same contents. Files
+	without a signature leave their directory, and its parents, without hash.
+	The root directory is `""`."""
+
+	def __init__(self, algorithm: str = ALGORITHM):
+		self.factory = digester(algorithm)
+		# The directories being hashed, from the root down to the current one
+		self.paths: list[str] = [""]
+		self.digests: list[Optional[Digest]] = [self.factory()]
+		self.hashes: dict[str, str] = {}
+
+	def add(self, node: Node) -> None:
+		parent, _, name = node.path.rpartition("/")
+		paths = self.paths
+		# We close the directories that are not ancestors of the node
+		while len(paths) > 1 and not (
+			parent == paths[-1] or parent.startswith(f"{paths[-1]}/")
+		):
+			self.close()
+		# And open the ones that are not opened yet
+		if parent != (top := paths[-1]):
+			for component in parent[len(top) + 1 if top else 0 :].split("/"):
+				top = f"{top}/{component}" if top else component
+				paths.append(top)
+				self.digests.append(self.factory())
+		self.update(
+			f"{name}\0{node.type}\0{node.sig or ''}\0",
+			node.type == NodeType.FILE and node.sig is None,
+		)
+
+	def update(self, entry: str, unknown: bool = False) -> None:
+		if unknown:
+			self.digests[-1] = None
+		elif digest := self.digests[-1]:
+			digest.update(entry.encode("utf8", "surrogateescape"))
+
+	def close(self) -> None:
+		"""Closes the current directory, adding its hash to its parent"""
+		path = self.paths.pop()
+		digest = self.digests.pop()
+		value = digest.hexdigest() if digest else None
+		if value:
+			self.hashes[path] = value
+		if self.paths:
+			self.update(f"{path.rpartition('/')[2]}/\0{value}\0", value is None)
+
+	def finish(self) -> dict[str, str]:
+		"""Closes all the directories and returns their hashes"""
+		while self.paths:
+			self.close()
+		return self.hashes
+
+
 class Snapshot:
-	"""Represents a collection of node states."""
+	"""Represents a collection of node states, which are stored in a
+	`NodeTable`."""
 
 	@staticmethod
 	def FromPrimitive(value: dict[str, Any]) -> "Snapshot":
@@ -150,25 +341,155 @@ class Snapshot:
 				if value.get("nodes")
 				else None
 			),
+			# Snapshots without algorithm predate the option, and all used
+			# the default one.
+			algorithm=value.get("algorithm", ALGORITHM),
+			dirs=value.get("dirs"),
+			blocks=value.get("blocks"),
+			blockSize=value.get("blockSize"),
 		)
 
-	def __init__(self, nodes: Optional[Iterable[Node] | dict[str, Node]] = None):
-		self.nodes: dict[str, Node] = nodes if nodes and isinstance(nodes, dict) else {}
-		if nodes and not isinstance(nodes, dict):
-			self.extend(nodes)
+	@staticmethod
+	def Stream(
+		nodes: Iterable[Node],
+		*,
+		algorithm: str = ALGORITHM,
+		root: Optional[str] = None,
+		isSorted: bool = False,
+		hashDirs: bool = False,
+	) -> "Snapshot":
+		"""Creates a snapshot whose nodes are only read when needed, either
+		all at once when accessing `nodes`, or one at a time with `stream`.
+		When `isSorted` is set, the nodes are known to come in path order,
+		and `hashDirs` computes the directory hashes as they are read."""
+		res = Snapshot(algorithm=algorithm, root=root)
+		res.pending = res.hashing(nodes) if isSorted and hashDirs else iter(nodes)
+		res.isSorted = isSorted
+		return res
+
+	def __init__(
+		self,
+		nodes: Optional[Iterable[Node] | dict[str, Node]] = None,
+		*,
+		algorithm: str = ALGORITHM,
+		root: Optional[str] = None,
+		dirs: Optional[dict[str, str]] = None,
+		blocks: Optional[dict[str, str]] = None,
+		blockSize: Optional[int] = None,
+	):
+		# The hash algorithm used for the signatures of the nodes
+		self.algorithm: str = algorithm
+		# The hashes of the directories (see `TreeHasher`), when known
+		self.dirs: Optional[dict[str, str]] = dirs
+		# The block signatures of the large files, for blocks of `blockSize`
+		# (see `hashing.Hasher.blocks`), when they were computed.
+		self.blocks: Optional[dict[str, str]] = blocks
+		self.blockSize: Optional[int] = blockSize
+		# The directory the snapshot was taken from, when it is still
+		# available, so that missing signatures can be computed on demand.
+		self.root: Optional[str] = root
+		# The nodes that are yet to be read, for streamed snapshots
+		self.pending: Optional[Iterator[Node]] = None
+		# Tells if the pending nodes come in path order
+		self.isSorted: bool = False
+		# Tells if the pending nodes can skip a directory sent to them
+		self.seekable: bool = False
+		self._nodes: NodeTable = NodeTable()
+		if nodes:
+			self.extend(nodes.values() if isinstance(nodes, dict) else nodes)
+
+	@property
+	def nodes(self) -> NodeTable:
+		if self.pending is not None:
+			pending, self.pending = self.pending, None
+			self.extend(pending)
+		return self._nodes
+
+	def read(self) -> "Snapshot":
+		"""Reads all the pending nodes, if any."""
+		self.nodes
+		return self
+
+	def stream(self) -> Iterator[Node]:
+		"""Iterates on the nodes. Pending nodes are not retained, so that
+		a streamed snapshot can only be iterated on once."""
+		if self.pending is not None:
+			pending, self.pending = self.pending, None
+			yield from pending
+		else:
+			yield from self._nodes.nodes()
+
+	def hashing(self, nodes: Iterable[Node]) -> Iterator[Node]:
+		"""Iterates on the given nodes, sorted by path, and sets the `dirs`
+		hashes once they have all been read."""
+		tree = TreeHasher(self.algorithm)
+		for node in nodes:
+			tree.add(node)
+			yield node
+		self.dirs = tree.finish()
+
+	def sorted(self) -> Generator[Node, Optional[str], None]:
+		"""Iterates on the nodes in path order. Sorted pending nodes are
+		streamed, while other snapshots are read and their paths sorted.
+		Sending a directory path skips the nodes it contains, returning the
+		next node after them."""
+		skip: Optional[str] = None
+		if self.pending is not None and self.isSorted:
+			previous: Optional[str] = None
+			stream = cast(Generator[Node, Optional[str], None], self.stream())
+			sent: Optional[str] = None
+			while True:
+				try:
+					# Seekable nodes skip the directory themselves
+					node = stream.send(sent) if sent and self.seekable else next(stream)
+				except StopIteration:
+					return
+				path = node.path
+				if previous is not None and path <= previous:
+					raise RuntimeError(f"Node out of order: {path} after {previous}")
+				previous = path
+				sent = None
+				if skip is None or not path.startswith(skip):
+					sent = yield node
+					skip = f"{sent}/" if sent is not None else None
+		else:
+			nodes = self.nodes
+			paths = sorted(nodes)
+			i: int = 0
+			while i < len(paths):
+				skip = yield nodes[paths[i]]
+				# Paths in the directory are all between `DIR/` and `DIR0`
+				i = i + 1 if skip is None else bisect_left(paths, f"{skip}0", i + 1)
 
 	def extend(self, nodes: Iterable[Node]) -> "Snapshot":
+		registered = self.nodes
 		for node in nodes:
-			if (path := node.path) in self.nodes:
+			if (path := node.path) in registered:
 				raise RuntimeError(f"Node already registered: {path}")
-			self.nodes[path] = node
+			registered[path] = node
 		return self
 
 	def __iter__(self) -> Iterator[Node]:
-		yield from self.nodes.values()
+		yield from self.nodes.nodes()
 
 	def toPrimitive(self) -> dict[str, Any]:
-		return {"nodes": {k: v.toPrimitive() for k, v in self.nodes.items()}}
+		res: dict[str, Any] = {
+			"algorithm": self.algorithm,
+			"nodes": {_.path: _.toPrimitive() for _ in self},
+		}
+		res.update(self.footer())
+		return res
+
+	def footer(self) -> dict[str, Any]:
+		"""Returns the directory hashes and block signatures, when known,
+		which snapshot files write after the nodes."""
+		res: dict[str, Any] = {}
+		if self.dirs is not None:
+			res["dirs"] = self.dirs
+		if self.blocks is not None:
+			res["blocks"] = self.blocks
+			res["blockSize"] = self.blockSize
+		return res
 
 
 class NodePredicates:
@@ -0,0 +1,396 @@
+from typing import IO, Iterable, Iterator, NamedTuple, Optional, Union
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import monotonic
+import os
+import re
+import shutil
+import stat
+import sys
+from .backup import Op, OpData, OpLn, OpMeta, OpMv, OpRm
+from .copy import copyFile
+from .logging import metric
+
+# --
+# ## Patch
+#
+# Applies the scripts written by `sink backup` (see `backup.iscript`) to a
+# target directory. Scripts name the files of the source, whose data is
+# copied to the same relative path in the target. Removals are applied
+# first, deepest paths first, followed by the moves, links, data and
+# metadata, top-down. Data is copied by a pool of threads (see `copy`),
+# metadata changes are applied once the data is written, and the files and
+# directories changed by the patch are synced every `CHECKPOINT` bytes
+# rather than after each file.
+
+# The number of bytes copied between syncs
+CHECKPOINT: int = 256 * 1024 * 1024
+
+RE_RANGE = re.compile(r"^(?P<offset>\d+) (?P<length>\d+) (?P<path>.+)$")
+RE_ATTR = re.compile(r" (?P<name>mode|uid|gid|ctime|mtime)=(?P<value>[^ ]+)$")
+
+
+class Patch(NamedTuple):
+	"""The operations of a script, with paths relative to its root."""
+
+	root: Optional[str]
+	removals: list[OpRm]
+	moves: list[OpMv]
+	links: list[OpLn]
+	data: list[OpData]
+	metas: list[OpMeta]
+
+	@property
+	def count(self) -> int:
+		return (
+			len(self.removals)
+			+ len(self.moves)
+			+ len(self.links)
+			+ len(self.data)
+			+ len(self.metas)
+		)
+
+
+def checked(path: str) -> str:
+	"""Returns the path when it is relative and stays within its root,
+	raising a `ValueError` otherwise."""
+	if not path or path.startswith("/") or ".." in path.split("/"):
+		raise ValueError(f"Path is outside of the root: {path!r}")
+	return path
+
+
+def parseMeta(line: str) -> OpMeta:
+	"""Parses the path and attributes of a `META` line, attributes being
+	read from its end so that paths may contain spaces."""
+	attrs: dict[str, str] = {}
+	while m := RE_ATTR.search(line):
+		attrs[m.group("name")] = m.group("value")
+		line = line[: m.start()]
+	return OpMeta(
+		line,
+		mode=int(attrs["mode"]) if "mode" in attrs else None,
+		uid=int(attrs["uid"]) if "uid" in attrs else None,
+		gid=int(attrs["gid"]) if "gid" in attrs else None,
+		ctime=float(attrs["ctime"]) if "ctime" in attrs else None,
+		mtime=float(attrs["mtime"]) if "mtime" in attrs else None,
+	)
+
+
+def iparse(
+	lines: Iterable[str], root: Optional[str] = None
+) -> Iterator[Union[Op, str]]:
+	"""Parses the lines of a script, yielding its operations, and its root
+	when given by a `# ROOT` comment. Link targets can't contain spaces,
+	as the path of the link can, and the paths of moves are told apart by
+	the `root`, which defaults to the one of the script."""
+	for i, line in enumerate(lines):
+		line = line.rstrip("\n")
+		if line.startswith("# ROOT "):
+			root = root or line[7:]
+			yield line[7:]
+		elif not line or line.startswith("#"):
+			continue
+		elif (command := line.partition(" "))[0] == "RM":
+			yield OpRm(command[2])
+		elif command[0] == "DATA":
+			yield OpData(command[2])
+		elif command[0] == "RANGE" and (m := RE_RANGE.match(command[2])):
+			yield OpData(
+				m.group("path"), int(m.group("offset")), int(m.group("length"))
+			)
+		elif command[0] == "META":
+			yield parseMeta(command[2])
+		elif command[0] == "LN":
+			path, _, origin = command[2].rpartition(" ")
+			yield OpLn(path, origin)
+		elif command[0] == "MV":
+			rest = command[2]
+			prefix = f" {root.rstrip('/')}/" if root else None
+			if prefix and (j := rest.find(prefix, 1)) != -1:
+				yield OpMv(rest[:j], rest[j + 1 :])
+			else:
+				path, _, origin = rest.rpartition(" ")
+				yield OpMv(path, origin)
+		else:
+			raise ValueError(
+				f"Unsupported script command at line {i + 1}: {line!r}"
+			)
+
+
+def parse(lines: Iterable[str], root: Optional[str] = None) -> Patch:
+	"""Parses the script, making its paths relative to the `root`, which
+	defaults to the one the script gives."""
+	res = Patch(root, [], [], [], [], [])
+	prefix: Optional[str] = f"{root.rstrip('/')}/" if root else None
+	for op in iparse(lines, root):
+		if isinstance(op, str):
+			if res.root is None:
+				res = res._replace(root=op)
+				prefix = f"{op.rstrip('/')}/"
+			continue
+		if prefix:
+			if not op.path.startswith(prefix):
+				raise ValueError(
+					f"Path is outside of the root {res.root}: {op.path}"
+				)
+			op = op._replace(path=op.path[len(prefix) :])
+			if isinstance(op, OpMv):
+				if not op.origin.startswith(prefix):
+					raise ValueError(
+						f"Path is outside of the root {res.root}: {op.origin}"
+					)
+				op = op._replace(origin=op.origin[len(prefix) :])
+		checked(op.path)
+		if isinstance(op, OpMv):
+			checked(op.origin)
+		if isinstance(op, OpRm):
+			res.removals.append(op)
+		elif isinstance(op, OpMv):
+			res.moves.append(op)
+		elif isinstance(op, OpLn):
+			res.links.append(op)
+		elif isinstance(op, OpData):
+			res.data.append(op)
+		else:
+			res.metas.append(op)
+	# Removals go bottom-up, and the rest top-down
+	res.removals.sort(key=lambda _: _.path, reverse=True)
+	for ops in (res.moves, res.links, res.data, res.metas):
+		ops.sort(key=lambda _: _.path)
+	return res
+
+
+class Patcher:
+	"""Applies a patch to the `target` directory, reading data from the
+	`source` one, which defaults to the root of the patch."""
+
+	def __init__(
+		self,
+		target: str,
+		source: Optional[str] = None,
+		*,
+		jobs: int = 4,
+		dryRun: bool = False,
+		sync: bool = True,
+	):
+		self.target: str = target
+		self.source: Optional[str] = source
+		self.jobs: int = max(1, jobs)
+		self.dryRun: bool = dryRun
+		self.sync: bool = sync
+		self.ops: int = 0
+		self.bytes: int = 0
+		self.elapsed: float = 0.0
+		# Bytes copied, files written and directories changed since the
+		# last sync, relative to the target.
+		self.pending: int = 0
+		self.files: set[str] = set()
+		self.parents: set[str] = set()
+		self.applied = metric("patch.ops")
+		self.copied = metric("patch.bytes")
+
+	def apply(self, patch: Patch, log: Optional[IO[str]] = None) -> int:
+		"""Applies the patch, logging the operations to `log` when given,
+		and returns the number of applied operations."""
+		started = monotonic()
+		source = self.source or patch.root
+		# Paths are checked before any change, as scripts may come from
+		# anywhere and the patch may not be parsed from one.
+		for ops in (
+			patch.removals,
+			patch.moves,
+			patch.links,
+			patch.data,
+			patch.metas,
+		):
+			for op in ops:
+				checked(op.path)
+		for op in patch.moves:
+			checked(op.origin)
+		# Moves whose origin is missing copy the data instead, which is
+		# known before any change is made.
+		moves: list[OpMv] = []
+		data: list[OpData] = patch.data
+		for op in patch.moves:
+			if os.path.lexists(os.path.join(self.target, op.origin)):
+				moves.append(op)
+			else:
+				sys.stderr.write(
+					f"WRN Origin of {op.path} is missing, copying its data: {op.origin}\n"
+				)
+				data = data + [OpData(op.path)]
+		if len(moves) != len(patch.moves):
+			data = sorted(data, key=lambda _: _.path)
+		if data and not source:
+			raise ValueError("The patch has no root to read data from")
+		for op in patch.removals:
+			self.log(log, "RM", op.path)
+			if not self.dryRun:
+				self.remove(op.path)
+		# Files are moved aside first, so that no move depends on another
+		staged: list[tuple[str, OpMv]] = []
+		for i, op in enumerate(moves):
+			self.log(log, "MV", op.path, op.origin)
+			if not self.dryRun:
+				temp = os.path.join(self.target, f".sink-mv-{i}")
+				os.rename(os.path.join(self.target, op.origin), temp)
+				self.changed(op.origin)
+				staged.append((temp, op))
+		for temp, op in staged:
+			self.makedirs(op.path)
+			os.replace(temp, os.path.join(self.target, op.path))
+			self.changed(op.path)
+			self.prune(op.origin)
+		for op in patch.links:
+			self.log(log, "LN", op.path, op.origin)
+			if not self.dryRun:
+				self.link(op.path, op.origin)
+		with ThreadPoolExecutor(self.jobs) as pool:
+			copies: list[Future[int]] = []
+			created: set[str] = set()
+			for op in data:
+				if op.offset is None:
+					self.log(log, "DATA", op.path)
+				else:
+					self.log(log, "RANGE", str(op.offset), str(op.length), op.path)
+				if self.dryRun:
+					continue
+				if (parent := os.path.dirname(op.path)) not in created:
+					self.makedirs(op.path)
+					created.add(parent)
+				copies.append(
+					pool.submit(
+						copyFile,
+						os.path.join(source or "", op.path),
+						os.path.join(self.target, op.path),
+						op.offset,
+						op.length,
+					)
+				)
+			for op, future in zip(data, copies):
+				self.written(future.result(), op.path)
+		# Metadata is set last, as writing data changes the times
+		for op in patch.metas:
+			self.log(log, "META", op.path)
+			if not self.dryRun:
+				self.meta(op)
+		self.checkpoint(True)
+		self.ops += patch.count
+		self.applied.add(patch.count)
+		self.elapsed += monotonic() - started
+		return patch.count
+
+	def log(self, log: Optional[IO[str]], *args: str) -> None:
+		if log:
+			log.write(f"{' '.join(args)}\n")
+
+	def written(self, count: int, path: str) -> None:
+		self.changed(path, True)
+		self.bytes += count
+		self.pending += count
+		self.copied.add(count)
+		if self.pending >= CHECKPOINT:
+			self.checkpoint()
+
+	def changed(self, path: str, data: bool = False) -> None:
+		"""Notes that the entry of the path changed, along with its data
+		when `data` is set, to be synced at the next checkpoint."""
+		if self.sync:
+			self.parents.add(os.path.dirname(path))
+			if data:
+				self.files.add(path)
+
+	def checkpoint(self, force: bool = False) -> None:
+		"""Flushes the files written and the directories changed since the
+		last checkpoint to disk, when needed."""
+		if self.sync and not self.dryRun and (self.pending or force):
+			for path in sorted(self.files):
+				self.fsync(path)
+			# Directories go bottom-up, after the entries they contain
+			for path in sorted(self.parents, reverse=True):
+				self.fsync(path)
+		self.pending = 0
+		self.files.clear()
+		self.parents.clear()
+
+	def fsync(self, path: str) -> None:
+		try:
+			fd = os.open(os.path.join(self.target, path), os.O_RDONLY)
+		except (FileNotFoundError, PermissionError):
+			return
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+	def makedirs(self, path: str) -> None:
+		"""Creates the missing parent directories of the path, noting the
+		directories they're created in."""
+		parent = os.path.dirname(path)
+		while parent and not os.path.isdir(os.path.join(self.target, parent)):
+			self.changed(parent)
+			parent = os.path.dirname(parent)
+		os.makedirs(os.path.join(self.target, os.path.dirname(path)), exist_ok=True)
+
+	def remove(self, path: str) -> None:
+		"""Removes the given path along with the parent directories it
+		leaves empty."""
+		target = os.path.join(self.target, path)
+		try:
+			if os.path.isdir(target) and not os.path.islink(target):
+				shutil.rmtree(target)
+			else:
+				os.unlink(target)
+		except FileNotFoundError:
+			pass
+		self.changed(path)
+		self.prune(path)
+
+	def prune(self, path: str) -> None:
+		"""Removes the parent directories of the path that are empty"""
+		parent = os.path.dirname(path)
+		while parent:
+			try:
+				os.rmdir(os.path.join(self.target, parent))
+			except OSError:
+				break
+			self.changed(parent)
+			parent = os.path.dirname(parent)
+
+	def link(self, path: str, origin: str) -> None:
+		target = os.path.join(self.target, path)
+		self.makedirs(path)
+		if os.path.lexists(target):
+			os.unlink(target)
+		os.symlink(origin, target)
+		self.changed(path)
+
+	def meta(self, op: OpMeta) -> None:
+		"""Sets the ownership, mode and modification time of the path, in
+		this order as changing the owner may reset the mode."""
+		target = os.path.join(self.target, op.path)
+		try:
+			r = os.lstat(target)
+		except FileNotFoundError:
+			return
+		if op.uid is not None or op.gid is not None:
+			os.chown(
+				target,
+				-1 if op.uid is None else op.uid,
+				-1 if op.gid is None else op.gid,
+				follow_symlinks=False,
+			)
+		isLink = stat.S_ISLNK(r.st_mode)
+		if op.mode is not None and not isLink:
+			os.chmod(target, stat.S_IMODE(op.mode))
+		if op.mtime is not None and (
+			not isLink or os.utime in os.supports_follow_symlinks
+		):
+			os.utime(
+				target,
+				ns=(r.st_atime_ns, int(op.mtime * 1_000_000_000)),
+				follow_symlinks=False,
+			)
+		self.changed(op.path, not isLink)
+
+
+# EOF
@@ -1,106 +1,515 @@
-from typing import Iterator
+from typing import Any, Iterator
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from operator import itemgetter
+from queue import Empty
+import multiprocessing
 import os
 import stat
-import hashlib
-import json
-from re import Pattern
+import threading
 from .model import Node, NodeType, NodeMeta, Snapshot
 from typing import Optional
-from .matching import matches
+from .matching import IgnoreScope, PathFilter, TFilter
 from .logging import metric
+from .hashing import Hasher, ALGORITHM, BLOCK_MIN
+from .cache import SignatureCache
+from .gitindex import GitIndex
+from .formats import isSnapshotPath, load
+from .store import SnapshotStore
+
+# Nodes along with the `stat` they were created from
+TStats = Iterator[tuple[Node, Optional[os.stat_result]]]
+
+# Hashers hold a read buffer, so each hashing thread gets its own.
+HASHERS = threading.local()
+# The key of block signatures in the signature cache, by block size
+BLOCKS_KEY: str = "blocks:{}"
+
+# A compact `stat` record sent by walker processes, like
+# `(path, mode, ino, dev, uid, gid, size, mtime, ctime, mtime_ns, ctime_ns)`,
+# or `(path,)` when the entry was removed since it was listed.
+TRecord = tuple[Any, ...]
+
+# A directory to be listed by a walker process, with its ignore scope
+TTask = tuple[str, Optional[IgnoreScope]]
 
 
 class FileSystem:
 	"""An abstraction of key operations involved in snapshotting filesystems"""
 
+	# The number of signatures queued per hashing job, which bounds the
+	# number of nodes held while waiting for the head of the queue.
+	JOB_QUEUE: int = 16
+	# The number of records a walker process gathers before sending them
+	WALK_BATCH: int = 2048
+
 	@classmethod
 	def walk(
 		cls,
 		path: str,
 		*,
-		accepts: Optional[Pattern[str]] = None,
-		rejects: Optional[Pattern[str]] = None,
-		keeps: Optional[Pattern[str]] = None,
+		accepts: Optional[TFilter] = None,
+		rejects: Optional[TFilter] = None,
+		keeps: Optional[TFilter] = None,
+		gitignore: bool = False,
 		followLinks: bool = False,
 	) -> Iterator[str]:
-		"""Does a breadth-first walk of the filesystem, yielding non-directory
-		paths that match the `accepts` and `rejects` filters."""
-		queue: list[str] = [path]
-		while queue:
-			base_path = queue.pop()
-			# TODO: It may be better to use os.walk there...
-			for rel_path in os.listdir(base_path):
-				if not matches(rel_path, accepts=accepts, rejects=rejects, keeps=keeps):
-					pass
-				else:
-					abs_path = f"{base_path}/{rel_path}"
-					is_link = (
-						0  # This is not a link
-						if not os.path.islink(abs_path)
-						else (
-							2  # This is a link to a directory
-							if os.path.isdir(os.readlink(abs_path))
-							else 1
-						)  # This is a link to not a directory
+		"""Does a depth-first walk of the filesystem, yielding non-directory
+		paths that match the `accepts` and `rejects` filters, in sorted order.
+		With `gitignore`, the `.gitignore` files of the walked directories
+		apply as well (see `PathFilter`)."""
+		for entry in cls.entries(
+			path,
+			accepts=accepts,
+			rejects=rejects,
+			keeps=keeps,
+			gitignore=gitignore,
+			followLinks=followLinks,
+		):
+			yield entry.path
+
+	@classmethod
+	def entries(
+		cls,
+		path: str,
+		*,
+		accepts: Optional[TFilter] = None,
+		rejects: Optional[TFilter] = None,
+		keeps: Optional[TFilter] = None,
+		gitignore: bool = False,
+		followLinks: bool = False,
+	) -> Iterator[os.DirEntry[str]]:
+		"""Like `walk`, but yields the `os.scandir` entries. Entries know
+		their type from the directory listing and cache their `stat`
+		result, so that nodes can be created without further system calls.
+
+		Entries are yielded in the lexicographic order of their paths, which
+		is why directories are sorted as if their name ended with a `/`:
+		`a/b` comes after `a-b` and `a.txt`."""
+		# The stack holds either directories to list along with their ignore
+		# scope, or entries to yield.
+		walk = PathFilter(
+			path, accepts=accepts, rejects=rejects, keeps=keeps, gitignore=gitignore
+		)
+		offset: int = len(path) + 1
+		stack: list[tuple[str, Optional[IgnoreScope]] | os.DirEntry[str]] = [
+			(path, walk.scope(""))
+		]
+		while stack:
+			item = stack.pop()
+			if not isinstance(item, tuple):
+				yield item
+				continue
+			directory, scope = item
+			listing: list[
+				tuple[str, tuple[str, Optional[IgnoreScope]] | os.DirEntry[str]]
+			] = []
+			with os.scandir(directory) as entries:
+				for entry in entries:
+					rel = entry.path[offset:]
+					# NOTE: `is_symlink` is known from the listing, `is_dir`
+					# only requires a `stat` call for symlinks. Directories are
+					# filtered before being listed, which prunes them.
+					if entry.is_dir():
+						if (followLinks or not entry.is_symlink()) and walk.allows(
+							rel, True, scope
+						):
+							listing.append(
+								(f"{entry.name}/", (entry.path, walk.scope(rel, scope)))
+							)
+					elif walk.allows(rel, False, scope):
+						listing.append((entry.name, entry))
+			listing.sort(key=lambda _: _[0])
+			stack.extend(_[1] for _ in reversed(listing))
+
+	@classmethod
+	def nodes(
+		cls,
+		path: str,
+		*,
+		accepts: Optional[TFilter] = None,
+		rejects: Optional[TFilter] = None,
+		keeps: Optional[TFilter] = None,
+		gitignore: bool = False,
+		jobs: int = 1,
+		cache: Optional[SignatureCache] = None,
+		algorithm: str = ALGORITHM,
+		walkers: int = 1,
+		mmapThreshold: Optional[int] = None,
+		blockSize: Optional[int] = None,
+		blocks: Optional[dict[str, str]] = None,
+	) -> Iterator[Node]:
+		"""Walks the given path and produces nodes augmented with metadata and
+		signatures using the given hash `algorithm`. When `jobs` is more
+		than one, signatures are computed by a pool of threads while the
+		walk goes on, the nodes being still yielded in walk order. Signatures
+		are reused from and stored in the given `cache`. With the `git`
+		algorithm, the signatures of the files that are unchanged since they
+		were staged are taken from the git index. Files of at least
+		`mmapThreshold` bytes are memory-mapped to be hashed. Given `blocks`,
+		the block signatures of large files, for blocks of `blockSize`, are
+		added to it in the same pass, or taken from the cache."""
+		stats = cls.stats(
+			path,
+			accepts=accepts,
+			rejects=rejects,
+			keeps=keeps,
+			gitignore=gitignore,
+			walkers=walkers,
+		)
+		if algorithm == "git" and (index := GitIndex.Open(path)):
+			stats = cls.indexed(stats, index)
+		if cache:
+			stats = cls.cached(stats, cache, algorithm, blockSize, blocks)
+		if jobs <= 1:
+			for node, r in stats:
+				size = cls.blockSizeOf(node, blockSize, blocks)
+				if size or (node.type == NodeType.FILE and node.sig is None):
+					cls.assign(
+						node,
+						r,
+						cls.signatures(
+							f"{path}/{node.path}", algorithm, mmapThreshold, size
+						),
+						cache,
+						algorithm,
+						size,
+						blocks,
 					)
-					is_dir = (
-						True
-						if is_link == 2
-						else False
-						if is_link
-						else os.path.isdir(abs_path)
+				yield node
+		else:
+			yield from cls.hashed(
+				path,
+				stats,
+				jobs,
+				cache,
+				algorithm,
+				mmapThreshold,
+				blockSize,
+				blocks,
+			)
+
+	@classmethod
+	def indexed(cls, stats: TStats, index: GitIndex) -> TStats:
+		"""Assigns the blob ids of the files unchanged in the git `index`
+		as their signatures."""
+		hits = metric("snap.index.hit")
+		for node, r in stats:
+			if node.type == NodeType.FILE and r and node.sig is None:
+				if sig := index.signature(node.path, r):
+					node.sig = sig
+					hits.inc()
+			yield node, r
+
+	@classmethod
+	def cached(
+		cls,
+		stats: TStats,
+		cache: SignatureCache,
+		algorithm: str = ALGORITHM,
+		blockSize: Optional[int] = None,
+		blocks: Optional[dict[str, str]] = None,
+	) -> TStats:
+		"""Assigns the signatures found in the `cache` to the given nodes
+		that don't have one yet, and adds their cached block signatures to
+		`blocks` when given."""
+		for node, r in stats:
+			if node.type == NodeType.FILE and r:
+				if node.sig is None:
+					node.sig = cache.get(r, algorithm)
+				if blocks is not None and cls.blockSizeOf(node, blockSize, blocks):
+					if found := cache.get(r, BLOCKS_KEY.format(blockSize)):
+						blocks[node.path] = found
+			yield node, r
+
+	@classmethod
+	def blockSizeOf(
+		cls, node: Node, blockSize: Optional[int], blocks: Optional[dict[str, str]]
+	) -> Optional[int]:
+		"""Returns the `blockSize` when the node is a file large enough to be
+		given block signatures, which are not in `blocks` yet."""
+		return (
+			blockSize
+			if blocks is not None
+			and blockSize
+			and node.type == NodeType.FILE
+			and node.meta
+			and node.meta.size >= blockSize * BLOCK_MIN
+			and node.path not in blocks
+			else None
+		)
+
+	@classmethod
+	def assign(
+		cls,
+		node: Node,
+		r: Optional[os.stat_result],
+		signatures: tuple[str, Optional[str]],
+		cache: Optional[SignatureCache],
+		algorithm: str,
+		blockSize: Optional[int],
+		blocks: Optional[dict[str, str]],
+	) -> None:
+		"""Assigns the signature and block signatures of a file to its node
+		and to `blocks`, when missing, caching them."""
+		sig, found = signatures
+		if node.sig is None:
+			node.sig = sig
+			if cache and r:
+				cache.set(r, algorithm, sig)
+		if found is not None and blocks is not None:
+			blocks[node.path] = found
+			if cache and r:
+				cache.set(r, BLOCKS_KEY.format(blockSize), found)
+
+	@classmethod
+	def hashed(
+		cls,
+		base: str,
+		stats: TStats,
+		jobs: int,
+		cache: Optional[SignatureCache] = None,
+		algorithm: str = ALGORITHM,
+		mmapThreshold: Optional[int] = None,
+		blockSize: Optional[int] = None,
+		blocks: Optional[dict[str, str]] = None,
+	) -> Iterator[Node]:
+		"""Assigns signatures to the given nodes using a pool of `jobs`
+		threads, yielding the nodes in the order they were given. Block
+		signatures are computed along, as in `nodes`."""
+		pending: deque[
+			tuple[
+				Node,
+				Optional[os.stat_result],
+				Optional[Future[tuple[str, Optional[str]]]],
+				Optional[int],
+			]
+		] = deque()
+		limit: int = jobs * cls.JOB_QUEUE
+		pool = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="sink-hash")
+
+		def resolve() -> Node:
+			head, r, sig, size = pending.popleft()
+			if sig:
+				cls.assign(head, r, sig.result(), cache, algorithm, size, blocks)
+			return head
+
+		try:
+			for node, r in stats:
+				size = cls.blockSizeOf(node, blockSize, blocks)
+				pending.append(
+					(
+						node,
+						r,
+						pool.submit(
+							cls.signatures,
+							f"{base}/{node.path}",
+							algorithm,
+							mmapThreshold,
+							size,
+						)
+						if size or (node.type == NodeType.FILE and node.sig is None)
+						else None,
+						size,
 					)
-					if is_dir:
-						if not is_link or followLinks:
-							queue.append(abs_path)
-					else:
-						# TODO: We should maybe filter out symlinks?
-						yield abs_path
+				)
+				# We yield the head of the queue as soon as it's ready, and
+				# block on it when the queue is full.
+				while pending and (
+					len(pending) >= limit
+					or (sig := pending[0][2]) is None
+					or sig.done()
+				):
+					yield resolve()
+			while pending:
+				yield resolve()
+		finally:
+			pool.shutdown(wait=True, cancel_futures=True)
 
 	@classmethod
-	def nodes(
+	def inodes(
 		cls,
 		path: str,
 		*,
-		accepts: Optional[Pattern[str]] = None,
-		rejects: Optional[Pattern[str]] = None,
-		keeps: Optional[Pattern[str]] = None,
+		accepts: Optional[TFilter] = None,
+		rejects: Optional[TFilter] = None,
+		keeps: Optional[TFilter] = None,
+		gitignore: bool = False,
+		walkers: int = 1,
 	) -> Iterator[Node]:
-		"""Walks the given path and produces nodes augmented with metadata"""
+		"""Walks the given path and produces nodes augmented with metadata,
+		but without signatures."""
+		for node, _ in cls.stats(
+			path,
+			accepts=accepts,
+			rejects=rejects,
+			keeps=keeps,
+			gitignore=gitignore,
+			walkers=walkers,
+		):
+			yield node
+
+	@classmethod
+	def stats(
+		cls,
+		path: str,
+		*,
+		accepts: Optional[TFilter] = None,
+		rejects: Optional[TFilter] = None,
+		keeps: Optional[TFilter] = None,
+		gitignore: bool = False,
+		walkers: int = 1,
+	) -> TStats:
+		"""Like `inodes`, but also yields the `stat` result of each node. When
+		`walkers` is more than one, the walk is partitioned between as many
+		processes (see `partitioned`)."""
 		offset = len(path) + 1
 		snap_paths = metric("snap.paths")
-		for path in cls.walk(
-			path, accepts=accepts, rejects=rejects, keeps=keeps, followLinks=False
-		):
-			if os.path.exists(path):
-				meta = cls.meta(path)
-				node_type = (
-					NodeType.FILE
-					if stat.S_ISREG(meta.mode)
-					else (
-						NodeType.DIRECTORY
-						if stat.S_ISREG(meta.mode)
-						else (
-							NodeType.LINK
-							if stat.S_ISLNK(meta.mode)
-							else NodeType.SPECIAL
-						)
+		if walkers > 1:
+			for record in cls.partitioned(
+				path,
+				accepts=accepts,
+				rejects=rejects,
+				keeps=keeps,
+				gitignore=gitignore,
+				walkers=walkers,
+			):
+				if len(record) == 1:
+					yield Node(record[0], NodeType.NULL, None, None), None
+				else:
+					snap_paths.inc()
+					r = cls.statOf(record)
+					yield (
+						Node(record[0], cls.typeOf(r.st_mode), cls.metaOf(r), None),
+						r,
 					)
-				)
+			return
+		for entry in cls.entries(
+			path,
+			accepts=accepts,
+			rejects=rejects,
+			keeps=keeps,
+			gitignore=gitignore,
+			followLinks=False,
+		):
+			try:
+				r = entry.stat(follow_symlinks=False)
+			except FileNotFoundError:
+				# The entry was removed since it was listed
+				yield Node(entry.path[offset:], NodeType.NULL, None, None), None
+			else:
 				snap_paths.inc()
-				yield Node(
-					path[offset:],
-					node_type,
-					meta,
-					cls.signature(path) if node_type == NodeType.FILE else None,
+				yield (
+					Node(
+						entry.path[offset:], cls.typeOf(r.st_mode), cls.metaOf(r), None
+					),
+					r,
 				)
-			else:
-				yield Node(path, NodeType.NULL, None, None)
+
+	@classmethod
+	def partitioned(
+		cls,
+		path: str,
+		*,
+		accepts: Optional[TFilter] = None,
+		rejects: Optional[TFilter] = None,
+		keeps: Optional[TFilter] = None,
+		gitignore: bool = False,
+		walkers: int = 2,
+	) -> Iterator[TRecord]:
+		"""Walks the given path with a pool of `walkers` processes sharing a
+		queue of directories. Each walker lists directories until it has a
+		batch of `WALK_BATCH` records, and sends them back along with the
+		directories it has not listed yet, which are queued again for any
+		idle walker to pick up. Records are yielded sorted by path once the
+		walk is complete, like `entries` would."""
+		context = multiprocessing.get_context()
+		tasks: multiprocessing.Queue[Optional[TTask]] = context.Queue()
+		results: multiprocessing.Queue[
+			tuple[list[TRecord], list[TTask], Optional[BaseException]]
+		] = context.Queue()
+		walk = PathFilter(
+			path, accepts=accepts, rejects=rejects, keeps=keeps, gitignore=gitignore
+		)
+		pool = [
+			context.Process(
+				target=walkPartition,
+				args=(tasks, results, walk, cls.WALK_BATCH),
+				daemon=True,
+			)
+			for _ in range(walkers)
+		]
+		for process in pool:
+			process.start()
+		records: list[TRecord] = []
+		completed: bool = False
+		try:
+			tasks.put((path, walk.scope("")))
+			pending: int = 1
+			while pending:
+				try:
+					batch, remaining, error = results.get(timeout=1.0)
+				except Empty:
+					if not all(_.is_alive() for _ in pool):
+						raise RuntimeError("A walker process exited unexpectedly")
+					continue
+				if error:
+					raise error
+				pending += len(remaining) - 1
+				records.extend(batch)
+				for directory in remaining:
+					tasks.put(directory)
+			completed = True
+		finally:
+			# NOTE: Walkers may have results left to send on failure, in which
+			# case they wouldn't exit, so they're terminated.
+			for process in pool:
+				if completed:
+					tasks.put(None)
+				else:
+					process.terminate()
+			for process in pool:
+				process.join()
+		records.sort(key=itemgetter(0))
+		yield from records
+
+	@classmethod
+	def statOf(cls, record: TRecord) -> os.stat_result:
+		"""Restores a `stat` result from a walker record"""
+		_, mode, ino, dev, uid, gid, size, mtime, ctime, mtime_ns, ctime_ns = record
+		return os.stat_result(
+			(mode, ino, dev, 1, uid, gid, size, 0, int(mtime), int(ctime)),
+			{
+				"st_atime": 0.0,
+				"st_mtime": mtime,
+				"st_ctime": ctime,
+				"st_atime_ns": 0,
+				"st_mtime_ns": mtime_ns,
+				"st_ctime_ns": ctime_ns,
+			},
+		)
+
+	@classmethod
+	def typeOf(cls, mode: int) -> int:
+		"""Returns the node type for the given `st_mode`"""
+		return (
+			NodeType.FILE
+			if stat.S_ISREG(mode)
+			else (
+				NodeType.DIRECTORY
+				if stat.S_ISDIR(mode)
+				else (NodeType.LINK if stat.S_ISLNK(mode) else NodeType.SPECIAL)
+			)
+		)
 
 	@classmethod
 	def meta(cls, path: str) -> NodeMeta:
 		"""Returns the meta information"""
-		r = os.stat(path)
+		return cls.metaOf(os.stat(path))
+
+	@classmethod
+	def metaOf(cls, r: os.stat_result) -> NodeMeta:
+		"""Returns the meta information from the given `stat` result"""
 		return NodeMeta(
 			mode=r.st_mode,
 			uid=r.st_uid,
@@ -111,30 +520,164 @@ class FileSystem:
 		)
 
 	@classmethod
-	def signature(cls, path: str) -> str:
+	def signature(
+		cls, path: str, algorithm: str = ALGORITHM, mmapThreshold: Optional[int] = None
+	) -> str:
 		"""Returns the signature of the file contents, as a string"""
-		h = hashlib.new("sha512_256")
-		with open(path, "rb") as f:
-			h.update(f.read())
-		return h.hexdigest()
+		return cls.hasher(algorithm, mmapThreshold).digest(path)
+
+	@classmethod
+	def signatures(
+		cls,
+		path: str,
+		algorithm: str = ALGORITHM,
+		mmapThreshold: Optional[int] = None,
+		blockSize: Optional[int] = None,
+	) -> tuple[str, Optional[str]]:
+		"""Returns the signature of the file contents, along with its block
+		signatures when a `blockSize` is given, reading the file once."""
+		hasher = cls.hasher(algorithm, mmapThreshold)
+		if blockSize:
+			return hasher.digestBlocks(path, blockSize)
+		return hasher.digest(path), None
+
+	@classmethod
+	def hasher(cls, algorithm: str, mmapThreshold: Optional[int] = None) -> Hasher:
+		"""Returns the hasher of the current thread for the algorithm, which
+		memory-maps files of at least `mmapThreshold` bytes."""
+		if not (hashers := getattr(HASHERS, "hashers", None)):
+			hashers = HASHERS.hashers = {}
+		if not (hasher := hashers.get((algorithm, mmapThreshold))):
+			hasher = hashers[(algorithm, mmapThreshold)] = Hasher(
+				algorithm, mmapThreshold=mmapThreshold
+			)
+		return hasher
+
+
+def walkPartition(
+	tasks: "multiprocessing.Queue[Optional[TTask]]",
+	results: "multiprocessing.Queue[tuple[list[TRecord], list[TTask], Optional[BaseException]]]",
+	walk: PathFilter,
+	batch: int,
+) -> None:
+	"""The loop of a walker process (see `FileSystem.partitioned`), which
+	lists directories from `tasks` until it gets `None`."""
+	offset: int = len(walk.root) + 1
+	while (task := tasks.get()) is not None:
+		records: list[TRecord] = []
+		stack: list[TTask] = [task]
+		try:
+			while stack and len(records) < batch:
+				directory, scope = stack.pop()
+				with os.scandir(directory) as entries:
+					for entry in entries:
+						rel = entry.path[offset:]
+						if entry.is_dir():
+							if not entry.is_symlink() and walk.allows(rel, True, scope):
+								stack.append((entry.path, walk.scope(rel, scope)))
+							continue
+						elif not walk.allows(rel, False, scope):
+							continue
+						try:
+							r = entry.stat(follow_symlinks=False)
+						except FileNotFoundError:
+							records.append((rel,))
+						else:
+							records.append(
+								(
+									rel,
+									r.st_mode,
+									r.st_ino,
+									r.st_dev,
+									r.st_uid,
+									r.st_gid,
+									r.st_size,
+									r.st_mtime,
+									r.st_ctime,
+									r.st_mtime_ns,
+									r.st_ctime_ns,
+								)
+							)
+		except BaseException as e:
+			results.put(([], [], e))
+		else:
+			results.put((records, stack, None))
 
 
 def snapshot(
 	path: str,
 	*,
-	accepts: Optional[Pattern[str]] = None,
-	rejects: Optional[Pattern[str]] = None,
-	keeps: Optional[Pattern[str]] = None,
+	accepts: Optional[TFilter] = None,
+	rejects: Optional[TFilter] = None,
+	keeps: Optional[TFilter] = None,
+	gitignore: bool = False,
+	jobs: int = 1,
+	cache: Optional[SignatureCache] = None,
+	algorithm: str = ALGORITHM,
+	signatures: bool = True,
+	stream: bool = False,
+	walkers: int = 1,
+	exclude: Optional[str] = None,
+	store: Optional[SnapshotStore] = None,
+	blocks: Optional[int] = None,
+	mmapThreshold: Optional[int] = None,
 ) -> Snapshot:
-	"""Creates a snapshot for the given `path`, given the `accepts` and `rejects`
-	filters."""
-	if path.endswith(".json"):
-		with open(path, "rt") as f:
-			return Snapshot.FromPrimitive(json.load(f))
+	"""Creates a snapshot for the given `path`, given the `accepts` and
+	`rejects` filters and the `.gitignore` files when `gitignore` is set,
+	walking with `walkers` processes, hashing files with `jobs` threads
+	using the given `algorithm` and reusing signatures from the `cache`.
+	When `signatures` is false, files are not hashed, and signatures can be
+	computed later on from the snapshot's `root`, otherwise directory
+	hashes are computed as well. When `stream` is set, nodes are only
+	produced as the snapshot is read (see `Snapshot.Stream`). The `exclude`
+	path, relative to `path`, is left out of the snapshot. Given a `store`,
+	a `ROOT@GENERATION` path is rebuilt from the stored generation. With a
+	`blocks` size, large files are given block signatures as well. Files of
+	at least `mmapThreshold` bytes are memory-mapped to be hashed."""
+	if store and (generation := store.reference(path)) is not None:
+		res = store.load(generation)
+	elif isSnapshotPath(path):
+		res = load(path)
 	else:
-		return Snapshot(
-			FileSystem.nodes(path, accepts=accepts, rejects=rejects, keeps=keeps)
+		# Block signatures are added as the nodes are hashed
+		found: Optional[dict[str, str]] = {} if blocks and signatures else None
+		nodes = (
+			FileSystem.nodes(
+				path,
+				accepts=accepts,
+				rejects=rejects,
+				keeps=keeps,
+				gitignore=gitignore,
+				jobs=jobs,
+				cache=cache,
+				algorithm=algorithm,
+				walkers=walkers,
+				mmapThreshold=mmapThreshold,
+				blockSize=blocks,
+				blocks=found,
+			)
+			if signatures
+			else FileSystem.inodes(
+				path,
+				accepts=accepts,
+				rejects=rejects,
+				keeps=keeps,
+				gitignore=gitignore,
+				walkers=walkers,
+			)
+		)
+		if exclude:
+			nodes = (_ for _ in nodes if _.path != exclude)
+		res = Snapshot.Stream(
+			nodes,
+			algorithm=algorithm,
+			root=path,
+			isSorted=True,
+			hashDirs=signatures,
 		)
+		if found is not None:
+			res.blocks, res.blockSize = found, blocks
+	return res if stream else res.read()
 
 
 # EOF
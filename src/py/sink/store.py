@@ -0,0 +1,431 @@
+from typing import Any, Iterable, Iterator, Optional
+from contextlib import contextmanager
+from pathlib import Path
+from time import time
+import hashlib
+import json
+import os
+import sqlite3
+from .model import Node, NodeMeta, Snapshot
+
+# --
+# ## Snapshot store
+#
+# The store keeps the history of the snapshots of each root directory, as
+# generations. Node records (type, meta and signature) are keyed by their
+# hash and stored once, so that a generation only adds the records that
+# changed, and an index of its paths to their records.
+#
+# Generations are either checkpoints, whose index lists all their paths, or
+# deltas, whose index only lists the paths that changed since their parent,
+# removed paths having no record. A generation is rebuilt by taking the
+# latest entry of each path from its last checkpoint onwards, and a new
+# checkpoint is made every `CHECKPOINT` generations, or when a delta would
+# be too large, to keep that short. Indexes are sorted by path, so that
+# generations can be streamed as sorted snapshots.
+
+# The version of the schema, an older store is discarded.
+VERSION: int = 3
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS roots (
+	id INTEGER PRIMARY KEY,
+	path TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS generations (
+	id INTEGER PRIMARY KEY,
+	root INTEGER NOT NULL REFERENCES roots (id),
+	created REAL NOT NULL,
+	algorithm TEXT NOT NULL,
+	count INTEGER NOT NULL DEFAULT 0,
+	sorted INTEGER NOT NULL DEFAULT 1,
+	dirs TEXT,
+	blocks TEXT,
+	blockSize INTEGER,
+	parent INTEGER REFERENCES generations (id),
+	base INTEGER,
+	depth INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS generations_root ON generations (root, id);
+CREATE TABLE IF NOT EXISTS records (
+	hash BLOB PRIMARY KEY,
+	type INTEGER NOT NULL,
+	mode INTEGER,
+	uid INTEGER,
+	gid INTEGER,
+	size INTEGER,
+	ctime REAL,
+	mtime REAL,
+	sig TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS entries (
+	generation INTEGER NOT NULL,
+	path BLOB NOT NULL,
+	hash BLOB,
+	PRIMARY KEY (generation, path)
+) WITHOUT ROWID;
+"""
+# The full index of a generation is gathered in a temporary table before
+# being compared with its parent's.
+PENDING = """CREATE TEMP TABLE IF NOT EXISTS pending (path BLOB PRIMARY KEY, hash BLOB NOT NULL) WITHOUT ROWID;
+CREATE TEMP TABLE IF NOT EXISTS previous (path BLOB PRIMARY KEY, hash BLOB NOT NULL) WITHOUT ROWID;
+DELETE FROM pending;
+DELETE FROM previous;
+"""
+
+# A record, as stored in the `records` table
+TRecord = tuple[
+	bytes,
+	int,
+	Optional[int],
+	Optional[int],
+	Optional[int],
+	Optional[int],
+	Optional[float],
+	Optional[float],
+	Optional[str],
+]
+
+
+def record(node: Node) -> TRecord:
+	"""Returns the record for the given node, keyed by the hash of its
+	type, meta and signature."""
+	meta = node.meta
+	values: tuple[Any, ...] = (
+		(meta.mode, meta.uid, meta.gid, meta.size, meta.ctime, meta.mtime)
+		if meta
+		else (None, None, None, None, None, None)
+	)
+	key = hashlib.blake2b(
+		repr((node.type, values, node.sig)).encode("utf8", "surrogateescape"),
+		digest_size=16,
+	).digest()
+	return (key, node.type, *values, node.sig)
+
+
+class GenerationWriter:
+	"""Adds a new generation to the store, one node at a time. Nothing is
+	visible in the store until the generation is closed, at which point it
+	is stored as a delta of the latest generation of its root when possible."""
+
+	# The number of pending nodes after which they are written
+	BATCH: int = 10_000
+
+	def __init__(self, store: "SnapshotStore", root: str, algorithm: str):
+		self.store: "SnapshotStore" = store
+		self.db: sqlite3.Connection = store.db
+		self.root: str = root
+		self.parent: Optional[int] = store.latest(root)
+		self.db.executescript(PENDING)
+		self.generation: int = self.db.execute(
+			"INSERT INTO generations (root, created, algorithm) VALUES (?, ?, ?)",
+			(store.rootOf(root), time(), algorithm),
+		).lastrowid or 0
+		self.records: list[TRecord] = []
+		self.entries: list[tuple[bytes, bytes]] = []
+		self.count: int = 0
+		# The number of records that were not in the store yet
+		self.added: int = 0
+		# The number of index entries written, which is the number of
+		# changes for a delta.
+		self.written: int = 0
+		# Paths that are not valid UTF-8 don't sort the same as bytes
+		self.sorted: bool = True
+
+	def add(self, node: Node) -> None:
+		r = record(node)
+		try:
+			path = node.path.encode("utf8")
+		except UnicodeEncodeError:
+			path = node.path.encode("utf8", "surrogateescape")
+			self.sorted = False
+		self.records.append(r)
+		self.entries.append((path, r[0]))
+		self.count += 1
+		if len(self.entries) >= self.BATCH:
+			self.flush()
+
+	def stream(self, nodes: Iterable[Node]) -> Iterator[Node]:
+		"""Adds the given nodes as they are iterated on"""
+		for node in nodes:
+			self.add(node)
+			yield node
+
+	def flush(self) -> None:
+		changes = self.db.total_changes
+		self.db.executemany(
+			"INSERT OR IGNORE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+			self.records,
+		)
+		self.added += self.db.total_changes - changes
+		self.db.executemany("INSERT INTO pending VALUES (?, ?)", self.entries)
+		self.records.clear()
+		self.entries.clear()
+
+	def close(
+		self,
+		dirs: Optional[dict[str, str]] = None,
+		blocks: Optional[dict[str, str]] = None,
+		blockSize: Optional[int] = None,
+	) -> int:
+		"""Commits the generation with the given directory hashes and block
+		signatures, returning its identifier."""
+		self.flush()
+		parent, depth, base = self.parent, 0, self.generation
+		if parent is not None:
+			parent_depth, parent_base = self.db.execute(
+				"SELECT depth, base FROM generations WHERE id=?", (parent,)
+			).fetchone()
+			if parent_depth + 1 < self.store.CHECKPOINT:
+				depth, base = parent_depth + 1, parent_base
+		if depth:
+			# We rebuild the parent's index and write the paths that were
+			# added or changed, and the ones that were removed.
+			self.db.execute(
+				f"INSERT INTO previous {self.store.index(parent)}", (parent,)
+			)
+			changes = self.db.execute(
+				"SELECT COUNT(*) FROM pending n LEFT JOIN previous p ON p.path=n.path WHERE p.hash IS NOT n.hash"
+			).fetchone()[0] + self.db.execute(
+				"SELECT COUNT(*) FROM previous p WHERE p.path NOT IN (SELECT path FROM pending)"
+			).fetchone()[0]
+			# A large delta is not worth it
+			if changes > self.count // 2:
+				depth, base = 0, self.generation
+		if depth:
+			self.db.execute(
+				"INSERT INTO entries SELECT ?, n.path, n.hash FROM pending n LEFT JOIN previous p ON p.path=n.path WHERE p.hash IS NOT n.hash",
+				(self.generation,),
+			)
+			self.db.execute(
+				"INSERT INTO entries SELECT ?, p.path, NULL FROM previous p WHERE p.path NOT IN (SELECT path FROM pending)",
+				(self.generation,),
+			)
+		else:
+			self.db.execute(
+				"INSERT INTO entries SELECT ?, path, hash FROM pending",
+				(self.generation,),
+			)
+		self.written = self.db.execute(
+			"SELECT COUNT(*) FROM entries WHERE generation=?", (self.generation,)
+		).fetchone()[0]
+		self.db.execute(
+			"UPDATE generations SET count=?, sorted=?, dirs=?, blocks=?, blockSize=?, parent=?, base=?, depth=? WHERE id=?",
+			(
+				self.count,
+				int(self.sorted),
+				json.dumps(dirs) if dirs is not None else None,
+				json.dumps(blocks) if blocks is not None else None,
+				blockSize if blocks is not None else None,
+				parent,
+				base,
+				depth,
+				self.generation,
+			),
+		)
+		self.db.commit()
+		self.db.executescript("DELETE FROM pending; DELETE FROM previous;")
+		return self.generation
+
+	def abort(self) -> None:
+		self.db.rollback()
+		self.db.executescript("DELETE FROM pending; DELETE FROM previous;")
+
+
+class SnapshotStore:
+	"""A store of snapshot generations, backed by SQLite."""
+
+	# The maximum number of generations from a checkpoint to the next
+	CHECKPOINT: int = 16
+
+	@staticmethod
+	def Location() -> Path:
+		"""Returns the default location of the store directory"""
+		base = (
+			os.environ.get("XDG_DATA_HOME")
+			or f"{os.environ.get('HOME', '.')}/.local/share"
+		)
+		return Path(base) / "sink"
+
+	@staticmethod
+	def Open(directory: Optional[Path] = None) -> "SnapshotStore":
+		"""Opens the store in the given directory, creating it if needed."""
+		directory = directory or SnapshotStore.Location()
+		directory.mkdir(parents=True, exist_ok=True)
+		return SnapshotStore(sqlite3.connect(str(directory / "store.sqlite")))
+
+	def __init__(self, db: sqlite3.Connection):
+		self.db: sqlite3.Connection = db
+		if self.db.execute("PRAGMA user_version").fetchone()[0] != VERSION:
+			self.db.executescript(
+				"DROP TABLE IF EXISTS entries; DROP TABLE IF EXISTS records; DROP TABLE IF EXISTS generations; DROP TABLE IF EXISTS roots;"
+				f"PRAGMA user_version={VERSION};"
+			)
+		self.db.executescript(SCHEMA)
+
+	def rootOf(self, root: str) -> int:
+		"""Returns the identifier of the given root, registering it if needed"""
+		path = os.path.abspath(root)
+		self.db.execute("INSERT OR IGNORE INTO roots (path) VALUES (?)", (path,))
+		return int(
+			self.db.execute("SELECT id FROM roots WHERE path=?", (path,)).fetchone()[0]
+		)
+
+	def writer(self, root: str, algorithm: str) -> GenerationWriter:
+		"""Returns a writer for a new generation of the given root"""
+		return GenerationWriter(self, root, algorithm)
+
+	def add(self, root: str, snapshot: Snapshot) -> int:
+		"""Adds the given snapshot as a new generation of `root`, returning
+		its identifier."""
+		writer = self.writer(root, snapshot.algorithm)
+		try:
+			for node in snapshot.stream():
+				writer.add(node)
+		except BaseException:
+			writer.abort()
+			raise
+		return writer.close(snapshot.dirs, snapshot.blocks, snapshot.blockSize)
+
+	def generations(self, root: str) -> list[tuple[int, float, int]]:
+		"""Returns the `(id, created, count)` generations of the given root,
+		oldest first."""
+		return [
+			(int(i), float(created), int(count))
+			for i, created, count in self.db.execute(
+				"SELECT g.id, g.created, g.count FROM generations g JOIN roots r ON g.root=r.id WHERE r.path=? ORDER BY g.id",
+				(os.path.abspath(root),),
+			)
+		]
+
+	def latest(self, root: str) -> Optional[int]:
+		"""Returns the latest generation of the given root, if any"""
+		row = self.db.execute(
+			"SELECT MAX(g.id) FROM generations g JOIN roots r ON g.root=r.id WHERE r.path=?",
+			(os.path.abspath(root),),
+		).fetchone()
+		return int(row[0]) if row and row[0] is not None else None
+
+	def parentOf(self, generation: int) -> Optional[int]:
+		"""Returns the generation the given one is a delta of, if any"""
+		row = self.db.execute(
+			"SELECT parent, depth FROM generations WHERE id=?", (generation,)
+		).fetchone()
+		return int(row[0]) if row and row[1] else None
+
+	def reference(self, path: str) -> Optional[int]:
+		"""Returns the generation designated by `ROOT@GENERATION`, or by
+		`ROOT@` for the latest one, or `None` when `path` is not a reference."""
+		root, at, generation = path.rpartition("@")
+		if not at or not (generation.isdigit() or not generation):
+			return None
+		res = self.latest(root) if not generation else int(generation)
+		if res is None or res not in {_[0] for _ in self.generations(root)}:
+			raise KeyError(f"No stored snapshot for {path}")
+		return res
+
+	def chain(self, generation: int) -> list[int]:
+		"""Returns the generations from the last checkpoint of the given one,
+		which are needed to rebuild it."""
+		return [
+			int(_[0])
+			for _ in self.db.execute(
+				"SELECT g.id FROM generations g JOIN generations h ON g.root=h.root AND g.base=h.base WHERE h.id=? AND g.id <= h.id ORDER BY g.id",
+				(generation,),
+			)
+		]
+
+	def index(self, generation: int) -> str:
+		"""Returns the query of the `(path, hash)` index of the given
+		generation, sorted by path, which takes the generation as parameter.
+		Deltas are applied to their checkpoint."""
+		chain = self.chain(generation)
+		if len(chain) <= 1:
+			return "SELECT path, hash FROM entries WHERE generation=? ORDER BY path"
+		return (
+			"SELECT path, hash FROM (SELECT path, hash, ROW_NUMBER() OVER (PARTITION BY path ORDER BY generation DESC) AS latest"
+			f" FROM entries WHERE generation IN ({', '.join(str(_) for _ in chain[:-1])}, ?))"
+			" WHERE latest=1 AND hash IS NOT NULL ORDER BY path"
+		)
+
+	def load(self, generation: int) -> Snapshot:
+		"""Returns the given generation as a streamed snapshot, reading its
+		index in path order."""
+		row = self.db.execute(
+			"SELECT algorithm, sorted, dirs, blocks, blockSize FROM generations WHERE id=?",
+			(generation,),
+		).fetchone()
+		if not row:
+			raise KeyError(f"No such generation: {generation}")
+		algorithm, is_sorted, dirs, blocks, blockSize = row
+		res = self.snapshot(
+			f"SELECT e.path, r.type, r.mode, r.uid, r.gid, r.size, r.ctime, r.mtime, r.sig FROM ({self.index(generation)}) e JOIN records r ON r.hash=e.hash ORDER BY e.path",
+			(generation,),
+			algorithm,
+			bool(is_sorted),
+		)
+		res.dirs = json.loads(dirs) if dirs else None
+		if blocks is not None:
+			res.blocks, res.blockSize = json.loads(blocks), blockSize
+		return res
+
+	def delta(self, generation: int) -> tuple[Snapshot, Snapshot]:
+		"""Returns the nodes of the parent of the given generation and of the
+		generation for the paths that changed between them, as read from the
+		delta. Diffing them gives the changes between the two generations."""
+		if (parent := self.parentOf(generation)) is None:
+			raise ValueError(f"Generation {generation} is not a delta")
+		algorithm, is_sorted = self.db.execute(
+			"SELECT algorithm, sorted FROM generations WHERE id=?", (generation,)
+		).fetchone()
+		fields = "e.path, r.type, r.mode, r.uid, r.gid, r.size, r.ctime, r.mtime, r.sig"
+		changed = "SELECT path FROM entries WHERE generation=?"
+		return (
+			self.snapshot(
+				f"SELECT {fields} FROM ({self.index(parent)}) e JOIN records r ON r.hash=e.hash WHERE e.path IN ({changed}) ORDER BY e.path",
+				(parent, generation),
+				algorithm,
+				bool(is_sorted),
+			),
+			self.snapshot(
+				f"SELECT {fields} FROM entries e JOIN records r ON r.hash=e.hash WHERE e.generation=? ORDER BY e.path",
+				(generation,),
+				algorithm,
+				bool(is_sorted),
+			),
+		)
+
+	def snapshot(
+		self, query: str, parameters: tuple[Any, ...], algorithm: str, isSorted: bool
+	) -> Snapshot:
+		"""Returns a streamed snapshot of the nodes returned by the given query"""
+		cursor = self.db.execute(query, parameters)
+
+		def nodes() -> Iterator[Node]:
+			for path, type, mode, uid, gid, size, ctime, mtime, sig in cursor:
+				yield Node(
+					path.decode("utf8", "surrogateescape"),
+					type,
+					NodeMeta(mode, uid, gid, size, ctime, mtime)
+					if mode is not None
+					else None,
+					sig,
+				)
+
+		return Snapshot.Stream(nodes(), algorithm=algorithm, isSorted=isSorted)
+
+	def close(self) -> None:
+		self.db.close()
+
+
+@contextmanager
+def generations(directory: Optional[str] = None) -> Iterator[SnapshotStore]:
+	"""Opens the store in the given directory, or the default one, for the
+	duration of the context."""
+	store = SnapshotStore.Open(Path(directory) if directory else None)
+	try:
+		yield store
+	finally:
+		store.close()
+
+
+# EOF
@@ -0,0 +1,372 @@
+from typing import Callable, Iterator, Optional
+from time import monotonic
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import stat
+import struct
+from .model import Node, NodeType, Snapshot
+from .matching import IgnoreScope, PathFilter, TFilter
+from .logging import metric, event
+from .hashing import ALGORITHM
+from .cache import SignatureCache
+from .formats import formatOf, save
+from .snap import FileSystem
+
+# --
+# ## Watch
+#
+# A watcher keeps the snapshot of a directory up to date from Linux's
+# inotify events, rather than walking it again. Each directory of the
+# filtered tree is watched, touched files are stat'ed and rehashed, and new
+# directories are walked. When the kernel's event queue overflows, events
+# are lost and the whole tree is walked again.
+
+# Flags of `inotify_init1`
+IN_NONBLOCK: int = os.O_NONBLOCK
+IN_CLOEXEC: int = os.O_CLOEXEC
+# Events
+IN_MODIFY: int = 0x00000002
+IN_ATTRIB: int = 0x00000004
+IN_CLOSE_WRITE: int = 0x00000008
+IN_MOVED_FROM: int = 0x00000040
+IN_MOVED_TO: int = 0x00000080
+IN_CREATE: int = 0x00000100
+IN_DELETE: int = 0x00000200
+IN_Q_OVERFLOW: int = 0x00004000
+IN_IGNORED: int = 0x00008000
+IN_ONLYDIR: int = 0x01000000
+IN_ISDIR: int = 0x40000000
+
+# The header of an event, like `(wd, mask, cookie, len)`, followed by the
+# `len` bytes of its NUL-padded name.
+EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+	"""A minimal binding of Linux's inotify API, through `ctypes`."""
+
+	# The size of the buffer events are read into
+	BUFFER: int = 64 * 1024
+
+	def __init__(self) -> None:
+		self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		if not hasattr(self.libc, "inotify_init1"):
+			raise OSError("inotify is not available on this platform")
+		self.fd: int = self.check(self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+	def check(self, res: int, path: Optional[str] = None) -> int:
+		if res < 0:
+			code = ctypes.get_errno()
+			raise OSError(code, os.strerror(code), path)
+		return res
+
+	def add(self, path: str, mask: int) -> int:
+		"""Watches the given path, returning its watch descriptor"""
+		return self.check(
+			self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask), path
+		)
+
+	def remove(self, wd: int) -> None:
+		"""Stops watching the given descriptor, which the kernel already
+		drops when its directory is removed."""
+		if self.libc.inotify_rm_watch(self.fd, wd) < 0:
+			if ctypes.get_errno() != errno.EINVAL:
+				self.check(-1)
+
+	def read(self, timeout: Optional[float] = None) -> list[tuple[int, int, str]]:
+		"""Returns the `(wd, mask, name)` events available within `timeout`
+		seconds, reading until the queue is drained."""
+		res: list[tuple[int, int, str]] = []
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return res
+		while True:
+			try:
+				data = os.read(self.fd, self.BUFFER)
+			except BlockingIOError:
+				return res
+			offset: int = 0
+			while offset < len(data):
+				wd, mask, _, size = EVENT.unpack_from(data, offset)
+				offset += EVENT.size
+				name = os.fsdecode(data[offset : offset + size].rstrip(b"\0"))
+				offset += size
+				res.append((wd, mask, name))
+
+	def close(self) -> None:
+		os.close(self.fd)
+
+
+class Watcher:
+	"""Keeps a snapshot of the given `path` up to date, given the `accepts`,
+	`rejects` and `keeps` filters and the `.gitignore` files when `gitignore`
+	is set. The `ignored` paths, relative to `path`, are left out of the
+	snapshot."""
+
+	MASK: int = (
+		IN_MODIFY
+		| IN_ATTRIB
+		| IN_CLOSE_WRITE
+		| IN_MOVED_FROM
+		| IN_MOVED_TO
+		| IN_CREATE
+		| IN_DELETE
+		| IN_ONLYDIR
+	)
+
+	def __init__(
+		self,
+		path: str,
+		*,
+		accepts: Optional[TFilter] = None,
+		rejects: Optional[TFilter] = None,
+		keeps: Optional[TFilter] = None,
+		gitignore: bool = False,
+		jobs: int = 1,
+		cache: Optional[SignatureCache] = None,
+		algorithm: str = ALGORITHM,
+		ignored: Optional[set[str]] = None,
+	):
+		self.path: str = path
+		self.filter: PathFilter = PathFilter(
+			path, accepts=accepts, rejects=rejects, keeps=keeps, gitignore=gitignore
+		)
+		self.jobs: int = jobs
+		self.cache: Optional[SignatureCache] = cache
+		self.algorithm: str = algorithm
+		self.ignored: set[str] = ignored or set()
+		self.snapshot: Snapshot = Snapshot(algorithm=algorithm, root=path)
+		self.inotify: Optional[Inotify] = None
+		# Watched directories, by watch descriptor and by path, with the
+		# ignore scope of the latter.
+		self.watches: dict[int, str] = {}
+		self.dirs: dict[str, int] = {}
+		self.scopes: dict[str, Optional[IgnoreScope]] = {}
+		# The nodes and watched directories of each directory, so that
+		# directories are forgotten without going through the whole tree.
+		self.children: dict[str, set[str]] = {}
+		# Tells if the snapshot changed since it was last written
+		self.changed: bool = False
+		self.events = metric("watch.events")
+		self.latency = metric("watch.latency_us")
+		self.rescans = metric("watch.rescans")
+		self.overflows = metric("watch.overflows")
+
+	def start(self) -> Snapshot:
+		"""Watches the tree and takes its initial snapshot"""
+		self.inotify = Inotify()
+		self.rescan("")
+		return self.snapshot
+
+	def accepted(self, path: str, isDirectory: bool = False) -> bool:
+		parent = path.rpartition("/")[0]
+		return path not in self.ignored and self.filter.allows(
+			path, isDirectory, self.scopes.get(parent)
+		)
+
+	def link(self, path: str) -> None:
+		self.children.setdefault(path.rpartition("/")[0], set()).add(path)
+
+	def unlink(self, path: str) -> None:
+		if (children := self.children.get(path.rpartition("/")[0])) is not None:
+			children.discard(path)
+
+	def watch(self, path: str) -> Iterator[tuple[str, os.stat_result]]:
+		"""Watches the given directory and the ones it contains, yielding
+		the paths and `stat` of the other entries they contain."""
+		assert self.inotify
+		stack: list[str] = [path]
+		while stack:
+			rel = stack.pop()
+			base = f"{self.path}/{rel}" if rel else self.path
+			try:
+				wd = self.inotify.add(base, self.MASK)
+				self.watches[wd] = rel
+				self.dirs[rel] = wd
+				if rel:
+					self.link(rel)
+				self.scopes[rel] = self.filter.scope(
+					rel, self.scopes.get(rel.rpartition("/")[0]) if rel else None
+				)
+				with os.scandir(base) as entries:
+					for entry in entries:
+						sub = f"{rel}/{entry.name}" if rel else entry.name
+						if entry.is_dir(follow_symlinks=False):
+							if self.accepted(sub, True):
+								stack.append(sub)
+						elif self.accepted(sub):
+							try:
+								yield sub, entry.stat(follow_symlinks=False)
+							except FileNotFoundError:
+								pass
+			except (FileNotFoundError, NotADirectoryError):
+				continue
+
+	def forget(self, path: str) -> None:
+		"""Removes the nodes and watches of the given directory, which is
+		the whole tree when empty."""
+		nodes = self.snapshot.nodes
+		if path:
+			# The path may have been a file before being a directory
+			if path in nodes:
+				del nodes[path]
+			self.unlink(path)
+		stack: list[str] = [path]
+		while stack:
+			rel = stack.pop()
+			if (wd := self.dirs.pop(rel, None)) is not None:
+				self.watches.pop(wd, None)
+				if self.inotify:
+					self.inotify.remove(wd)
+			self.scopes.pop(rel, None)
+			for child in self.children.pop(rel, ()):
+				if child in nodes:
+					del nodes[child]
+				else:
+					stack.append(child)
+		self.changed = True
+
+	def rescan(self, path: str) -> None:
+		"""Walks the given directory again, replacing its nodes"""
+		self.rescans.inc()
+		self.forget(path)
+		# Directories are watched before being listed, so that no change
+		# goes unnoticed in between.
+		stats: Iterator[tuple[Node, Optional[os.stat_result]]] = (
+			(Node(rel, FileSystem.typeOf(r.st_mode), FileSystem.metaOf(r), None), r)
+			for rel, r in self.watch(path)
+		)
+		if self.cache:
+			stats = FileSystem.cached(stats, self.cache, self.algorithm)
+		nodes = self.snapshot.nodes
+		for node in FileSystem.hashed(
+			self.path, stats, max(1, self.jobs), self.cache, self.algorithm
+		):
+			nodes[node.path] = node
+			self.link(node.path)
+
+	def update(self, path: str) -> None:
+		"""Updates the node at the given path from its current state,
+		rehashing it if it is a file."""
+		nodes = self.snapshot.nodes
+		try:
+			r = os.lstat(f"{self.path}/{path}")
+		except FileNotFoundError:
+			if path in nodes:
+				del nodes[path]
+				self.unlink(path)
+			return
+		if stat.S_ISDIR(r.st_mode):
+			self.rescan(path)
+			return
+		node = Node(path, FileSystem.typeOf(r.st_mode), FileSystem.metaOf(r), None)
+		if node.type == NodeType.FILE:
+			node.sig = self.cache.get(r, self.algorithm) if self.cache else None
+			if node.sig is None:
+				try:
+					node.sig = FileSystem.signature(
+						f"{self.path}/{path}", self.algorithm
+					)
+				except FileNotFoundError:
+					if path in nodes:
+						del nodes[path]
+						self.unlink(path)
+					return
+				if self.cache:
+					self.cache.set(r, self.algorithm, node.sig)
+		nodes[path] = node
+		self.link(path)
+
+	def poll(self, timeout: Optional[float] = None) -> int:
+		"""Waits up to `timeout` seconds for events and applies them to the
+		snapshot, returning the number of events."""
+		assert self.inotify
+		events = self.inotify.read(timeout)
+		if not events:
+			return 0
+		started = monotonic()
+		touched: set[str] = set()
+		for wd, mask, name in events:
+			if mask & IN_Q_OVERFLOW:
+				self.overflows.inc()
+				self.rescan("")
+				touched.clear()
+				continue
+			if (parent := self.watches.get(wd)) is None:
+				continue
+			if not name:
+				# The watched directory itself was removed or moved, which its
+				# parent's events already account for, and its watch is gone.
+				if mask & IN_IGNORED and self.dirs.get(parent) == wd:
+					del self.watches[wd]
+					del self.dirs[parent]
+				continue
+			path = f"{parent}/{name}" if parent else name
+			if not self.accepted(path, bool(mask & IN_ISDIR)):
+				continue
+			if name == ".gitignore" and self.filter.gitignore:
+				# The rules of the directory changed, and so may its nodes
+				self.rescan(parent)
+				continue
+			if mask & IN_ISDIR:
+				if mask & (IN_DELETE | IN_MOVED_FROM):
+					self.forget(path)
+				elif mask & (IN_CREATE | IN_MOVED_TO):
+					self.rescan(path)
+			else:
+				touched.add(path)
+		for path in sorted(touched):
+			self.update(path)
+		self.changed = True
+		self.snapshot.dirs = None
+		self.events.add(len(events))
+		latency = monotonic() - started
+		self.latency.add(int(latency * 1_000_000))
+		event("watch.batch", {"events": len(events), "latency": latency})
+		return len(events)
+
+	def write(self, output: str, format: Optional[str] = None) -> int:
+		"""Writes the snapshot to `output` in the given `format`, which
+		defaults to the one of its extension, replacing it at once, and
+		returns the number of nodes written."""
+		directory, name = os.path.split(output)
+		temp = os.path.join(directory, f".tmp-{name}")
+		s = self.snapshot
+		res = save(
+			temp,
+			s.hashing(s.sorted()),
+			format or formatOf(output) or "json",
+			lambda: {"dirs": s.dirs} if s.dirs is not None else {},
+			algorithm=s.algorithm,
+			sorted=True,
+		)
+		os.replace(temp, output)
+		self.changed = False
+		return res
+
+	def run(
+		self,
+		output: Optional[str] = None,
+		*,
+		format: Optional[str] = None,
+		interval: float = 5.0,
+		until: Optional[Callable[[], bool]] = None,
+	) -> None:
+		"""Applies events until `until` returns true, writing the snapshot to
+		`output` when it changed, at most every `interval` seconds."""
+		written: float = monotonic()
+		while not (until and until()):
+			self.poll(interval)
+			if output and self.changed and monotonic() - written >= interval:
+				self.write(output, format)
+				written = monotonic()
+
+	def close(self) -> None:
+		if self.inotify:
+			self.inotify.close()
+			self.inotify = None
+
+
+# EOF
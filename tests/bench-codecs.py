@@ -0,0 +1,44 @@
+import os
+import sys
+import time
+import tempfile
+from sink.model import Node, NodeMeta, NodeType
+from sink.formats import CODECS, FORMATS, save, load
+
+# --
+# Compares the size and the encoding/decoding time of snapshots for each
+# format and compression codec, using a synthetic manifest that mimics a
+# source tree: nested directories, repeated names and random signatures.
+#
+# Usage: bench-codecs.py [NODES]
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+nodes = [
+	Node(
+		f"src/module-{i % 97}/pkg-{i % 13}/file-{i}.{('py', 'c', 'h', 'txt')[i % 4]}",
+		NodeType.FILE,
+		NodeMeta(0o100644, 1000, 1000, (i * 7919) % 65536, 1700000000.0 + i * 0.37, 1700000000.0 + i * 0.37),
+		os.urandom(32).hex(),
+	)
+	for i in range(count)
+]
+
+print(f"{'format':12s} {'size':>12s} {'ratio':>7s} {'write':>8s} {'read':>8s}")
+with tempfile.TemporaryDirectory(prefix="sink-bench-") as d:
+	baseline = 0
+	for ext, format in FORMATS.items():
+		for codec in ("", *CODECS):
+			path = os.path.join(d, f"snapshot{ext}{codec}")
+			started = time.monotonic()
+			save(path, nodes, format)
+			written = time.monotonic() - started
+			started = time.monotonic()
+			assert sum(1 for _ in load(path)) == count
+			read = time.monotonic() - started
+			size = os.path.getsize(path)
+			baseline = baseline or size
+			print(
+				f"{ext + codec:12s} {size:12d} {size / baseline:7.2f} {written:7.2f}s {read:7.2f}s"
+			)
+
+# EOF
@@ -0,0 +1,56 @@
+import sys
+import time
+from sink.matching import Matcher, gitignored, pattern
+
+# --
+# Measures the throughput of filters on paths made of names that repeat, like
+# in large trees, comparing the regexp built by `pattern` with the `Matcher`
+# used by walks, both matched against names and paths. Counts differ as the
+# regexp also matches the paths below a name, which walks prune anyway, and
+# exact patterns only match paths with a matcher.
+#
+# Usage: bench-filters.py [PATHS]
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+NAMES = [
+	"__pycache__",
+	"node_modules",
+	"index.js",
+	".DS_Store",
+	"README.md",
+	"main.py",
+	"main.pyc",
+	"package.json",
+	"lib",
+	"src",
+]
+paths = [
+	f"{NAMES[i % 7]}/{NAMES[(i // 7) % 10]}/{i % 1000}-{NAMES[i % 10]}"
+	if i % 3
+	else f"src/{NAMES[i % 10]}"
+	for i in range(count)
+]
+rejects = gitignored().rejects or []
+rejects += [f"*.ext{i}" for i in range(50)] + [f"name-{i}" for i in range(100)]
+rejects += ["node_modules", "__pycache__", ".DS_Store", "./build", "cache-*"]
+print(f"{len(rejects)} patterns, {count} paths")
+
+expr = pattern(rejects)
+started = time.monotonic()
+regexp_kept = sum(
+	1 for p in paths if not (expr.match(p.rpartition("/")[2]) or expr.match(p))
+)
+elapsed = time.monotonic() - started
+print(f"{'regexp':10s} {count / elapsed:12.0f} paths/s")
+
+matcher = Matcher.Compile(rejects)
+assert matcher
+started = time.monotonic()
+matcher_kept = sum(
+	1 for p in paths if not matcher.matches(p.rpartition("/")[2], p)
+)
+elapsed = time.monotonic() - started
+print(f"{'matcher':10s} {count / elapsed:12.0f} paths/s")
+print(f"kept {regexp_kept} / {matcher_kept}")
+
+# EOF
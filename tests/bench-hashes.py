@@ -0,0 +1,29 @@
+import os
+import sys
+import time
+import tempfile
+from sink.hashing import ALGORITHMS, Hasher
+
+# --
+# Measures the throughput of each signature algorithm on this machine, to
+# help picking a default. The file is hashed once beforehand so that it is
+# in the page cache, and the numbers reflect the algorithms, not the disk.
+#
+# Usage: bench-hashes.py [SIZE_MB]
+
+size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+with tempfile.NamedTemporaryFile(prefix="sink-bench-") as f:
+	block = os.urandom(1024 * 1024)
+	for _ in range(size_mb):
+		f.write(block)
+	f.flush()
+	Hasher("crc32").digest(f.name)
+	print(f"{'algorithm':12s} {'MB/s':>10s} {'digest':>8s}")
+	for name in ALGORITHMS:
+		hasher = Hasher(name)
+		started = time.monotonic()
+		digest = hasher.digest(f.name)
+		elapsed = time.monotonic() - started
+		print(f"{name:12s} {size_mb / elapsed:10.1f} {len(digest) * 4:>7d}b")
+
+# EOF
@@ -0,0 +1,58 @@
+import os
+import sys
+import time
+import resource
+import tempfile
+import hashlib
+import subprocess  # nosec: B404
+from sink.hashing import Hasher
+
+# --
+# Compares the peak memory (RSS) and the throughput of hashing a large file
+# by reading it in one piece, in reused chunks and through `mmap`. Each mode
+# runs in its own process so that the peak RSS is not shared.
+#
+# Usage: bench-hashing.py [SIZE_MB]
+
+MODES = ["read", "chunked", "mmap"]
+
+
+def run(mode: str, path: str) -> None:
+	started = time.monotonic()
+	if mode == "read":
+		h = hashlib.new("sha512_256")
+		with open(path, "rb") as f:
+			h.update(f.read())
+		h.hexdigest()
+	elif mode == "chunked":
+		Hasher().digest(path)
+	else:
+		Hasher(mmapThreshold=0).digest(path)
+	elapsed = time.monotonic() - started
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	print(f"{elapsed} {peak}")
+
+
+if len(sys.argv) > 2 and sys.argv[1] == "--run":
+	run(sys.argv[2], sys.argv[3])
+	sys.exit(0)
+
+size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+with tempfile.NamedTemporaryFile(prefix="sink-bench-") as f:
+	block = os.urandom(1024 * 1024)
+	for _ in range(size_mb):
+		f.write(block)
+	f.flush()
+	print(f"{'mode':10s} {'MB/s':>10s} {'peak RSS (MB)':>14s}")
+	for mode in MODES:
+		res = subprocess.run(  # nosec: B603
+			[sys.executable, __file__, "--run", mode, f.name],
+			capture_output=True,
+			check=True,
+		)
+		elapsed, peak = res.stdout.decode().split()
+		print(
+			f"{mode:10s} {size_mb / float(elapsed):10.1f} {int(peak) / 1024:14.1f}"
+		)
+
+# EOF
@@ -0,0 +1,47 @@
+import os
+import sys
+import tracemalloc
+from sink.model import Node, NodeMeta, NodeType, NodeTable
+
+# --
+# Measures the memory taken by the nodes of snapshots, stored as a plain
+# dictionary of `Node` objects or as a columnar `NodeTable`. Several
+# snapshots of the same tree are created, as `sink diff A B C` does, with
+# most signatures in common.
+#
+# Usage: bench-memory.py [NODES] [SNAPSHOTS]
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+snapshots = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+sigs = [os.urandom(32).hex() for _ in range(count)]
+
+
+def nodes(generation: int) -> list[Node]:
+	# Each generation changes one file out of 10, the strings are built
+	# anew each time, as they would be when loading a snapshot.
+	return [
+		Node(
+			f"src/module-{i % 97}/pkg-{i % 13}/file-{i}.py",
+			NodeType.FILE,
+			NodeMeta(0o100644, 1000, 1000, i * 17, 1700000000.5 + i, 1700000000.5 + i),
+			os.urandom(32).hex() if i % 10 == generation else bytes.fromhex(sigs[i]).hex(),
+		)
+		for i in range(count)
+	]
+
+
+def measure(name: str, factory) -> None:
+	tracemalloc.start()
+	kept = [factory(nodes(i)) for i in range(snapshots)]
+	size, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	print(
+		f"{name:12s} {size / 1024 / 1024:10.1f}MB {size / count / len(kept):10.1f}B/node"
+	)
+
+
+print(f"{'storage':12s} {'total':>12s} {'per node':>12s}")
+measure("dict", lambda _: {n.path: n for n in _})
+measure("table", NodeTable)
+
+# EOF
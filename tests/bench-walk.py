@@ -0,0 +1,105 @@
+from typing import Optional
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import subprocess  # nosec: B404
+from sink.snap import FileSystem
+
+# --
+# Compares the number of system calls per file between the former
+# `listdir`-based walk (followed by `exists` and `stat` on each path) and
+# the `scandir`-based one. System calls are counted with `strace -c` when
+# available, otherwise only the timings are reported.
+#
+# Usage: bench-walk.py [FILES]
+
+
+def legacy(path: str) -> int:
+	count = 0
+	queue: list[str] = [path]
+	while queue:
+		base_path = queue.pop()
+		for rel_path in os.listdir(base_path):
+			abs_path = f"{base_path}/{rel_path}"
+			is_link = (
+				0
+				if not os.path.islink(abs_path)
+				else (2 if os.path.isdir(os.readlink(abs_path)) else 1)
+			)
+			is_dir = True if is_link == 2 else False if is_link else os.path.isdir(abs_path)
+			if is_dir:
+				if not is_link:
+					queue.append(abs_path)
+			elif os.path.exists(abs_path):
+				os.stat(abs_path)
+				count += 1
+	return count
+
+
+def scandir(path: str) -> int:
+	return sum(1 for _ in FileSystem.inodes(path))
+
+
+def run(mode: str, path: str) -> None:
+	started = time.monotonic()
+	count = legacy(path) if mode == "legacy" else scandir(path)
+	print(f"{count} {time.monotonic() - started}")
+
+
+def syscalls(output: str) -> int:
+	"""Extracts the total number of calls from a `strace -c` summary. The
+	columns are right-aligned and some may be blank, so the calls are the
+	number that ends where the `calls` header does."""
+	end: Optional[int] = None
+	for line in output.split("\n"):
+		if end is None and (m := re.search(r"\bcalls\b", line)):
+			end = m.end()
+		elif end is not None and line.strip().endswith("total"):
+			for m in re.finditer(r"\d+", line):
+				if m.end() == end:
+					return int(m.group())
+	return 0
+
+
+if len(sys.argv) > 2 and sys.argv[1] == "--run":
+	run(sys.argv[2], sys.argv[3])
+	sys.exit(0)
+
+files = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+strace = shutil.which("strace")
+base = tempfile.mkdtemp(prefix="sink-bench-")
+empty = tempfile.mkdtemp(prefix="sink-bench-")
+try:
+	for i in range(files):
+		d = f"{base}/{i % 100:02d}/{i % 7}"
+		os.makedirs(d, exist_ok=True)
+		with open(f"{d}/{i}.txt", "wt") as f:
+			f.write(str(i))
+	print(f"{'mode':10s} {'files':>8s} {'seconds':>8s} {'syscalls/file':>14s}")
+	for mode in ("legacy", "scandir"):
+		cmd = [sys.executable, __file__, "--run", mode, base]
+		res = subprocess.run(cmd, capture_output=True, check=True)  # nosec: B603
+		count, elapsed = res.stdout.decode().split()
+		per_file = "n/a"
+		if strace:
+			# We subtract the calls made by the interpreter startup
+			traced = [strace, "-f", "-c", "-o", "/dev/stderr"]
+			total = syscalls(
+				subprocess.run(traced + cmd, capture_output=True).stderr.decode()  # nosec: B603
+			)
+			startup = syscalls(
+				subprocess.run(  # nosec: B603
+					traced + [sys.executable, __file__, "--run", mode, empty],
+					capture_output=True,
+				).stderr.decode()
+			)
+			per_file = f"{(total - startup) / int(count):.2f}"
+		print(f"{mode:10s} {count:>8s} {float(elapsed):8.3f} {per_file:>14s}")
+finally:
+	shutil.rmtree(base)
+	shutil.rmtree(empty)
+
+# EOF
@@ -0,0 +1,37 @@
+import os
+import sys
+import time
+import tempfile
+from sink.snap import FileSystem
+
+# --
+# Measures how the walk scales with the number of walker processes, on a
+# synthetic tree of `DIRS` directories nested `DEPTH` levels deep, each
+# with `FILES` files. Only the walk and `stat` calls are measured, files
+# are not hashed.
+#
+# Usage: bench-walkers.py [DIRS] [FILES] [DEPTH]
+
+dirs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+files = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+depth = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+with tempfile.TemporaryDirectory(prefix="sink-bench-") as root:
+	for i in range(dirs):
+		path = os.path.join(root, *(f"d{(i >> (4 * _)) % 16}" for _ in range(depth)), f"leaf{i}")
+		os.makedirs(path)
+		for j in range(files):
+			with open(os.path.join(path, f"file-{j}.txt"), "w") as f:
+				f.write(str(j))
+	print(f"{dirs * files} files in {dirs} directories, {os.cpu_count()} CPUs")
+	print(f"{'walkers':>8s} {'time':>8s} {'files/s':>10s} {'speedup':>7s}")
+	baseline = None
+	for walkers in (1, 2, 4, 8):
+		started = time.monotonic()
+		count = sum(1 for _ in FileSystem.stats(root, walkers=walkers))
+		elapsed = time.monotonic() - started
+		baseline = baseline or elapsed
+		assert count == dirs * files, count
+		print(f"{walkers:8d} {elapsed:7.2f}s {count / elapsed:10.0f} {baseline / elapsed:6.2f}x")
+
+# EOF
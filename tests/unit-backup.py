@@ -0,0 +1,170 @@
+import io
+import os
+import tarfile
+import tempfile
+from sink.backup import OPS, archive, iops, iscript, opline
+from sink.backup import OpData, OpMeta, OpMv, OpRm
+from sink.patch import Patch, Patcher, parse
+import errno
+import sink.copy
+from sink.snap import snapshot
+import sink.backup
+
+
+def write(path: str, data: bytes) -> None:
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, "wb") as f:
+		f.write(data)
+
+
+with tempfile.TemporaryDirectory(prefix="sink-test-") as d:
+	for i in range(20):
+		write(f"{d}/old/dir/f{i}", str(i).encode() * i)
+	write(f"{d}/old/gone", b"gone")
+	old = snapshot(f"{d}/old")
+	for i in range(20):
+		write(f"{d}/new/dir/f{i}", str(i).encode() * i)
+	write(f"{d}/new/dir/f3", b"changed")
+	write(f"{d}/new/large", os.urandom(3000))
+	os.symlink("large", f"{d}/new/link")
+	new = snapshot(f"{d}/new")
+
+	ops = list(iops(new, old))
+	assert OpRm("gone") in ops, ops
+	assert OpData("dir/f3") in ops and OpData("large") in ops, ops
+
+	# Large files are copied by the writer rather than prefetched, and the
+	# archive is the same whatever the depth of the queue.
+	sink.backup.PREFETCH_SIZE = 1024
+	for depth, codec in ((64, None), (1, ".gz"), (0, ".xz")):
+		sink.backup.PREFETCH_DEPTH = depth
+		output = io.BytesIO()
+		count, size = archive(new, old, output, codec)
+		assert count == 4 and size == 3007, (count, size)
+		output.seek(0)
+		with tarfile.open(fileobj=output, mode="r:*") as tar:
+			members = {_.name: _ for _ in tar.getmembers()}
+			assert sorted(members) == [OPS, "dir/f3", "large", "link"], members
+			assert tar.extractfile("dir/f3").read() == b"changed"
+			with open(f"{d}/new/large", "rb") as f:
+				assert tar.extractfile("large").read() == f.read()
+			assert members["link"].issym() and members["link"].linkname == "large"
+			script = tar.extractfile(OPS).read().decode().splitlines()
+			assert "RM gone" in script, script
+
+	# Scripts are parsed relative to their root, removals bottom-up
+	patch = parse(iscript(new, old, f"{d}/new"))
+	assert patch.root == f"{d}/new", patch.root
+	assert [_.path for _ in patch.removals] == ["gone"], patch.removals
+	assert [_.path for _ in patch.data] == ["dir/f3", "large"], patch.data
+	meta = parse([f"META {d}/new/a b mode=33188 mtime=1.5"], f"{d}/new").metas
+	assert meta == [OpMeta("a b", mode=33188, mtime=1.5)], meta
+	# Paths ending like a range are told apart from actual ranges
+	ops = [OpData("b 3 4", 1, 2), OpData("dir/report 2024 01")]
+	data = parse([opline(_, f"{d}/new") for _ in ops], f"{d}/new").data
+	assert data == ops, data
+
+	# Paths that would leave the root are rejected, before any change
+	for line in ("RM ../gone", "DATA /etc/passwd", f"MV {d}/new/a {d}/new/../b"):
+		try:
+			parse([line], f"{d}/new")
+			assert False, line
+		except ValueError:
+			pass
+	try:
+		unsafe = Patch(f"{d}/new", [OpRm("dir/f1")], [], [], [OpData("../x")], [])
+		Patcher(f"{d}/old").apply(unsafe)
+		assert False
+	except ValueError:
+		assert os.path.exists(f"{d}/old/dir/f1")
+
+	# A dry run changes nothing, and patching makes the directories alike
+	patcher = Patcher(f"{d}/old", dryRun=True)
+	assert patcher.apply(patch) == patch.count
+	assert os.path.exists(f"{d}/old/gone")
+	Patcher(f"{d}/old", sync=False).apply(patch)
+	expected = {_.path: (_.type, _.sig) for _ in snapshot(f"{d}/new")}
+	actual = {_.path: (_.type, _.sig) for _ in snapshot(f"{d}/old")}
+	assert actual == expected, (actual, expected)
+	assert os.readlink(f"{d}/old/link") == "large"
+
+	# Ranges are written in place
+	with open(f"{d}/new/large", "rb") as f:
+		data = f.read()
+	write(f"{d}/new/large", data[:1000] + b"x" * 10 + data[1010:])
+	Patcher(f"{d}/old", sync=False).apply(
+		parse([f"RANGE 1000 10 {d}/new/large"], f"{d}/new")
+	)
+	with open(f"{d}/old/large", "rb") as f:
+		assert f.read() == data[:1000] + b"x" * 10 + data[1010:]
+
+	# Checkpoints sync the files written and the directories changed, rather
+	# than the whole system.
+	synced: list[str] = []
+
+	class Recorder(Patcher):
+		def fsync(self, path: str) -> None:
+			synced.append(path)
+
+	Recorder(f"{d}/old").apply(
+		parse([f"RANGE 1000 10 {d}/new/large", f"RM {d}/new/dir/f2"], f"{d}/new")
+	)
+	assert synced == ["large", "dir", ""], synced
+	write(f"{d}/old/dir/f2", b"22")
+
+	# Copies fall back to the next method when one is not supported for
+	# the files, down to the buffered one.
+	def unsupported(src: int, dst: int, position: int, count: int) -> int:
+		raise OSError(errno.EXDEV, "Cross-device link")
+
+	data = data[:1000] + b"x" * 10 + data[1010:]
+	methods = sink.copy.METHODS
+	for name in methods:
+		sink.copy.METHODS = {"none": unsupported, name: methods[name]}
+		assert sink.copy.copyFile(f"{d}/new/large", f"{d}/copy") == len(data)
+		with open(f"{d}/copy", "rb") as f:
+			assert f.read() == data, name
+		assert sink.copy.copyFile(f"{d}/new/dir/f3", f"{d}/copy", 2, 3) == 3
+		with open(f"{d}/copy", "rb") as f:
+			assert f.read() == data[:2] + b"ang" + data[5:], name
+	sink.copy.METHODS = methods
+
+	# Moved files are moved by scripts rather than written again
+	os.rename(f"{d}/new/dir", f"{d}/new/moved dir")
+	new = snapshot(f"{d}/new")
+	old = snapshot(f"{d}/old")
+	ops = list(iops(new, old, moved=True))
+	assert OpMv("moved dir/f3", "dir/f3") in ops, ops
+	# Empty files are created again, which is as cheap
+	assert [_ for _ in ops if isinstance(_, (OpRm, OpData))] == [
+		OpRm("dir/f0"),
+		OpData("moved dir/f0"),
+	], ops
+	patch = parse(iscript(new, old, f"{d}/new", moved=True))
+	assert [(_.path, _.origin) for _ in patch.moves][:2] == [
+		("moved dir/f1", "dir/f1"),
+		("moved dir/f10", "dir/f10"),
+	], patch.moves
+	Patcher(f"{d}/old", sync=False).apply(patch)
+	expected = {_.path: (_.type, _.sig) for _ in snapshot(f"{d}/new")}
+	actual = {_.path: (_.type, _.sig) for _ in snapshot(f"{d}/old")}
+	assert actual == expected, (actual, expected)
+	assert not os.path.exists(f"{d}/old/dir")
+
+	# Moves whose origin is missing copy the data instead
+	write(f"{d}/old/moved dir/f1", b"stale")
+	write(f"{d}/old/moved dir/f2", b"stale")
+	os.unlink(f"{d}/old/moved dir/f1")
+	Patcher(f"{d}/old", sync=False).apply(
+		parse(
+			[
+				f"MV {d}/new/moved dir/f1 {d}/new/dir/f1",
+				f"MV {d}/new/moved dir/f2 {d}/new/dir/missing",
+			],
+			f"{d}/new",
+		)
+	)
+	actual = {_.path: (_.type, _.sig) for _ in snapshot(f"{d}/old")}
+	assert actual == expected, (actual, expected)
+
+# EOF
@@ -0,0 +1,85 @@
+import sqlite3
+from types import SimpleNamespace
+from sink.cache import VERSION, SignatureCache
+
+
+def stat(ino: int, size: int = 10, mtime: int = 1, ctime: int = 1) -> SimpleNamespace:
+	# The fields of `os.stat_result` the cache uses, with times old enough
+	# for files to be cached.
+	return SimpleNamespace(
+		st_dev=1,
+		st_ino=ino,
+		st_size=size,
+		st_mtime_ns=mtime * 1_000_000_000,
+		st_ctime_ns=ctime * 1_000_000_000,
+	)
+
+
+db = sqlite3.connect(":memory:")
+cache = SignatureCache(db)
+r = stat(1)
+cache.set(r, "sha1", "sig")
+cache.flush()
+
+# Unchanged files hit, files with another size, modification or change
+# time miss, as do other algorithms.
+assert cache.get(r, "sha1") == "sig"
+assert cache.get(stat(1), "sha1") == "sig"
+assert cache.get(stat(1, size=11), "sha1") is None
+assert cache.get(stat(1, mtime=2), "sha1") is None
+assert cache.get(stat(1, ctime=2), "sha1") is None
+assert cache.get(stat(2), "sha1") is None
+assert cache.get(r, "xxh3") is None
+cache.set(r, "xxh3", "other")
+cache.flush()
+assert cache.get(r, "sha1") == "sig" and cache.get(r, "xxh3") == "other"
+
+# Files modified recently are not cached
+cache.set(stat(3, mtime=cache.now), "sha1", "recent")
+cache.flush()
+assert cache.get(stat(3, mtime=cache.now), "sha1") is None
+
+# When rehashing, the cache is written to but not read
+rehashing = SignatureCache(db, rehash=True)
+assert rehashing.get(r, "sha1") is None
+rehashing.set(r, "sha1", "new")
+rehashing.flush()
+assert cache.get(r, "sha1") == "new"
+
+# A cache with another schema version is discarded
+db.execute(f"PRAGMA user_version={VERSION - 1}")
+cache = SignatureCache(db)
+assert db.execute("PRAGMA user_version").fetchone()[0] == VERSION
+assert cache.get(r, "sha1") is None
+
+# Entries unused for `MAX_AGE` are evicted, then the least recently used
+# ones above `MAX_ENTRIES`.
+now = cache.now
+for i in range(5):
+	cache.now = now + i * 2 * cache.USED_RESOLUTION
+	cache.set(stat(10 + i), "sha1", f"sig{i}")
+cache.flush()
+cache.now = now + 10 * cache.USED_RESOLUTION
+assert cache.get(stat(10), "sha1") == "sig0"
+cache.flush()
+cache.now = now + cache.MAX_AGE + 3 * cache.USED_RESOLUTION
+cache.evict()
+# The first two entries are too old, but the first one was used since
+assert [cache.get(stat(10 + i), "sha1") for i in range(5)] == [
+	"sig0",
+	None,
+	"sig2",
+	"sig3",
+	"sig4",
+]
+cache.MAX_ENTRIES = 2
+cache.evict()
+assert [cache.get(stat(10 + i), "sha1") for i in range(5)] == [
+	"sig0",
+	None,
+	None,
+	None,
+	"sig4",
+]
+
+# EOF
@@ -0,0 +1,166 @@
+import io
+import json
+import os
+import tempfile
+from sink.commands import diffNDJSON, diffTSV
+from sink.model import Node, NodeType, Snapshot, Status
+from sink.diff import Strategy, diff, idiff, merge, moves
+from sink.logging import metric
+from sink.model import NodeMeta
+from sink.snap import snapshot as take
+from sink.formats import load, save
+
+A = [Node(p, NodeType.FILE, None, "a") for p in ("a-b", "a.txt", "a/b", "c")]
+B = [Node(p, NodeType.FILE, None, "a") for p in ("a/b", "b", "c")]
+B[-1].sig = "b"
+
+# Rows are merged in path order, with `None` for missing nodes
+rows = list(merge(A, B))
+assert [_[0] for _ in rows] == ["a-b", "a.txt", "a/b", "b", "c"], rows
+assert rows[2][1] == [A[2], B[0]]
+assert rows[3][1] == [None, B[1]]
+
+# Streamed sorted snapshots and unsorted ones give the same result
+streamed = list(
+	idiff(Snapshot.Stream(A, isSorted=True), Snapshot.Stream(B, isSorted=True))
+)
+assert streamed == list(diff(Snapshot(reversed(A)), Snapshot(B)).items())
+assert dict(streamed)["c"] == [Status.OLDER, Status.NEWER], streamed
+
+# Streamed snapshots that are not sorted are detected
+try:
+	list(idiff(Snapshot.Stream(reversed(A), isSorted=True), Snapshot(B)))
+	raise AssertionError("Unsorted nodes should fail")
+except RuntimeError:
+	pass
+
+# Directory hashes only differ for the directories with changes
+def tree(*changed: str) -> list[Node]:
+	return [
+		Node(p, NodeType.FILE, None, "b" if p in changed else "a")
+		for p in ("a-b", "a/b/c", "a/b/d", "a/e", "b/c", "b/d/e", "c")
+	]
+
+
+def snapshot(nodes: list[Node], stream: bool) -> Snapshot:
+	res = Snapshot.Stream(nodes, isSorted=True, hashDirs=True)
+	return res if stream else res.read()
+
+
+a, b = snapshot(tree(), False), snapshot(tree("a/b/d"), False)
+assert a.dirs and b.dirs
+assert sorted(a.dirs) == ["", "a", "a/b", "b", "b/d"], a.dirs
+assert [_ for _ in a.dirs if a.dirs[_] != b.dirs[_]] == ["a/b", "a", ""]
+assert Snapshot.Stream([Node("a/b", NodeType.FILE)], isSorted=True, hashDirs=True).read().dirs == {}
+
+# Pruned diffs skip the same directories, whether the snapshots are
+# streamed or not, and report the same changes. Directory hashes of
+# streamed snapshots are known upfront when loaded from binary files.
+for stream in (True, False):
+	a, b = snapshot(tree(), False), snapshot(tree("a/b/d"), stream)
+	b.dirs = b.dirs or snapshot(tree("a/b/d"), False).dirs
+	pruned = list(idiff(a, b, prune=True))
+	assert [_[0] for _ in pruned] == ["a-b", "a/b/c", "a/b/d", "a/e", "b/", "c"], pruned
+	assert dict(pruned)["b/"] == [Status.ORIGIN, Status.SAME]
+	expected = diff(snapshot(tree(), False), snapshot(tree("a/b/d"), False))
+	assert {k: v for k, v in pruned if not k.endswith("/")} == {
+		k: v for k, v in expected.items() if not k.startswith("b/")
+	}
+
+# Binary snapshots seek past the pruned directories, and JSON snapshots are
+# pruned when their directory hashes are written before their nodes.
+with tempfile.TemporaryDirectory(prefix="sink-test-") as d:
+	expected = list(idiff(snapshot(tree(), False), snapshot(tree("a/b/d"), False), prune=True))
+	for ext in ("snap", "json"):
+		for name, changed in (("a", ()), ("b", ("a/b/d",))):
+			s = snapshot(tree(*changed), False)
+			save(f"{d}/{name}.{ext}", s.sorted(), ext, s.footer, sorted=True, dirs=s.dirs)
+		a, b = load(f"{d}/a.{ext}"), load(f"{d}/b.{ext}")
+		assert a.dirs and b.dirs and a.seekable == (ext == "snap"), ext
+		assert list(idiff(a, b, prune=True)) == expected, ext
+
+# Pruned rows don't share their statuses, which may be updated
+pruned = dict(idiff(snapshot(tree(), False), snapshot(tree("c"), False), prune=True))
+assert pruned["a/"] == pruned["b/"] and pruned["a/"] is not pruned["b/"], pruned
+
+# Machine-readable rows, with paths escaped in TSV
+rows = [(0, "a\tb\\c", [Status.ORIGIN, Status.REMOVED])]
+out = io.StringIO()
+diffTSV(out, ["A", "B"], rows, {})
+assert out.getvalue() == "row\tpath\tA\tB\torigin\n0\ta\\tb\\\\c\t.\t-\t\n", out.getvalue()
+out = io.StringIO()
+diffNDJSON(out, ["A", "B"], rows, {})
+assert json.loads(out.getvalue()) == {
+	"row": 0,
+	"path": "a\tb\\c",
+	"status": [".", "-"],
+	"origin": None,
+}
+# Moved files have the path they were moved from
+rows = [(0, "e/f", [Status.ABSENT, Status.MOVED])]
+out = io.StringIO()
+diffTSV(out, ["A", "B"], rows, {"e/f": "d/f"})
+assert out.getvalue().splitlines()[1] == "0\te/f\t!\t→\td/f", out.getvalue()
+out = io.StringIO()
+diffNDJSON(out, ["A", "B"], rows, {"e/f": "d/f"})
+assert json.loads(out.getvalue())["origin"] == "d/f", out.getvalue()
+
+# Moved files are paired by size and signature, same names first, and
+# marked as moved in both rows.
+def sized(path: str, sig: str, size: int = 1) -> Node:
+	return Node(path, NodeType.FILE, NodeMeta(0o100644, 0, 0, size, 0.0, 0.0), sig)
+
+
+old = Snapshot([sized("a/x", "1"), sized("a/y", "1"), sized("e", "0", 0), sized("z", "2")])
+new = Snapshot([sized("b/y", "1"), sized("b/z", "2", 2), sized("f", "0", 0), sized("z", "2")])
+assert moves([old.nodes["a/x"], old.nodes["a/y"]], [new.nodes["b/y"]], (old, new)) == {
+	"b/y": "a/y"
+}
+origins: dict[str, str] = {}
+statuses = dict(idiff(old, new, moved=True, origins=origins))
+assert origins == {"b/y": "a/y"}, origins
+assert statuses["a/y"] == [Status.ORIGIN, Status.MOVED], statuses
+assert statuses["b/y"] == [Status.ABSENT, Status.MOVED], statuses
+assert statuses["a/x"] == [Status.ORIGIN, Status.REMOVED], statuses
+assert statuses["b/z"] == [Status.ABSENT, Status.ADDED], statuses
+assert statuses["e"][1] == Status.REMOVED and statuses["f"][1] == Status.ADDED
+assert diff(old, new)["b/y"] == [Status.ABSENT, Status.ADDED]
+
+# Each strategy tells edits, touched files and size changes apart, hashing
+# files of the same size: always for `size`, only when their modification
+# time differs for `quick`, and never for `time`.
+with tempfile.TemporaryDirectory(prefix="sink-test-") as d:
+	for side, files in (
+		("a", {"edit": "aaaa", "touched": "same", "resized": "a", "same": "same"}),
+		("b", {"edit": "bbbb", "touched": "same", "resized": "bb", "same": "same"}),
+	):
+		for name, text in files.items():
+			os.makedirs(f"{d}/{side}", exist_ok=True)
+			with open(f"{d}/{side}/{name}", "w") as f:
+				f.write(text)
+			mtime = 1000 if side == "a" or name == "same" else 2000
+			os.utime(f"{d}/{side}/{name}", (mtime, mtime))
+	CHANGED, SAME = True, False
+	for compare, edit, touched, resized, count in (
+		(Strategy.SIGNATURE, CHANGED, SAME, CHANGED, 0),
+		(Strategy.QUICK, CHANGED, SAME, CHANGED, 4),
+		(Strategy.SIZE, CHANGED, SAME, CHANGED, 6),
+		(Strategy.TIME, CHANGED, CHANGED, CHANGED, 0),
+	):
+		signatures = compare == Strategy.SIGNATURE
+		hashed = metric("diff.hashed").value
+		statuses = diff(
+			take(f"{d}/a", signatures=signatures),
+			take(f"{d}/b", signatures=signatures),
+			strategy=compare,
+		)
+		changed = {k: v[1] != Status.SAME for k, v in statuses.items()}
+		assert changed == {
+			"edit": edit,
+			"touched": touched,
+			"resized": resized,
+			"same": SAME,
+		}, (compare, statuses)
+		assert metric("diff.hashed").value - hashed == count, compare
+
+# EOF
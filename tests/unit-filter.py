@@ -1,4 +1,7 @@
-from sink.matching import pattern, gitignored
+import os
+import tempfile
+from sink.matching import pattern, gitignored, PathFilter, Matcher
+from sink.snap import FileSystem
 
 FILES = """\
 src
@@ -30,6 +33,81 @@ assert rx_root is not None
 rejected_root = [p for p in FILES if rx_root.match(p)]
 assert rejected_root == expected, rejected_root
 
+# Matchers split patterns into names, suffixes, name globs and paths, and
+# match like the regexp of `pattern` does.
+m = Matcher.Compile(["node_modules", "*.pyc", "a?c", "./build", "src/*.tmp"])
+assert m is not None
+assert m.names == {"node_modules"} and m.suffixes == (".pyc",) and m.paths == {"build"}
+for path, expected in {
+	"node_modules": True,
+	"x/node_modules": True,
+	"x/y.pyc": True,
+	"abc": True,
+	"x/abbc": False,
+	"build": True,
+	"build/x.o": True,
+	"x/build": False,
+	"src/a.tmp": True,
+	"x/src/a.tmp": False,
+}.items():
+	assert m.match(path) == expected, (path, expected)
+	assert m.match(path) == expected, "memoized"
+assert Matcher.Compile(None) is None
+# Compiled regexps match names and paths
+assert Matcher.Of(rx).match("x/node_modules") and Matcher.Of(rx).match("node_modules/x")
+
+# Walks filter paths relative to their root, prune rejected directories, and
+# apply `.gitignore` files to the directory they're in.
+with tempfile.TemporaryDirectory(prefix="sink-test-") as d:
+	for path, text in {
+		".gitignore": "build/\n*.log\n!keep.log\n/top.txt\n",
+		"build/x.o": "",
+		"a.log": "",
+		"keep.log": "",
+		"top.txt": "",
+		"c.tmp": "",
+		"sub/top.txt": "",
+		"sub/.gitignore": "*.tmp\n!a.log\n",
+		"sub/a.log": "",
+		"sub/b.tmp": "",
+		"sub/build": "",
+		"sub/deep/d.txt": "",
+		"sub/deep/build/e.txt": "",
+	}.items():
+		os.makedirs(os.path.dirname(f"{d}/{path}"), exist_ok=True)
+		with open(f"{d}/{path}", "w") as f:
+			f.write(text)
+	walked = [_[len(d) + 1 :] for _ in FileSystem.walk(d, gitignore=True)]
+	assert walked == [
+		".gitignore",
+		"c.tmp",
+		"keep.log",
+		"sub/.gitignore",
+		"sub/a.log",
+		"sub/build",
+		"sub/deep/d.txt",
+		"sub/top.txt",
+	], walked
+	walked = [
+		_[len(d) + 1 :]
+		for _ in FileSystem.walk(d, rejects=pattern(["./sub/deep", "*.log"]))
+	]
+	assert "sub/deep/d.txt" not in walked and "sub/build" in walked, walked
+	assert not [_ for _ in walked if _.endswith(".log")], walked
+	# Accepted patterns don't prune directories
+	walked = [
+		_[len(d) + 1 :] for _ in FileSystem.walk(d, accepts=pattern(["./sub/deep/*"]))
+	]
+	assert walked == ["sub/deep/build/e.txt", "sub/deep/d.txt"], walked
+	# Walker processes filter the same way
+	walked = [
+		_[0] for _ in FileSystem.partitioned(d, gitignore=True, walkers=2)
+	]
+	assert walked == [
+		_[len(d) + 1 :] for _ in FileSystem.walk(d, gitignore=True)
+	], walked
+	assert PathFilter(d).allows("anything/at/all")
+
 # Regression: combined gitignored() reject patterns should compile
 # without raising, even when HOME .gitignore contains complex rules.
 rf = gitignored()
@@ -0,0 +1,140 @@
+import io
+import json
+from sink.model import Node, NodeMeta, NodeType, Snapshot
+import os
+import tempfile
+from sink.formats import JSONReader, BinaryReader, writeJSON, writeBinary, save, load
+from sink.hashing import BLOCK_SIG, Hasher, changedRanges
+from sink.snap import FileSystem, snapshot as take
+from sink.cache import SignatureCache
+import sqlite3
+
+NODES = [
+	Node(
+		f"dir {i % 3}/file-{i}.txt",
+		NodeType.FILE,
+		NodeMeta(0o100644, 1000, 1000, i * 1024, 1700000000.25 + i, 1700000000.5 + i),
+		f"{i:064x}",
+	)
+	for i in range(100)
+] + [Node("link", NodeType.LINK, None, None), Node('quo"ted\\', NodeType.FILE)]
+
+# The streaming writer produces the same output as dumping the primitive
+stream = io.StringIO()
+assert writeJSON(stream, NODES, algorithm="sha256") == len(NODES)
+text = stream.getvalue()
+assert text == json.dumps(Snapshot(NODES, algorithm="sha256").toPrimitive()), text
+
+# The reader yields the same nodes, whatever the size of its buffer
+for chunk in (1, 7, 64, 65536):
+	reader = JSONReader(io.StringIO(text))
+	reader.CHUNK = chunk
+	reader.start()
+	assert reader.header == {"algorithm": "sha256"}, reader.header
+	nodes = list(reader)
+	assert nodes == NODES, chunk
+
+# Header values after the nodes, whitespace and empty nodes
+reader = JSONReader(io.StringIO('{ "nodes" : { } ,\n "algorithm" : "crc32" , "n": 10 }'))
+reader.CHUNK = 3
+assert list(reader) == []
+assert reader.header == {"algorithm": "crc32", "n": 10}, reader.header
+
+# Binary snapshots restore the same nodes, including non-hex signatures
+# and negative times.
+NODES.append(Node("old", NodeType.FILE, NodeMeta(0o100600, 0, 0, 0, -1.5, 0.0), "xyz"))
+data = io.BytesIO()
+assert writeBinary(data, NODES, algorithm="sha256") == len(NODES)
+reader = BinaryReader(data.getvalue())
+assert reader.header == {"algorithm": "sha256"}, reader.header
+assert len(reader) == len(NODES)
+assert list(reader) == NODES
+
+# Sending a directory to the binary reader seeks past its nodes, without
+# decoding them, whether the directory has a node or not.
+TREE = [
+	Node(p, NodeType.DIRECTORY if p in ("a", "a/b") else NodeType.FILE, None, f"{i:02x}")
+	for i, p in enumerate(("a", "a/b", "a/b/c", "a/b/d/e", "a/f", "b/c", "b/d", "c"))
+]
+data = io.BytesIO()
+writeBinary(data, TREE)
+reader = BinaryReader(data.getvalue())
+assert len(reader.subtrees) == 4, reader.subtrees
+for skipped, sent, expected in (
+	(None, None, [_.path for _ in TREE]),
+	("a/b", "a/b/c", ["a", "a/b", "a/b/c", "a/f", "b/c", "b/d", "c"]),
+	("a", "a/b", ["a", "a/b", "b/c", "b/d", "c"]),
+	("b", "b/c", ["a", "a/b", "a/b/c", "a/b/d/e", "a/f", "b/c", "c"]),
+):
+	decoded: list[int] = []
+	varint = BinaryReader.varint
+	reader.varint = lambda offset: decoded.append(offset) or varint(reader, offset)  # type: ignore
+	nodes = iter(reader)
+	paths = []
+	for node in nodes:
+		paths.append(node.path)
+		while node.path == sent:
+			node = nodes.send(skipped)
+			paths.append(node.path)
+	assert paths == expected, (skipped, paths)
+	if skipped is None:
+		total = len(decoded)
+	else:
+		assert len(decoded) < total, skipped
+
+# Compressed snapshots, in both formats
+with tempfile.TemporaryDirectory(prefix="sink-test-") as d:
+	for name in ("a.json.gz", "a.json.xz", "a.snap.bz2", "a.snap.gz"):
+		path = os.path.join(d, name)
+		assert save(path, NODES, "snap" if ".snap" in name else "json", algorithm="md5") == len(NODES)
+		snapshot = load(path)
+		assert snapshot.algorithm == "md5", name
+		assert list(snapshot) == NODES, name
+
+# Block signatures are kept by both formats, and tell the changed ranges
+with tempfile.TemporaryDirectory(prefix="sink-test-") as d:
+	data = bytearray(os.urandom(10 * 64))
+	with open(f"{d}/a", "wb") as f:
+		f.write(data)
+	previous = Hasher().blocks(f"{d}/a", 64)
+	assert len(previous) == 10 * BLOCK_SIG, previous
+	data[130:200] = b"x" * 70
+	data += b"tail"
+	with open(f"{d}/a", "wb") as f:
+		f.write(data)
+	current = Hasher().blocks(f"{d}/a", 64)
+	assert current[: 2 * BLOCK_SIG] == previous[: 2 * BLOCK_SIG]
+	assert changedRanges(previous, current, 64) == [(128, 128), (640, 64)]
+	assert changedRanges(previous, current, 64, len(data)) == [(128, 128), (640, 4)]
+	for name in ("b.json", "b.snap"):
+		s = Snapshot(NODES, algorithm="md5", blocks={"old": current}, blockSize=64)
+		save(f"{d}/{name}", NODES, "snap" if ".snap" in name else "json", s.footer, algorithm="md5")
+		snapshot = load(f"{d}/{name}")
+		# JSON snapshots only have them once their nodes are read
+		assert list(snapshot) == NODES, name
+		assert snapshot.blocks == {"old": current}, name
+		assert snapshot.blockSize == 64, name
+
+	# Block signatures are computed as files are hashed, and reused from the
+	# cache along with their signatures, without reading the files again.
+	os.mkdir(f"{d}/e")
+	with open(f"{d}/e/a", "wb") as f:
+		f.write(data * 2)
+	expected = Hasher().blocks(f"{d}/e/a", 64)
+	os.utime(f"{d}/e/a", (1700000000, 1700000000))
+	read: list[str] = []
+	signatures = FileSystem.signatures
+	FileSystem.signatures = lambda path, *args: read.append(path) or signatures(path, *args)  # type: ignore
+	try:
+		for jobs in (1, 2):
+			cache = SignatureCache(sqlite3.connect(":memory:"))
+			for run in range(2):
+				read.clear()
+				s = take(f"{d}/e", jobs=jobs, cache=cache, blocks=64)
+				cache.flush()
+				assert s.blocks == {"a": expected} and s.blockSize == 64, (jobs, run)
+				assert read == ([f"{d}/e/a"] if not run else []), (jobs, read)
+	finally:
+		FileSystem.signatures = signatures  # type: ignore
+
+# EOF
@@ -0,0 +1,89 @@
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+from sink.cache import SignatureCache
+from sink.gitindex import GitIndex
+from sink.hashing import Hasher
+from sink.logging import metric
+from sink.matching import Matcher, filterset
+from sink.snap import FileSystem
+
+
+def git(*args: str) -> str:
+	return subprocess.run(
+		["git", *args], cwd=d, check=True, capture_output=True, text=True
+	).stdout
+
+
+if shutil.which("git"):
+	with tempfile.TemporaryDirectory(prefix="sink-test-") as d:
+		git("init", "-q")
+		for path in ("a.txt", "dir/b.txt", "dir/sub/c [1].txt", "dir/sub/d.txt", "e"):
+			os.makedirs(os.path.dirname(f"{d}/{path}"), exist_ok=True)
+			with open(f"{d}/{path}", "w") as f:
+				f.write(path * 3)
+		git("add", ".")
+		# The index lists the same entries as git, in every version
+		for version in ("2", "4"):
+			git("update-index", "--index-version", version)
+			index = GitIndex.Open(d)
+			assert index
+			# Lines are like `MODE SHA STAGE\tPATH`
+			expected = [
+				(*meta.split()[:2], path)
+				for meta, path in (_.split("\t", 1) for _ in git("ls-files", "-s").splitlines())
+			]
+			actual = [(f"{_.mode:o}", _.sha, _.path) for _ in index.entries.values()]
+			assert actual == expected, (version, actual, expected)
+
+		# Blob ids are `git` signatures, which are taken from the index for
+		# the files that did not change.
+		index = GitIndex.Open(f"{d}/dir")
+		assert index and sorted(index.paths()) == ["b.txt", "sub/c [1].txt", "sub/d.txt"]
+		sha = git("hash-object", "dir/b.txt").strip()
+		assert Hasher("git").digest(f"{d}/dir/b.txt") == sha
+		r = os.stat(f"{d}/dir/b.txt")
+		assert index.signature("b.txt", r) in (sha, None)
+		with open(f"{d}/dir/b.txt", "a") as f:
+			f.write("changed")
+		assert index.signature("b.txt", os.stat(f"{d}/dir/b.txt")) is None
+		nodes = {_.path: _.sig for _ in FileSystem.nodes(d, algorithm="git")}
+		assert nodes["dir/b.txt"] == git("hash-object", "dir/b.txt").strip()
+		assert nodes["a.txt"] == git("hash-object", "a.txt").strip()
+
+		# Signatures from the index are kept when the cache misses, so that
+		# the files that did not change are not hashed.
+		tracked = git("ls-files").splitlines()
+		for path in tracked:
+			os.utime(f"{d}/{path}", (1000, 1000))
+		git("add", ".")
+		hashed: list[str] = []
+		signature = FileSystem.signature
+		FileSystem.signature = lambda *args: hashed.append(args[0]) or ""  # type: ignore
+		try:
+			hits = metric("snap.index.hit").value
+			cache = SignatureCache(sqlite3.connect(":memory:"))
+			nodes = {
+				_.path: _.sig for _ in FileSystem.nodes(d, algorithm="git", cache=cache)
+			}
+		finally:
+			FileSystem.signature = signature  # type: ignore
+		assert not [_ for _ in tracked if f"{d}/{_}" in hashed], hashed
+		assert metric("snap.index.hit").value - hits == len(tracked), tracked
+		assert nodes["dir/b.txt"] == git("hash-object", "dir/b.txt").strip()
+
+		# The `git` filter set accepts the tracked paths only
+		with open(f"{d}/untracked", "w") as f:
+			f.write("")
+		cwd = os.getcwd()
+		os.chdir(d)
+		try:
+			m = Matcher.Compile(filterset("git").accepts)
+		finally:
+			os.chdir(cwd)
+		assert m and "dir/sub/d.txt" in m.paths and "e" in m.paths
+		assert m.match("dir/sub/c [1].txt") and not m.match("untracked")
+
+# EOF
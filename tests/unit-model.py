@@ -0,0 +1,42 @@
+from sink.model import Node, NodeMeta, NodeType, NodeTable, Snapshot
+
+NODES = [
+	Node(f"dir/file-{i}", NodeType.FILE, NodeMeta(0o100644, 1000, 0, i, 1.25 + i, -2.5), f"{i:x}")
+	for i in range(10)
+] + [Node("link", NodeType.LINK), Node("unknown", NodeType.UNKNOWN, None, "sig")]
+
+# The table restores the same nodes, in the same order
+table = NodeTable(NODES)
+assert len(table) == len(NODES)
+assert list(table.values()) == NODES
+assert list(table.nodes()) == NODES
+assert table["link"] == Node("link", NodeType.LINK)
+assert "missing" not in table and table.get("missing") is None
+
+# Nodes are detached copies, which need to be set back
+node = table["dir/file-1"]
+node.sig = "changed"
+assert table["dir/file-1"].sig == "1"
+table["dir/file-1"] = node
+assert table["dir/file-1"].sig == "changed"
+assert len(table) == len(NODES)
+del table["dir/file-1"]
+assert "dir/file-1" not in table and len(table) == len(NODES) - 1
+
+# The rows of removed nodes are reused, so the columns don't grow
+rows = len(table.types)
+for i in range(100):
+	table[f"temp-{i}"] = Node(f"temp-{i}", NodeType.FILE, None, f"t{i}")
+	del table[f"temp-{i}"]
+assert len(table.types) == rows and len(table.sigs) == rows
+new = Node("new", NodeType.FILE, NodeMeta(0o100600, 0, 0, 5, 1.0, 2.0), "5")
+table["new"] = new
+assert len(table.types) == rows and table["new"] == new
+assert table["dir/file-0"] == NODES[0] and len(table) == len(NODES)
+
+# Snapshots are backed by tables, and are the same from a dict
+snapshot = Snapshot({_.path: _ for _ in NODES})
+assert list(snapshot) == NODES
+assert Snapshot.FromPrimitive(snapshot.toPrimitive()).nodes == snapshot.nodes
+
+# EOF
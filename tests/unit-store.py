@@ -0,0 +1,74 @@
+import tempfile
+from pathlib import Path
+from sink.model import Node, NodeMeta, NodeType, Snapshot
+from sink.store import SnapshotStore
+
+
+def nodes(changed: str = "") -> list[Node]:
+	return [
+		Node(p, NodeType.FILE, NodeMeta(0o100644, 0, 0, 1, 1.5, 2.5), "b" if p == changed else "a")
+		for p in ("a", "b/c", "é") + (("b/d\udcff",) if changed else ())
+	] + [Node("link", NodeType.LINK)]
+
+
+with tempfile.TemporaryDirectory(prefix="sink-test-") as d:
+	store = SnapshotStore.Open(Path(d))
+	assert store.latest("/some/root") is None
+	first = store.add("/some/root", Snapshot.Stream(nodes(), isSorted=True, hashDirs=True))
+	writer = store.writer("/some/root", "sha256")
+	for node in nodes("b/c"):
+		writer.add(node)
+	second = writer.close({"": "x"})
+	# Only the changed record is added, paths that are not valid UTF-8 are
+	# not sorted the same.
+	assert writer.added == 1, writer.added
+	assert store.latest("/some/root") == second
+	assert [_[0] for _ in store.generations("/some/root")] == [first, second]
+
+	# Generations are restored as they were added
+	snapshot = store.load(second)
+	assert snapshot.algorithm == "sha256" and snapshot.dirs == {"": "x"}
+	assert not snapshot.isSorted
+	assert sorted(snapshot.read(), key=lambda _: _.path) == sorted(nodes("b/c"), key=lambda _: _.path)
+	snapshot = store.load(first)
+	assert snapshot.isSorted and snapshot.dirs
+	assert list(snapshot.sorted()) == sorted(nodes(), key=lambda _: _.path)
+
+	# Aborted generations leave no trace
+	writer = store.writer("/some/root", "sha256")
+	writer.add(Node("other", NodeType.FILE))
+	writer.abort()
+	assert store.latest("/some/root") == second
+
+	# Later generations are stored as deltas, with removed paths, and
+	# rebuilt from their checkpoint.
+	assert store.parentOf(first) is None and store.parentOf(second) == first
+	store.CHECKPOINT = 3
+	expected = {second: nodes("b/c")}
+	for current in (nodes("b/c")[:-1], nodes("b/c"), nodes("a")):
+		expected[store.add("/some/root", Snapshot(current))] = current
+	third, fourth, fifth = list(expected)[1:]
+	assert store.parentOf(third) == second
+	assert store.parentOf(fourth) is None, "checkpoint"
+	assert store.parentOf(fifth) == fourth
+	for generation, current in expected.items():
+		assert sorted(store.load(generation).read(), key=lambda _: _.path) == sorted(current, key=lambda _: _.path), generation
+
+	# The delta of a generation has the nodes that changed, before and after
+	assert store.reference("/some/root@") == fifth
+	assert store.reference(f"/some/root@{third}") == third
+	assert store.reference("/some/root") is None
+	before, after = store.delta(third)
+	assert [_.path for _ in before.read()] == ["link"] and not list(after)
+	before, after = store.delta(fifth)
+	assert [(_.path, _.sig) for _ in before.read()] == [("a", "a"), ("b/c", "b")]
+	assert [(_.path, _.sig) for _ in after.read()] == [("a", "b"), ("b/c", "a")]
+
+	# Block signatures are kept with their generation
+	blocked = store.add("/some/root", Snapshot(nodes(), blocks={"a": "00"}, blockSize=64))
+	loaded = store.load(blocked)
+	assert loaded.blocks == {"a": "00"} and loaded.blockSize == 64
+	assert store.load(fifth).blocks is None
+	store.close()
+
+# EOF
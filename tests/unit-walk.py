@@ -0,0 +1,44 @@
+import os
+import tempfile
+from sink.matching import pattern
+from sink.snap import FileSystem, snapshot
+
+
+def write(path: str, text: str) -> None:
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, "w") as f:
+		f.write(text)
+
+
+# The walk partitioned between processes gives the same snapshot as the
+# serial one, including when directories are split across batches.
+with tempfile.TemporaryDirectory(prefix="sink-test-") as d:
+	for i in range(40):
+		write(f"{d}/d{i % 4}/sub{i % 3}/deep{i % 2}/f{i}.txt", str(i) * i)
+		write(f"{d}/d{i % 4}/skip/f{i}.txt", str(i))
+	write(f"{d}/d0/.gitignore", "*.log\n")
+	write(f"{d}/d0/ignored.log", "log")
+	write(f"{d}/top.txt", "top")
+	os.symlink("top.txt", f"{d}/link")
+	os.symlink("d1", f"{d}/dirlink")
+	os.symlink("missing", f"{d}/d2/dangling")
+	os.mkdir(f"{d}/empty")
+	FileSystem.WALK_BATCH = 7
+	for options in ({}, {"rejects": pattern(["skip"]), "gitignore": True}):
+		serial = snapshot(d, **options)
+		paths = [_.path for _ in serial]
+		assert "link" in paths and "d2/dangling" in paths, paths
+		assert ("rejects" in options) != ("d0/skip/f0.txt" in paths), paths
+		assert ("gitignore" in options) != ("d0/ignored.log" in paths), paths
+		for walkers in (2, 3):
+			partitioned = snapshot(d, walkers=walkers, **options)
+			assert [(_.path, _.type, _.meta, _.sig) for _ in partitioned] == [
+				(_.path, _.type, _.meta, _.sig) for _ in serial
+			], walkers
+			assert partitioned.dirs == serial.dirs, walkers
+
+	# Memory-mapped files are given the same signatures
+	mapped = snapshot(d, mmapThreshold=1, jobs=2)
+	assert [(_.path, _.sig) for _ in mapped] == [(_.path, _.sig) for _ in snapshot(d)]
+
+# EOF
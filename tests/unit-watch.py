@@ -0,0 +1,75 @@
+import os
+import shutil
+import sys
+import tempfile
+from sink.snap import snapshot
+from sink.watch import Watcher
+
+
+def write(path: str, text: str) -> None:
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, "w") as f:
+		f.write(text)
+
+
+def check(watcher: Watcher, path: str) -> None:
+	# Events are applied until there are none left, after which the
+	# snapshot is the same as a new one.
+	while watcher.poll(0.2):
+		pass
+	expected = {
+		_.path: (_.type, _.sig)
+		for _ in snapshot(path)
+		if _.path not in watcher.ignored
+	}
+	actual = {_.path: (_.type, _.sig) for _ in watcher.snapshot}
+	assert actual == expected, (actual, expected)
+
+
+if sys.platform.startswith("linux"):
+	with tempfile.TemporaryDirectory(prefix="sink-test-") as d:
+		write(f"{d}/a.txt", "a")
+		write(f"{d}/sub/b.txt", "b")
+		watcher = Watcher(d, ignored={"out.json"})
+		assert set(watcher.start().nodes) == {"a.txt", "sub/b.txt"}
+
+		# Touched files are rehashed, removed ones forgotten
+		write(f"{d}/a.txt", "changed")
+		os.unlink(f"{d}/sub/b.txt")
+		write(f"{d}/out.json", "ignored")
+		check(watcher, d)
+		assert watcher.changed and "out.json" not in watcher.snapshot.nodes
+
+		# New and moved directories are walked
+		write(f"{d}/new/deep/c.txt", "c")
+		os.rename(f"{d}/sub", f"{d}/moved")
+		write(f"{d}/moved/d.txt", "d")
+		os.unlink(f"{d}/out.json")
+		check(watcher, d)
+		assert set(watcher.dirs) == {"", "new", "new/deep", "moved"}, watcher.dirs
+		assert sorted(watcher.watches.values()) == sorted(watcher.dirs)
+
+		# Removed directories are forgotten along with their watches
+		shutil.rmtree(f"{d}/new")
+		check(watcher, d)
+		assert set(watcher.dirs) == {"", "moved"}, watcher.dirs
+		assert sorted(watcher.watches.values()) == sorted(watcher.dirs)
+		assert "new" not in watcher.children.get("", ()), watcher.children
+		with open(f"/proc/self/fdinfo/{watcher.inotify.fd}") as f:
+			kernel = [_ for _ in f if _.startswith("inotify")]
+		assert len(kernel) == len(watcher.dirs), kernel
+
+		# Lost events (like on overflows) are recovered with a rescan
+		watcher.snapshot.nodes.clear()
+		watcher.rescan("")
+		check(watcher, d)
+
+		# The written snapshot has its directory hashes
+		watcher.write(f"{d}/out.json")
+		assert not watcher.changed and watcher.snapshot.dirs
+		watcher.write(f"{d}/out.json", "snap")
+		with open(f"{d}/out.json", "rb") as f:
+			assert not f.read().startswith(b"{")
+		watcher.close()
+
+# EOF